@@ -1,27 +1,196 @@
-from shard import Shard 
+from shard import Shard, CompactShard, KeyTable
+from remote_shard import RemoteShard, WorkerPool
+from hashing import get_hash_fn
+from migration import Migration
+from collections import Counter
 
-"""Base LoadBalancer class"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Base LoadBalancer class
+hash_fn picks the hash function the load balancer places keys with: a name
+registered in hashing.py, a HashFunction, or None for the default.
+"""
 class LoadBalancer:
-    def __init__(self):
+    shard_class = Shard # Shard, CompactShard to keep every key in one KeyTable, or RemoteShard to keep them in worker processes
+    num_workers = None  # Worker processes RemoteShards are spread over, None for one per CPU
+    sweep_rate = None   # With a rate, child classes that plan migrations change only their routing on add/remove
+                        # and move a key when it is next accessed, sweeping sweep_rate other keys per key put
+    migration_class = Migration # Migration for plans of ring arcs, BucketMigration for plans of table buckets
+
+    def __init__(self, hash_fn=None):
         self.num_shards = 0  # Keeps track of the number of shards
         self.shards = {}     # Map from shard_name to Shard
         self.shard_list = [] # Keeps track of a list of shards 
+        self.hash_fn = get_hash_fn(hash_fn) # Hash function used to place keys
+        self.key_table = None # KeyTable of the shards if they are CompactShards
+        self.workers = None   # WorkerPool of the shards if they are RemoteShards
+        self.epoch = 0        # Bumped whenever the shard a key routes to may have changed
+        self.routing_snapshot = None # RoutingSnapshot of the latest epoch routing() was asked for
+        self.migrations = []  # Migrations in flight, oldest first
 
     """Adds a shard using the shard_name"""
     def add_shard(self, shard_name):
+        self.epoch += 1
         self.num_shards += 1
-        self.shards[shard_name] = Shard(shard_name)
+        self.shards[shard_name] = self.new_shard(shard_name)
         self.shard_list.append(shard_name)
 
+    """Returns an empty shard of shard_class, CompactShards sharing the KeyTable of the load balancer
+    and RemoteShards its WorkerPool"""
+    def new_shard(self, shard_name):
+        if issubclass(self.shard_class, RemoteShard):
+            if self.workers is None:
+                self.workers = WorkerPool(self.num_workers)
+            return self.shard_class(shard_name, self.workers)
+        if not issubclass(self.shard_class, CompactShard):
+            return self.shard_class(shard_name)
+        if self.key_table is None:
+            self.key_table = KeyTable(self.hash_fn)
+        return self.shard_class(shard_name, self.key_table)
+
     """Removes a shard using the shard_name and returns the kvstore if there is one"""
     def remove_shard(self, shard_name):
         s = self.shards.pop(shard_name, None)
         if s:
+            self.epoch += 1
             self.shard_list.remove(shard_name)
             self.num_shards -= 1
             return s.kvstore
         return None
 
+    """Adds the shards one at a time; child classes override this to make every shard change first
+    and then move each key once, straight to its final shard"""
+    def add_shards(self, shard_names):
+        for shard_name in shard_names:
+            self.add_shard(shard_name)
+
+    """Removes the shards one at a time; child classes override this like add_shards"""
+    def remove_shards(self, shard_names):
+        for shard_name in shard_names:
+            self.remove_shard(shard_name)
+
+    """Returns the MigrationPlan of adding the shards; None where child classes only move keys synchronously"""
+    def plan_add_shards(self, shard_names):
+        return None
+
+    """Returns the MigrationPlan of removing the shards, like plan_add_shards"""
+    def plan_remove_shards(self, shard_names):
+        return None
+
+    """Applies the routing change of a plan made at the current epoch and returns the Migration
+    that moves its keys, keys_per_put keys after every key put once the migrations before it are done"""
+    def start_migration(self, plan, keys_per_put=1.0):
+        if plan.epoch != self.epoch:
+            raise ValueError('plan was made at epoch {}, the load balancer is at epoch {}'.format(plan.epoch, self.epoch))
+        self.apply_plan(plan)
+        migration = self.migration_class(self, plan, keys_per_put)
+        self.migrations.append(migration)
+        self.end_migrations()
+        return migration
+
+    """Ends the finished migrations at the front of migrations. A migration only ends once the ones
+    before it have: their pending moves may still come from the shards it removes"""
+    def end_migrations(self):
+        while self.migrations and self.migrations[0].done():
+            self.end_migration(self.migrations[0])
+
+    """Moves up to max_keys keys of the migrations in flight, oldest first, and returns how many moved"""
+    def migrate(self, max_keys):
+        moved = 0
+        while self.migrations and moved < max_keys:
+            moved += self.migrations[0].step(max_keys - moved)
+        return moved
+
+    """Moves all keys of the migrations in flight"""
+    def finish_migration(self):
+        self.migrate(float('inf'))
+
+    """In lazy mode, starts migrating the plan plan_change(shard_names) returns and returns True;
+    otherwise, or without a plan, finishes the migrations in flight and returns False so the caller
+    changes the shards synchronously"""
+    def start_lazy_migration(self, plan_change, shard_names):
+        if self.sweep_rate is not None:
+            plan = plan_change(shard_names)
+            if plan is not None:
+                self.start_migration(plan, self.sweep_rate)
+                return True
+        self.finish_migration()
+        return False
+
+    """Moves the keys (with hashes vals) that migrations in flight have yet to move to the shards
+    they route to, before they are accessed"""
+    def claim(self, keys, vals):
+        for migration in self.migrations:
+            migration.claim(keys, vals)
+
+    """Returns the shard key (with hash val) waits on to be migrated from, None if it waits on none"""
+    def holder(self, key, val):
+        for migration in self.migrations:
+            holder = migration.holder(key, val)
+            if holder is not None:
+                return holder
+        return None
+
+    """Should be implemented in child classes that plan migrations: changes the routing to the plan"""
+    def apply_plan(self, plan):
+        raise NotImplementedError
+
+    """Should be implemented in child classes that plan migrations: forgets the finished migration
+    and drops the shards it drained"""
+    def end_migration(self, migration):
+        raise NotImplementedError
+
     """Should be implemented in child classes"""
     def put(self, key, value=0):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    """Returns the name of the shard storing key; None where child classes can only find it by searching"""
+    def getShardNameForKey(self, key):
+        return None
+
+    """Returns an immutable RoutingSnapshot of the current epoch, built once per epoch"""
+    def routing(self):
+        if self.routing_snapshot is None or self.routing_snapshot.epoch != self.epoch:
+            self.routing_snapshot = self.build_routing()
+        return self.routing_snapshot
+
+    """Should be implemented in child classes that route keys by their hash: the RoutingSnapshot of the current epoch"""
+    def build_routing(self):
+        raise NotImplementedError
+
+    """Returns the access count of key, None if it is not stored, first moving it to the shard it
+    routes to if a migration in flight has yet to"""
+    def get(self, key):
+        if not self.shards:
+            return None
+        if self.migrations:
+            self.claim([key], [self.hash_fn(key)])
+        shard_name = self.getShardNameForKey(key)
+        if shard_name is not None:
+            return self.shards[shard_name].get(key)
+        for shard in self.shards.values():
+            count = shard.get(key)
+            if count is not None:
+                return count
+        return None
+
+    """Puts a batch of keys in order; hash based child classes override this with a vectorized version
+    that reuses hashes[i], the precomputed hash_fn hash of keys[i], when given"""
+    def put_many(self, keys, hashes=None):
+        for key in keys:
+            self.put(key)
+
+    """Returns the distinct keys of a batch, their counts and their hashes, hashing
+    each distinct key once unless the hashes of keys are given"""
+    def count_keys(self, keys, hashes=None):
+        counts = Counter(keys)
+        uniq = list(counts)
+        if hashes is None:
+            return uniq, list(counts.values()), self.hash_fn.many(uniq)
+        # a dict keeps the first position of every key, like the Counter
+        vals = list(dict(zip(keys, hashes.tolist() if np is not None else hashes)).values())
+        return uniq, list(counts.values()), np.array(vals, dtype=hashes.dtype) if np is not None else vals
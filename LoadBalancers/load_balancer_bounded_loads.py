@@ -0,0 +1,158 @@
+from .load_balancer_hash_shard_mult import ConsistentHashingLoadBalancer
+from routing import RingSnapshot
+import math
+
+"""
+Consistent Hashing with Bounded Loads
+Places keys on the consistent hashing ring, but no shard may hold more than
+capacity = ceil((1 + epsilon) * keys / shards) keys (Mirrokni et al., 2018).
+A key whose ring owner is full spills to the next shard clockwise with room.
+Spilled keys are tracked so they are found again without walking the ring, and
+membership changes only re-place the keys they touch plus any keys over the
+new capacity.
+"""
+class BoundedLoadsLoadBalancer(ConsistentHashingLoadBalancer):
+
+    def __init__(self, hash_fn=None, num_rounds=5, epsilon=0.25):
+        super().__init__(hash_fn, num_rounds)
+        self.epsilon = epsilon # How far above the mean load a shard may go
+        self.num_keys = 0      # Number of distinct keys stored
+        self.spilled = {}      # key -> (shard_name, hash) for keys not on their ring owner
+
+    # Maximum number of keys a shard may hold right now
+    def capacity(self):
+        return math.ceil((1 + self.epsilon) * max(self.num_keys, 1) / self.num_shards)
+
+    # Adds a shard, see add_shards
+    def add_shard(self, shard_name):
+        self.add_shards([shard_name])
+
+    # Adds shards, takes over their arcs up to the (now lower) capacity, brings
+    # home the spilled keys they now own and re-places keys on shards still over
+    # it; new shards never go over it, so no key moves twice
+    def add_shards(self, shard_names):
+        super().add_shards(shard_names)
+        cap = self.capacity()
+        new = set(shard_names)
+        for key, (holder, val) in list(self.spilled.items()):
+            if not new:
+                break
+            owner = self.ring.lookup(val)
+            if owner not in new:
+                continue
+            if len(self.shards[owner].kvstore) >= cap:
+                new.discard(owner)
+                continue
+            self.key_index[holder].discard(key, val)
+            self.store(key, val, owner, self.shards[holder].kvstore.pop(key))
+        self.enforce_capacity()
+
+    # Removes a shard, see remove_shards
+    def remove_shard(self, shard_name):
+        self.remove_shards([shard_name])
+
+    # Removes shards, re-places their keys and forgets the spills whose holder
+    # became their ring owner
+    def remove_shards(self, shard_names):
+        super().remove_shards(shard_names)
+        for key, (holder, val) in list(self.spilled.items()):
+            if self.ring.lookup(val) == holder:
+                del self.spilled[key]
+
+    # Capacity re-places keys based on the loads of all shards at once, so
+    # membership changes are not planned and stay synchronous
+    def plan_add_shards(self, shard_names):
+        return None
+
+    def plan_remove_shards(self, shard_names):
+        return None
+
+    # Puts a key in a certain shard, incrementing the access count
+    def put(self, k):
+        spill = self.spilled.get(k)
+        if spill is not None:
+            self.shards[spill[0]].put(k, 1)
+            return
+        val = self.hash_fn(k)
+        shard = self.shards[self.ring.lookup(val)]
+        if k in shard.kvstore:
+            shard.put(k, 1)
+            return
+        self.num_keys += 1
+        self.store(k, val, self.place(val), 1)
+
+    # Placement depends on the loads left by the keys before, so batches are put one by one
+    def put_many(self, keys, hashes=None):
+        for k in keys:
+            self.put(k)
+
+    """ Rebalance Utils """
+
+    # Gets the shard storing this key
+    def getShardNameForKey(self, key):
+        spill = self.spilled.get(key)
+        return spill[0] if spill is not None else super().getShardNameForKey(key)
+
+    # Returns the ring of this epoch, with the spilled keys as overrides
+    def build_routing(self):
+        spilled = {key: holder for key, (holder, _) in self.spilled.items()}
+        return RingSnapshot(self.epoch, self.hash_fn, self.ring.snapshot(), spilled)
+
+    # Gets the first shard clockwise from val with room for one more key
+    def place(self, val):
+        cap = self.capacity()
+        ring = self.ring
+        start = ring.slot(val)
+        full = set()
+        for step in range(len(ring)):
+            shard_name = ring.names[ring.owners[(start + step) % len(ring)]]
+            if shard_name in full:
+                continue
+            if len(self.shards[shard_name].kvstore) < cap:
+                return shard_name
+            full.add(shard_name)
+            if len(full) == self.num_shards:
+                break
+        return ring.lookup(val) # unreachable while capacity >= mean load
+
+    # Stores key with the given count on shard_name and records if it spilled
+    def store(self, key, val, shard_name, count):
+        self.shards[shard_name].put(key, count, val)
+        self.key_index[shard_name].add(key, val)
+        if shard_name == self.ring.lookup(val):
+            if self.spilled.pop(key, None) is not None:
+                self.epoch += 1
+        else:
+            self.spilled[key] = (shard_name, val)
+            self.epoch += 1
+
+    # Moves the keys of the arc (lo, hi] from src to dst, as many as dst has room
+    # for; the rest stay on src as spills, for enforce_capacity to re-place if
+    # src is over capacity
+    def take_arc(self, lo, hi, src, dst):
+        items = self.key_index[src].pop_arc(lo, hi)
+        room = max(self.capacity() - len(self.shards[dst].kvstore), 0)
+        if room and items:
+            keys, vals = zip(*items[:room])
+            self.shards[dst].take(self.shards[src].kvstore, keys)
+            self.key_index[dst].add_many(keys, vals)
+        if len(items) > room:
+            for key, val in items[room:]:
+                self.spilled[key] = (src, val)
+            self.key_index[src].add_many(*zip(*items[room:]))
+            self.epoch += 1
+
+    # Re-places the (key, hash) pairs of `items` out of the passed in kvstore
+    def rekey(self, items, kvstore):
+        for key, val in items:
+            self.spilled.pop(key, None)
+            self.store(key, val, self.place(val), kvstore.pop(key))
+
+    # Moves keys off every shard holding more than the capacity
+    def enforce_capacity(self):
+        cap = self.capacity()
+        for (shard_name, shard) in list(self.shards.items()):
+            excess = len(shard.kvstore) - cap
+            if excess > 0:
+                evicted = self.key_index[shard_name].pop_highest(excess)
+                self.rekey(evicted, shard.kvstore)
@@ -1,5 +1,4 @@
 from .load_balancer import LoadBalancer
-from utils import hash_fn
 
 """
 Broken Load Balancer 
@@ -8,17 +7,27 @@ and fails to rebalance on removes
 """
 class BrokenLoadBalancer(LoadBalancer):
     # Initialize data structures
-    def __init__(self):
-        super().__init__()
+    def __init__(self, hash_fn=None):
+        super().__init__(hash_fn)
 
     # Adds a shard to the system and rebalances the system
     def add_shard(self, shard_name):
         super().add_shard(shard_name)
 
+    # Adds shards to the system
+    def add_shards(self, shard_names):
+        for shard_name in shard_names:
+            super().add_shard(shard_name)
+
     # Removes a shard from the system and rebalances the system
     def remove_shard(self, shard_name):
         kvstore = super().remove_shard(shard_name)
 
+    # Removes shards from the system
+    def remove_shards(self, shard_names):
+        for shard_name in shard_names:
+            super().remove_shard(shard_name)
+
     # Store the given key in a shard
     def put(self, k):
         shard = self.shard_list[0]
@@ -1,34 +1,53 @@
 from .load_balancer import LoadBalancer
-from utils import hash_fn
+from utils import group_by_owner, np
+from routing import TableSnapshot
 
 """
 Hash Key Load Balancer
 Assigns keys in a consistent manner and rebalances using hash functions.
 """
 class HashKeyLoadBalancer(LoadBalancer):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, hash_fn=None):
+        super().__init__(hash_fn)
         # Feel free to add things here
 
     # Adds a shard to the system and rebalance as necessary
     def add_shard(self, shard_name):
-        super().add_shard(shard_name)
+        self.add_shards([shard_name])
+
+    # Adds shards and re-maps all keys once for the whole batch
+    def add_shards(self, shard_names):
+        for shard_name in shard_names:
+            super().add_shard(shard_name)
         self.rebalance() # all keys need to be re-mapped
 
     # Remove a shard to the system and rebalance as necessary
     def remove_shard(self, shard_name):
-        kvstore = super().remove_shard(shard_name)
+        self.remove_shards([shard_name])
+
+    # Removes shards and re-maps all keys once for the whole batch
+    def remove_shards(self, shard_names):
+        kvstores = []
+        for shard_name in shard_names:
+            kvstores.append((super().remove_shard(shard_name), shard_name))
         self.rebalance() # all keys need to be re-mapped
-        self.rekey(kvstore, shard_name) # re-assigns keys in removed shard
+        for kvstore, shard_name in kvstores:
+            self.rekey(kvstore, shard_name) # re-assigns keys in removed shards
 
-    # Re-Assigns the keys in the passed in kvstore
+    # Re-Assigns the keys in the passed in kvstore, using the hashes it kept
     def rekey(self, kvstore, shard_name):
-        for key in list(kvstore.keys()):
-            targetShardName = self.getShardNameForKey(key)
-            if targetShardName != shard_name: # have to move this key
-                val = kvstore.pop(key)
-                targetShard = self.shards[targetShardName]
-                targetShard.put(key, val)
+        keys = list(kvstore.keys())
+        if not keys:
+            return
+        vals = kvstore.hash_many(keys, self.hash_fn)
+        if np is not None:
+            shardNums = vals % self.num_shards
+        else:
+            shardNums = [val % self.num_shards for val in vals]
+        for shardNum, (group,) in group_by_owner(shardNums, keys).items():
+            targetShardName = self.shard_list[shardNum]
+            if targetShardName != shard_name: # have to move these keys
+                self.shards[targetShardName].take(kvstore, group)
 
     # Re-assigns all of the keys in the current configuration
     def rebalance(self):
@@ -37,10 +56,26 @@ class HashKeyLoadBalancer(LoadBalancer):
 
     # Gets the shard assigned to this key
     def getShardNameForKey(self, key):
-        shardNum = hash_fn(key) % self.num_shards
+        shardNum = self.hash_fn(key) % self.num_shards
         return self.shard_list[shardNum]
 
+    # Returns the shard list of this epoch, as a table routing slot i to shard i
+    def build_routing(self):
+        return TableSnapshot(self.epoch, self.hash_fn, self.shard_list, range(self.num_shards))
+
     # Puts a key in a certain shard, incrementing the access count
     def put(self, k):
-        shard = self.shards[self.getShardNameForKey(k)]
-        shard.put(k, 1)
+        val = self.hash_fn(k)
+        shard = self.shards[self.shard_list[val % self.num_shards]]
+        shard.put(k, 1, val)
+
+    # Puts a batch of keys, hashing every distinct key once and applying one
+    # grouped update per shard
+    def put_many(self, keys, hashes=None):
+        uniq, counts, vals = self.count_keys(keys, hashes)
+        if np is not None:
+            shardNums = vals % self.num_shards
+        else:
+            shardNums = [val % self.num_shards for val in vals]
+        for shardNum, (group, groupCounts, groupVals) in group_by_owner(shardNums, uniq, counts, vals).items():
+            self.shards[self.shard_list[shardNum]].put_many(group, groupCounts, groupVals)
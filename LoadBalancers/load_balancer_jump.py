@@ -0,0 +1,91 @@
+from .load_balancer import LoadBalancer
+from utils import group_by_owner, jump_hash, jump_hash_many
+from routing import JumpSnapshot
+
+"""
+Jump Consistent Hash Load Balancer
+Assigns keys to dense bucket ids with jump consistent hashing, so there is no
+ring and only O(1) memory per shard. Appending a shard moves 1/n of the keys.
+Removing a shard from the middle hands its bucket id to the last shard, so
+the bucket ids stay dense and only the keys of those two shards move.
+"""
+class JumpHashLoadBalancer(LoadBalancer):
+
+    def __init__(self, hash_fn=None):
+        super().__init__(hash_fn)
+        self.buckets = []   # bucket id -> shard_name
+        self.bucket_of = {} # shard_name -> bucket id
+
+    # Appends a shard as the last bucket and pulls in the keys that jump to it
+    def add_shard(self, shard_name):
+        self.add_shards([shard_name])
+
+    # Appends shards as the last buckets, then pulls the keys that jump to any
+    # of them out of the shards that were there before, in one pass each
+    def add_shards(self, shard_names):
+        old = list(self.shards)
+        for shard_name in shard_names:
+            super().add_shard(shard_name)
+            self.bucket_of[shard_name] = len(self.buckets)
+            self.buckets.append(shard_name)
+        for name in old:
+            self.rekey(self.shards[name].kvstore, name)
+
+    # Removes a shard, gives its bucket id to the last shard and re-assigns
+    # the keys of both
+    def remove_shard(self, shard_name):
+        self.remove_shards([shard_name])
+
+    # Removes shards, giving each bucket id they free to the last shard, then
+    # re-assigns the keys of the shards whose bucket id changed and of the
+    # removed ones; all other shards keep their keys as their ids stay below
+    # the new number of buckets
+    def remove_shards(self, shard_names):
+        kvstores = []
+        moved = []
+        for shard_name in shard_names:
+            kvstores.append((super().remove_shard(shard_name), shard_name))
+            bucket = self.bucket_of.pop(shard_name)
+            last = self.buckets.pop()
+            if last != shard_name:
+                self.buckets[bucket] = last
+                self.bucket_of[last] = bucket
+                moved.append(last)
+        for name in dict.fromkeys(moved):
+            if name in self.shards:
+                self.rekey(self.shards[name].kvstore, name)
+        for kvstore, shard_name in kvstores:
+            self.rekey(kvstore, shard_name)
+
+    # Puts a key in a certain shard, incrementing the access count
+    def put(self, k):
+        val = self.hash_fn(k)
+        shard = self.shards[self.buckets[jump_hash(val, len(self.buckets))]]
+        shard.put(k, 1, val)
+
+    # Puts a batch of keys, hashing and jumping every distinct key once
+    def put_many(self, keys, hashes=None):
+        uniq, counts, vals = self.count_keys(keys, hashes)
+        buckets = jump_hash_many(vals, len(self.buckets))
+        for bucket, (group, groupCounts, groupVals) in group_by_owner(buckets, uniq, counts, vals).items():
+            self.shards[self.buckets[bucket]].put_many(group, groupCounts, groupVals)
+
+    # Gets the shard assigned to this key
+    def getShardNameForKey(self, key):
+        return self.buckets[jump_hash(self.hash_fn(key), len(self.buckets))]
+
+    # Returns the buckets of this epoch
+    def build_routing(self):
+        return JumpSnapshot(self.epoch, self.hash_fn, self.buckets)
+
+    # Re-Assigns the keys in the passed in kvstore that no longer belong to
+    # shard_name, using the hashes it kept
+    def rekey(self, kvstore, shard_name):
+        keys = list(kvstore.keys())
+        if not keys:
+            return
+        buckets = jump_hash_many(kvstore.hash_many(keys, self.hash_fn), len(self.buckets))
+        for bucket, (group,) in group_by_owner(buckets, keys).items():
+            targetShardName = self.buckets[bucket]
+            if targetShardName != shard_name:
+                self.shards[targetShardName].take(kvstore, group)
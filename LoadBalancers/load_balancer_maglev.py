@@ -0,0 +1,221 @@
+from .load_balancer import LoadBalancer
+from utils import group_by_owner, np
+from routing import TableSnapshot
+from migration import BucketMove, BucketMigration, MigrationPlan
+from array import array
+
+# Returns whether n is a prime, by trial division
+def is_prime(n):
+    return n > 1 and all(n % d for d in range(2, int(n ** 0.5) + 1))
+
+"""
+Maglev Load Balancer
+Routes a key with a single lookup, table[hash(key) % table_size], into a table
+that every shard fills by taking turns walking its own permutation of the
+slots (Eisenbud et al., "Maglev", NSDI 2016). Shards end up owning nearly the
+same number of slots, and a membership change rebuilds the table and moves only
+the keys whose slot changed owner, found through a slot -> keys index, or
+plans them as a BucketMigration of those slots.
+table_size must be a prime, so every permutation visits every slot, and
+should be much larger than the number of shards.
+"""
+class MaglevLoadBalancer(LoadBalancer):
+    migration_class = BucketMigration
+
+    def __init__(self, hash_fn=None, table_size=65537):
+        super().__init__(hash_fn)
+        if not is_prime(table_size):
+            raise ValueError('table_size must be a prime, got {}'.format(table_size))
+        self.table_size = table_size
+        self.members = []                     # shard names, in table-filling order
+        self.table = array('i')               # slot -> position in members
+        self.slot_keys = [None] * table_size  # slot -> set of keys stored for it
+
+    # Adds a shard to the system and moves the keys of the slots it takes
+    def add_shard(self, shard_name):
+        self.add_shards([shard_name])
+
+    # Adds shards with a single table rebuild
+    def add_shards(self, shard_names):
+        if self.start_lazy_migration(self.plan_add_shards, shard_names):
+            return
+        for shard_name in shard_names:
+            super().add_shard(shard_name)
+        self.rebuild({})
+
+    # Removes a shard and moves the keys of the slots it owned
+    def remove_shard(self, shard_name):
+        self.remove_shards([shard_name])
+
+    # Removes shards with a single table rebuild
+    def remove_shards(self, shard_names):
+        if self.start_lazy_migration(self.plan_remove_shards, shard_names):
+            return
+        removed = {}
+        for shard_name in shard_names:
+            removed[shard_name] = super().remove_shard(shard_name)
+        self.rebuild(removed)
+
+    # Puts a key in a certain shard, incrementing the access count
+    def put(self, k):
+        val = self.hash_fn(k)
+        if self.migrations:
+            self.claim([k], [val])
+        slot = val % self.table_size
+        shard = self.shards[self.members[self.table[slot]]]
+        if shard.put(k, 1, val) == 1: # first time we see k
+            self.index(k, slot)
+        if self.migrations:
+            self.migrations[0].pace(1)
+
+    # Puts a batch of keys with one table lookup per distinct key
+    def put_many(self, keys, hashes=None):
+        uniq, counts, vals = self.count_keys(keys, hashes)
+        if self.migrations:
+            self.claim(uniq, vals)
+        if np is not None:
+            slots = vals % self.table_size
+            owners = np.frombuffer(self.table, dtype='i')[slots]
+        else:
+            slots = [val % self.table_size for val in vals]
+            owners = [self.table[slot] for slot in slots]
+        # every group is handed out before the new keys of any are read, so
+        # shards in worker processes apply theirs in parallel
+        sent = [(group, groupSlots, self.shards[self.members[owner]].put_many(group, groupCounts, groupVals))
+                for owner, (group, groupCounts, groupSlots, groupVals) in group_by_owner(owners, uniq, counts, slots, vals).items()]
+        for group, groupSlots, new in sent:
+            for i in new:
+                self.index(group[i], groupSlots[i])
+        if self.migrations:
+            self.migrations[0].pace(len(keys))
+
+    # Gets the shard assigned to this key, or the one it waits on to be migrated
+    def getShardNameForKey(self, key):
+        val = self.hash_fn(key)
+        return self.holder(key, val) or self.members[self.table[val % self.table_size]]
+
+    # Returns the lookup table of this epoch
+    def build_routing(self):
+        return TableSnapshot(self.epoch, self.hash_fn, self.members, self.table)
+
+    """ Migrations """
+
+    # Returns the plan of adding shards: every slot the rebuilt table gives
+    # another owner, with the number of keys of the slot on its owner now (not
+    # counting the keys migrations in flight have yet to move there); None for
+    # the first shards, which have no keys to take
+    def plan_add_shards(self, shard_names):
+        if any(shard_name in self.shards for shard_name in shard_names):
+            self.finish_migration() # a removed shard of the same name is still draining
+        if not self.members:
+            return None
+        return self.plan(shard_names, [], self.members + list(shard_names))
+
+    # Returns the plan of removing shards, like plan_add_shards; None when no
+    # shard would be left
+    def plan_remove_shards(self, shard_names):
+        for shard_name in shard_names:
+            if shard_name not in self.members:
+                raise ValueError('shard {} is not in the table'.format(shard_name))
+        members = [member for member in self.members if member not in shard_names]
+        if not members:
+            return None
+        return self.plan([], shard_names, members)
+
+    # Returns the MigrationPlan of changing the table to one for members
+    def plan(self, added, removed, members):
+        table = self.populate(members)
+        moves = []
+        for slot in range(self.table_size):
+            src, dst = self.members[self.table[slot]], members[table[slot]]
+            if src == dst:
+                continue
+            keys = self.slot_keys[slot] or ()
+            if self.migrations:
+                kvstore = self.shards[src].kvstore
+                numKeys = sum(key in kvstore for key in keys)
+            else:
+                numKeys = len(keys)
+            moves.append(BucketMove(src, dst, slot, numKeys))
+        return MigrationPlan(self.epoch, added, removed, moves, (members, table))
+
+    # Routes keys with the table of the plan; removed shards keep their keys
+    # (and stay in shards) until the migration drains them
+    def apply_plan(self, plan):
+        for shard_name in plan.added:
+            super().add_shard(shard_name)
+        if plan.removed:
+            self.epoch += 1
+        self.members, self.table = plan.layout
+
+    # Forgets the finished migration and drops the shards it drained
+    def end_migration(self, migration):
+        self.migrations.remove(migration)
+        for shard_name in migration.plan.removed:
+            super().remove_shard(shard_name)
+
+    # Returns the slot of each hash in vals (a NumPy array if NumPy is installed)
+    def bucket_of(self, vals):
+        if np is not None:
+            return vals % self.table_size
+        return [val % self.table_size for val in vals]
+
+    # Returns the keys stored for slot
+    def bucket_keys(self, slot):
+        return self.slot_keys[slot] or ()
+
+    # Moves keys of slot out of kvstore to the shard owning the slot now
+    def rekey_bucket(self, slot, keys, kvstore):
+        shard = self.shards[self.members[self.table[slot]]]
+        if shard.kvstore is not kvstore: # a migration can find keys back on their owner
+            shard.take(kvstore, keys)
+
+    """ Table Utils """
+
+    # Records that a key of `slot` is stored
+    def index(self, key, slot):
+        keys = self.slot_keys[slot]
+        if keys is None:
+            keys = self.slot_keys[slot] = set()
+        keys.add(key)
+
+    # Rebuilds the table for the current shard_list and moves the keys of every
+    # slot that changed owner; removed_kvstores maps removed shards to their kvstores
+    def rebuild(self, removed_kvstores):
+        oldMembers, oldTable = self.members, self.table
+        self.members = list(self.shard_list)
+        self.table = self.populate(self.members)
+        if not oldMembers or not self.members: # no keys yet, or no shard left to hold them
+            return
+        for slot in range(self.table_size):
+            src, dst = oldMembers[oldTable[slot]], self.members[self.table[slot]]
+            keys = self.slot_keys[slot]
+            if src == dst or not keys:
+                continue
+            kvstore = self.shards[src].kvstore if src in self.shards else removed_kvstores[src]
+            self.shards[dst].take(kvstore, list(keys))
+
+    # Fills a table for `members`: each shard in turn claims the next free slot
+    # of its permutation (offset + j * skip) % table_size until all are taken
+    def populate(self, members):
+        if not members:
+            return array('i')
+        size = self.table_size
+        table = array('i', [-1]) * size
+        offsets = [self.hash_fn(name + '#offset') % size for name in members]
+        skips = [self.hash_fn(name + '#skip') % (size - 1) + 1 for name in members]
+        nexts = [0] * len(members)
+        filled = 0
+        while filled < size:
+            for i in range(len(members)):
+                offset, skip, j = offsets[i], skips[i], nexts[i]
+                slot = (offset + j * skip) % size
+                while table[slot] >= 0:
+                    j += 1
+                    slot = (offset + j * skip) % size
+                table[slot] = i
+                nexts[i] = j + 1
+                filled += 1
+                if filled == size:
+                    break
+        return table
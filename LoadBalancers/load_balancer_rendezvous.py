@@ -0,0 +1,88 @@
+from .load_balancer import LoadBalancer
+from utils import group_by_owner, fmix64, rendezvous_owners
+from routing import RendezvousSnapshot
+
+"""
+Rendezvous (Highest Random Weight) Load Balancer
+Every key goes to the shard with the highest score(key, shard). Adding a shard
+only moves the keys it now wins and removing one only moves its own keys, with
+no virtual nodes to tune. Shards can be given weights to take a larger share.
+"""
+class RendezvousLoadBalancer(LoadBalancer):
+
+    def __init__(self, hash_fn=None):
+        super().__init__(hash_fn)
+        self.weights = {} # shard_name -> weight
+        self.seeds = {}   # shard_name -> seed mixed into its scores
+
+    # Adds a shard with the given weight and moves over the keys it now wins
+    def add_shard(self, shard_name, weight=1.0):
+        self.add_shards([shard_name], [weight])
+
+    # Adds shards with the given weights (1.0 each by default) and moves every
+    # key one of them now wins straight to the best of them
+    def add_shards(self, shard_names, weights=None):
+        old = list(self.shards)
+        for shard_name, weight in zip(shard_names, weights or [1.0] * len(shard_names)):
+            super().add_shard(shard_name)
+            self.weights[shard_name] = weight
+            self.seeds[shard_name] = fmix64(self.hash_fn(shard_name))
+        for name in old:
+            shard = self.shards[name]
+            if not shard.kvstore:
+                continue
+            # a key moves only if a new shard outscores its current owner
+            keys = list(shard.kvstore.keys())
+            winners = self.scoreAgainst(keys, [name] + list(shard_names), shard.kvstore.hash_many(keys, self.hash_fn))
+            for winner, (group,) in group_by_owner(winners, keys).items():
+                if winner != 0:
+                    self.shards[shard_names[winner - 1]].take(shard.kvstore, group)
+
+    # Removes a shard and sends each of its keys to its next best shard
+    def remove_shard(self, shard_name):
+        self.remove_shards([shard_name])
+
+    # Removes shards and sends each of their keys to its best remaining shard
+    def remove_shards(self, shard_names):
+        kvstores = []
+        for shard_name in shard_names:
+            kvstores.append(super().remove_shard(shard_name))
+            del self.weights[shard_name]
+            del self.seeds[shard_name]
+        for kvstore in kvstores:
+            keys = list(kvstore.keys())
+            if not keys:
+                continue
+            owners = self.scoreAgainst(keys, self.shard_list, kvstore.hash_many(keys, self.hash_fn))
+            for owner, (group,) in group_by_owner(owners, keys).items():
+                self.shards[self.shard_list[owner]].take(kvstore, group)
+
+    # Puts a key in a certain shard, incrementing the access count
+    def put(self, k):
+        val = self.hash_fn(k)
+        shard = self.shards[self.shard_list[self.scoreAgainst([k], self.shard_list, [val])[0]]]
+        shard.put(k, 1, val)
+
+    # Puts a batch of keys, scoring every distinct key against all shards at once
+    def put_many(self, keys, hashes=None):
+        uniq, counts, vals = self.count_keys(keys, hashes)
+        owners = self.scoreAgainst(uniq, self.shard_list, vals)
+        for owner, (group, groupCounts, groupVals) in group_by_owner(owners, uniq, counts, vals).items():
+            self.shards[self.shard_list[owner]].put_many(group, groupCounts, groupVals)
+
+    # Gets the shard assigned to this key
+    def getShardNameForKey(self, key):
+        return self.shard_list[self.scoreAgainst([key], self.shard_list)[0]]
+
+    # Returns the shards of this epoch with their seeds and weights
+    def build_routing(self):
+        return RendezvousSnapshot(self.epoch, self.hash_fn, self.shard_list,
+                                  [self.seeds[name] for name in self.shard_list],
+                                  [self.weights[name] for name in self.shard_list])
+
+    # Gets, for each key, the position in shard_names of its highest scoring shard
+    def scoreAgainst(self, keys, shard_names, key_hashes=None):
+        if key_hashes is None:
+            key_hashes = self.hash_fn.many(keys)
+        return rendezvous_owners(key_hashes, [self.seeds[name] for name in shard_names],
+                                 [self.weights[name] for name in shard_names])
@@ -0,0 +1,169 @@
+from .load_balancer import LoadBalancer
+from ring import Ring
+from routing import RingSnapshot
+from utils import HashIndex, group_by_owner
+from migration import Move, MigrationPlan
+
+"""
+Ring Load Balancer
+Base for the load balancers that place shards on a ring over the key-space
+[0, 2^32]. A key belongs to the first shard token at or after its hash, so
+each token owns the arc between its predecessor and itself. Every shard keeps
+an index of its keys ordered by hash, which lets a membership change move only
+the keys in the arcs that change owner, and lets such a change be planned
+and carried out incrementally, arc by arc (see migration.py).
+"""
+class RingLoadBalancer(LoadBalancer):
+
+    def __init__(self, hash_fn=None):
+        super().__init__(hash_fn)
+        self.ring = Ring(self.hash_fn.bits) # Tokens of every shard
+        self.key_index = {} # Map from shard_name to the HashIndex of its keys
+
+    # Should be implemented in child classes: the ring tokens of a shard
+    def shard_tokens(self, shard_name):
+        raise NotImplementedError
+
+    # Adds a shard to the system and moves the keys in the arcs it takes over
+    def add_shard(self, shard_name):
+        self.add_shards([shard_name])
+
+    # Adds shards, placing the tokens of all of them before moving the keys of
+    # every arc they take over straight from the shard that held it; with a
+    # sweep_rate only the ring changes and the keys move lazily
+    def add_shards(self, shard_names):
+        if self.start_lazy_migration(self.plan_add_shards, shard_names):
+            return
+        for shard_name in shard_names:
+            super().add_shard(shard_name)
+            self.key_index[shard_name] = HashIndex()
+            self.ring.add(shard_name, self.shard_tokens(shard_name))
+        for shard_name in shard_names:
+            for lo, hi, old_owner in self.ring.arcs(shard_name, shard_names):
+                if old_owner is not None:
+                    self.take_arc(lo, hi, old_owner, shard_name)
+
+    # Remove a shard from the system and re-assigns the keys it held
+    def remove_shard(self, shard_name):
+        self.remove_shards([shard_name])
+
+    # Removes shards, taking the tokens of all of them off the ring before
+    # re-assigning the keys they held; with a sweep_rate the keys move lazily
+    def remove_shards(self, shard_names):
+        if self.start_lazy_migration(self.plan_remove_shards, shard_names):
+            return
+        removed = []
+        for shard_name in shard_names:
+            kvstore = super().remove_shard(shard_name)
+            self.ring.remove(shard_name)
+            removed.append((self.key_index.pop(shard_name), kvstore))
+        for index, kvstore in removed:
+            self.rekey(index.items(), kvstore)
+
+    # Returns the plan of adding shards: the arcs they take over, each from the
+    # shard holding it now, with the number of keys on it (not counting the
+    # keys migrations in flight have yet to move there)
+    def plan_add_shards(self, shard_names):
+        if any(shard_name in self.shards for shard_name in shard_names):
+            self.finish_migration() # a removed shard of the same name is still draining
+        ring = self.ring.snapshot()
+        for shard_name in shard_names:
+            ring.add(shard_name, self.shard_tokens(shard_name))
+        moves = []
+        for shard_name in shard_names:
+            for lo, hi, old_owner in ring.arcs(shard_name, shard_names):
+                if old_owner is not None:
+                    moves.append(Move(old_owner, shard_name, lo, hi, self.key_index[old_owner].count_arc(lo, hi)))
+        return MigrationPlan(self.epoch, shard_names, [], moves, ring)
+
+    # Returns the plan of removing shards: every arc they hold, each to the
+    # closest shard clockwise that stays
+    def plan_remove_shards(self, shard_names):
+        for shard_name in shard_names:
+            if shard_name not in self.ring.ids:
+                raise ValueError('shard {} is not on the ring'.format(shard_name))
+        moves = []
+        for shard_name in shard_names:
+            for lo, hi, new_owner in self.ring.arcs(shard_name, shard_names):
+                if new_owner is not None:
+                    moves.append(Move(shard_name, new_owner, lo, hi, self.key_index[shard_name].count_arc(lo, hi)))
+        ring = self.ring.snapshot()
+        for shard_name in shard_names:
+            ring.remove(shard_name)
+        return MigrationPlan(self.epoch, [], shard_names, moves, ring)
+
+    # Routes keys with the ring of the plan; removed shards keep their keys
+    # (and stay in shards) until the migration drains them
+    def apply_plan(self, plan):
+        for shard_name in plan.added:
+            super().add_shard(shard_name)
+            self.key_index[shard_name] = HashIndex()
+        if plan.removed:
+            self.epoch += 1
+        self.ring = plan.layout
+
+    # Forgets the finished migration and drops the shards it drained
+    def end_migration(self, migration):
+        self.migrations.remove(migration)
+        for shard_name in migration.plan.removed:
+            super().remove_shard(shard_name)
+            del self.key_index[shard_name]
+
+    # Puts a key in a certain shard, incrementing the access count
+    def put(self, k):
+        val = self.hash_fn(k)
+        if self.migrations:
+            self.claim([k], [val])
+        shard_name = self.ring.lookup(val)
+        if self.shards[shard_name].put(k, 1, val) == 1: # first time this shard sees k
+            self.key_index[shard_name].add(k, val)
+        if self.migrations:
+            self.migrations[0].pace(1)
+
+    # Puts a batch of keys: every distinct key is hashed once, all owners are
+    # resolved with a single ring search and each shard gets one grouped update
+    def put_many(self, keys, hashes=None):
+        uniq, counts, vals = self.count_keys(keys, hashes)
+        if self.migrations:
+            self.claim(uniq, vals)
+        owners = self.ring.lookup_many(vals)
+        # every group is handed out before the new keys of any are read, so
+        # shards in worker processes apply theirs in parallel
+        sent = [(self.ring.names[owner], group, groupVals, self.shards[self.ring.names[owner]].put_many(group, groupCounts, groupVals))
+                for owner, (group, groupCounts, groupVals) in group_by_owner(owners, uniq, counts, vals).items()]
+        for shard_name, group, groupVals, new in sent:
+            self.key_index[shard_name].add_many(map(group.__getitem__, new), map(groupVals.__getitem__, new))
+        if self.migrations:
+            self.migrations[0].pace(len(keys))
+
+    """ Rebalance Utils """
+
+    # Gets the shard assigned to this key, or the one it waits on to be migrated
+    def getShardNameForKey(self, key):
+        val = self.hash_fn(key)
+        return self.holder(key, val) or self.ring.lookup(val)
+
+    # Returns the ring of this epoch; the snapshot shares its arrays
+    def build_routing(self):
+        return RingSnapshot(self.epoch, self.hash_fn, self.ring.snapshot())
+
+    # Moves the keys with hash in the arc (lo, hi] from src to dst
+    def take_arc(self, lo, hi, src, dst):
+        moved = self.key_index[src].pop_arc(lo, hi)
+        if not moved:
+            return
+        keys, vals = zip(*moved)
+        self.shards[dst].take(self.shards[src].kvstore, keys)
+        self.key_index[dst].add_many(keys, vals)
+
+    # Re-Assigns the (key, hash) pairs of `items` out of the passed in kvstore
+    def rekey(self, items, kvstore):
+        if not items:
+            return
+        keys, vals = zip(*items)
+        owners = self.ring.lookup_many(vals)
+        for owner, (group, groupVals) in group_by_owner(owners, keys, vals).items():
+            targetShardName = self.ring.names[owner]
+            if self.shards[targetShardName].kvstore is not kvstore: # a migration can find keys back on their owner
+                self.shards[targetShardName].take(kvstore, group)
+            self.key_index[targetShardName].add_many(group, groupVals)
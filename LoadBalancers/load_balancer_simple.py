@@ -1,25 +1,36 @@
 from .load_balancer import LoadBalancer
-from utils import hash_fn
 
 """
 Simple Load Balancer
 Assigns keys in a consistent manner and rebalances based on some criteria.
 """
 class SimpleLoadBalancer(LoadBalancer):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, hash_fn=None):
+        super().__init__(hash_fn)
         # Feel free to add things here
 
     # Adds a shard to the system and rebalance as necessary
     def add_shard(self, shard_name):
-        super().add_shard(shard_name)
-        self.rebalance() # all keys need to be re-mapped 
+        self.add_shards([shard_name])
+
+    # Adds shards and re-maps all keys once for the whole batch
+    def add_shards(self, shard_names):
+        for shard_name in shard_names:
+            super().add_shard(shard_name)
+        self.rebalance() # all keys need to be re-mapped
 
     # Remove a shard to the system and rebalance as necessary
     def remove_shard(self, shard_name):
-        kvstore = super().remove_shard(shard_name)
+        self.remove_shards([shard_name])
+
+    # Removes shards and re-maps all keys once for the whole batch
+    def remove_shards(self, shard_names):
+        kvstores = []
+        for shard_name in shard_names:
+            kvstores.append((super().remove_shard(shard_name), shard_name))
         self.rebalance() # all keys need to be re-mapped
-        self.rekey(kvstore, shard_name) # re-assigns keys in removed shard
+        for kvstore, shard_name in kvstores:
+            self.rekey(kvstore, shard_name) # re-assigns keys in removed shards
    
     # Re-Assigns the keys in the passed in kvstore
     def rekey(self, kvstore, shard_name):
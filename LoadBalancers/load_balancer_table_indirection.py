@@ -1,103 +1,251 @@
 from .load_balancer import LoadBalancer
-from utils import hash_fn
+from routing import TableSnapshot
+from migration import BucketMove, BucketMigration, MigrationPlan
+from utils import np
 from collections import defaultdict
+import heapq
+
+# Heats are renormalized once the decay scale grows past this
+MAX_HEAT_SCALE = 2.0 ** 64
 
 """
 Table Indirection to deal with varying key popularity
+Heat decays exponentially with a half-life of `halfLife` puts (None keeps the
+cumulative put counts). Decay is applied lazily: each put adds the current
+scale 2^(t / halfLife) instead of 1, which keeps every heat comparison exact
+without touching all buckets on every put.
+Rebalancing runs as soon as a put pushes its server over minDeviationFactor
+times the average heat (only the server that received the put can newly cross
+it) and moves at most maxMovesPerRebalance buckets per put, picking up where
+it left off on the next put, instead of every updateInterval puts (None by
+default, set it to also rebalance on that fixed schedule). Membership changes
+always rebalance fully.
+Either way it stops once moving the hottest server's heaviest bucket to the
+idlest server would not lower the maximum heat, e.g. when that bucket alone
+is over the threshold, so such a bucket is never bounced between servers.
+Membership changes can be planned as BucketMigrations of the buckets that
+change owner, which rebalance afterwards as puts come in.
 """
 class TableIndirection(LoadBalancer):
-    
-    def __init__(self):
-        super().__init__()
+    migration_class = BucketMigration
+
+    def __init__(self, hash_fn=None, halfLife=None, maxMovesPerRebalance=8, updateInterval=None):
+        super().__init__(hash_fn)
         self.num_buckets = 100
         self.currAccess = 0
-        self.updateInterval = 5
+        self.updateInterval = updateInterval # if set, also rebalance every updateInterval puts
         self.minDeviationFactor = 4
+        self.maxMovesPerRebalance = maxMovesPerRebalance
+        self.pendingRebalance = False # whether the last capped rebalance stopped early
+        self.halfLife = halfLife
+        self.decayFactor = 2 ** (1 / halfLife) if halfLife else 1
+        self.heatScale = 1.0
         self.serverToBuckets = defaultdict(lambda: [])
         self.serverToHeat = defaultdict(lambda: 0)
         self.bucketToServer = [None] * self.num_buckets
         self.bucketToHeat = [0] * self.num_buckets
+        self.bucketToKeys = [set() for _ in range(self.num_buckets)] # keys stored for each bucket
+        self.totalHeat = 0
+        # Heat heaps with lazy deletion: an entry is only valid while it still
+        # matches the current heat (and owner), stale entries are skipped
+        self.maxServerHeap = [] # (-heat, server)
+        self.minServerHeap = [] # (heat, server)
+        self.serverBucketHeap = defaultdict(lambda: []) # server -> [(-heat, bucket)]
+        self.dirtyBuckets = set() # buckets whose heat changed since the heaps were updated
 
     def add_shard(self, shard_name):
-        # add new shard to overall system
-        super().add_shard(shard_name)
-        if len(self.shard_list) == 1:
-            # initial system -> give all buckets to the only shard
-            self.init_shard_metadata(shard_name)
-        else:
-            # take an arbitrary bucket from a server with multiple buckets
-            chosenBucket = self.find_arbitrary_bucket()
-            # give this new shard ownership of that bucket + rebalance as necessary (if possible)
-            self.moveBucket(chosenBucket, shard_name)
+        self.add_shards([shard_name])
+
+    def add_shards(self, shard_names):
+        if self.start_lazy_migration(self.plan_add_shards, shard_names):
+            return
+        shard_names = list(shard_names)
+        # add new shards to overall system
+        for shard_name in shard_names:
+            super().add_shard(shard_name)
+        if len(self.shard_list) == len(shard_names):
+            # initial system -> give all buckets to the first shard
+            self.init_shard_metadata(shard_names.pop(0))
+        # give each other new shard a bucket of a server with multiple buckets
+        moves = self.addedBucketOwners(shard_names)
+        for bucket, shard_name in moves:
+            self.moveBucket(bucket, shard_name)
+        # rebalance as necessary (if possible), once for the whole batch
+        if moves:
             self.rebalance()
 
     def remove_shard(self, shard_name):
-        # move all buckets to an arbitrary server
-        buckets = list(self.serverToBuckets[shard_name])
-        for bucket in buckets:
-            dest_shard = self.find_arbitrary_shard_noteq(shard_name)
+        self.remove_shards([shard_name])
+
+    def remove_shards(self, shard_names):
+        if self.start_lazy_migration(self.plan_remove_shards, shard_names):
+            return
+        for bucket, dest_shard in self.removedBucketOwners(shard_names):
             self.moveBucket(bucket, dest_shard)
-        # remove metadata about this shard
-        del self.serverToHeat[shard_name]
-        del self.serverToBuckets[shard_name]
-        # rebalance as necessary
-        self.rebalance() 
-        # remove shard from the system
-        super().remove_shard(shard_name)
+        for shard_name in shard_names:
+            self.forgetServer(shard_name)
+        # rebalance as necessary, once for the whole batch
+        self.rebalance()
+        # remove shards from the system
+        for shard_name in shard_names:
+            super().remove_shard(shard_name)
 
     def put(self, key):
-        # Get the bucket/server responsible for key
-        bucket = self.getBucket(key)
+        # Get the bucket/server responsible for key, moving key there first if a migration has yet to
+        val = self.hash_fn(key)
+        if self.migrations:
+            self.claim([key], [val])
+        bucket = val % self.num_buckets
         server = self.bucketToServer[bucket]
         # Incr the heat for the bucket + owner
-        self.bucketToHeat[bucket] += 1
-        self.serverToHeat[server] += 1
+        heat = self.heatIncrement()
+        self.bucketToHeat[bucket] += heat
+        self.serverToHeat[server] += heat
+        self.totalHeat += heat
+        self.dirtyBuckets.add(bucket)
         # Put the key on the appropriate shard kvstore
         shard = self.shards[server]
-        shard.put(key, 1)
+        if shard.put(key, 1, val) == 1: # first time we see key
+            self.bucketToKeys[bucket].add(key)
         # Rebalance as necessary
         self.currAccess += 1
-        if self.currAccess % self.updateInterval == 0:
-            self.rebalance()
+        if (self.pendingRebalance or self.isOverloaded(server)
+                or (self.updateInterval and self.currAccess % self.updateInterval == 0)):
+            self.rebalance(self.maxMovesPerRebalance)
+        if self.migrations:
+            self.migrations[0].pace(1)
+
+    ### MIGRATIONS
+
+    ## Returns the plan of adding shards: the bucket each takes from a server with multiple buckets,
+    ## None for the first shards, which take every bucket before there are keys
+    def plan_add_shards(self, shard_names):
+        if any(shard_name in self.shards for shard_name in shard_names):
+            self.finish_migration() # a removed shard of the same name is still draining
+        if not self.serverToHeat:
+            return None
+        return self.planMoves(shard_names, [], self.addedBucketOwners(shard_names))
+
+    ## Returns the plan of removing shards: each of their buckets, heaviest first, to the coolest
+    ## server that stays
+    def plan_remove_shards(self, shard_names):
+        for shard_name in shard_names:
+            if shard_name not in self.serverToHeat:
+                raise ValueError('shard {} owns no buckets'.format(shard_name))
+        return self.planMoves([], shard_names, self.removedBucketOwners(shard_names))
+
+    ## Returns the MigrationPlan of the (bucket, new owner) moves, each with the keys of the bucket
+    ## on its owner now (not counting the keys migrations in flight have yet to move there)
+    def planMoves(self, added, removed, owners):
+        table = list(self.bucketToServer)
+        moves = []
+        for bucket, dst in owners:
+            src = table[bucket]
+            keys = self.bucketToKeys[bucket]
+            if self.migrations:
+                kvstore = self.shards[src].kvstore
+                numKeys = sum(key in kvstore for key in keys)
+            else:
+                numKeys = len(keys)
+            moves.append(BucketMove(src, dst, bucket, numKeys))
+            table[bucket] = dst
+        return MigrationPlan(self.epoch, added, removed, moves, table)
+
+    ## Routes the buckets to the owners of the plan; removed shards keep their keys (and stay in
+    ## shards) until the migration drains them. The heats moved with the buckets are rebalanced
+    ## over the next puts
+    def apply_plan(self, plan):
+        for shard_name in plan.added:
+            super().add_shard(shard_name)
+        self.epoch += 1
+        for move in plan.moves:
+            self.assignBucket(move.bucket, move.dst)
+        for shard_name in plan.removed:
+            self.forgetServer(shard_name)
+        self.pendingRebalance = True
+
+    ## Forgets the finished migration and drops the shards it drained
+    def end_migration(self, migration):
+        self.migrations.remove(migration)
+        for shard_name in migration.plan.removed:
+            super().remove_shard(shard_name)
+
+    ## Returns the bucket of each hash in `vals` (a NumPy array if NumPy is installed)
+    def bucket_of(self, vals):
+        if np is not None:
+            return vals % self.num_buckets
+        return [val % self.num_buckets for val in vals]
+
+    ## Returns the keys stored for `bucket`
+    def bucket_keys(self, bucket):
+        return self.bucketToKeys[bucket]
+
+    ## Moves `keys` of `bucket` out of `kvstore` to the server owning the bucket now
+    def rekey_bucket(self, bucket, keys, kvstore):
+        shard = self.shards[self.bucketToServer[bucket]]
+        if shard.kvstore is not kvstore: # a migration can find keys back on their owner
+            shard.take(kvstore, keys)
 
     ### UTILS
 
+    ## Whether `server` is above minDeviationFactor times the average heat and rebalancing can lower it
+    def isOverloaded(self, server):
+        if self.serverToHeat[server] <= self.minDeviationFactor * self.totalHeat / len(self.serverToHeat):
+            return False
+        self.flushHeat()
+        return self.canShed(server)
+
+    ## Whether moving the heaviest bucket of `server` to the idle server lowers the heat of both below
+    ## that of `server` now (heaps must be flushed)
+    def canShed(self, server):
+        if len(self.serverToBuckets[server]) == 1: # make sure we can spare buckets from server
+            return False
+        bucket = self.maxHeatBucketForServer(server)
+        return self.serverToHeat[self.minHeatServer()] + self.bucketToHeat[bucket] < self.serverToHeat[server]
+
     ## Ensures that the maximum load on a given server is not more than twice the average (moving shards as necessary)
-    def rebalance(self):
-        # Local helper functions
-        ## Getting the overloaded/idle server
-        optHeatServer = lambda func: func(self.serverToHeat.keys(), key=(lambda k: self.serverToHeat[k]))
-        maxHeatServer, minHeatServer = lambda: optHeatServer(max), lambda: optHeatServer(min)
-        avgServerHeat = lambda: sum(self.serverToHeat.values()) / len(self.serverToHeat)
-        ## Getting the heaviest bucket for overloaded server
-        def maxHeatBucketForServer(server):
-            bucketsSortedByHeat = sorted(range(len(self.bucketToHeat)), key=(lambda i: self.bucketToHeat[i]), reverse=True)
-            bucketsSortedByHeatForServer = filter(lambda bucket: bucket in self.serverToBuckets[server], bucketsSortedByHeat)
-            return list(bucketsSortedByHeatForServer)[0]
+    ## Moves at most `maxMoves` buckets (None for no limit) and records if it had to stop early
+    def rebalance(self, maxMoves=None):
+        self.flushHeat()
+        self.pendingRebalance = False
+        moves = 0
+        avgServerHeat = lambda: self.totalHeat / len(self.serverToHeat)
         # Get the server with the most cumulative bucket heat (overloaded server)
-        maxHS = maxHeatServer()
+        maxHS = self.maxHeatServer()
         while self.serverToHeat[maxHS] > self.minDeviationFactor * avgServerHeat():
-            maxHS_buckets = self.serverToBuckets[maxHS]
-            if len(maxHS_buckets) == 1: # make sure we can spare buckets from maxHS
+            if not self.canShed(maxHS): # no move lowers the maximum
+                return
+            if maxMoves is not None and moves >= maxMoves:
+                self.pendingRebalance = True
                 return
+            moves += 1
             # Get the server with the least cumulative bucket heat (idle server)
-            minHS = minHeatServer()
+            minHS = self.minHeatServer()
             # Move the heaviest bucket from the overloaded server to idle server
-            chosenBucket = maxHeatBucketForServer(maxHS)
+            chosenBucket = self.maxHeatBucketForServer(maxHS)
             self.moveBucket(chosenBucket, minHS)
-            maxHS = maxHeatServer()
+            maxHS = self.maxHeatServer()
 
     ## Moves `bucket` from whoever owns it to `dst`
     def moveBucket(self, bucket, dst):
-        # 1. move all keys owned by the old owner that belong to bucket to dst
         oldDst = self.bucketToServer[bucket]
-        kvstore = self.shards[oldDst].kvstore
-        for key in list(kvstore.keys()):
-            currBucket = self.getBucket(key)
-            if bucket == currBucket:
-                targetShard = self.shards[dst]
-                targetShard.put(key, kvstore.pop(key))
-        # 2. update metadata reflecting new bucket ownership
+        self.epoch += 1
+        keys = list(self.bucketToKeys[bucket])
+        self.assignBucket(bucket, dst)
+        if self.migrations:
+            # keys of bucket still waiting on an older owner go straight to dst
+            for migration in list(self.migrations):
+                migration.claim_bucket(bucket)
+            kvstore = self.shards[oldDst].kvstore
+            keys = [key for key in keys if key in kvstore]
+            self.end_migrations()
+        # move all keys of bucket from the old owner to dst
+        self.shards[dst].take(self.shards[oldDst].kvstore, keys)
+
+    ## Records that `dst` owns `bucket` and its heat
+    def assignBucket(self, bucket, dst):
+        oldDst = self.bucketToServer[bucket]
+        # 1. update metadata reflecting new bucket ownership
         ## remove this bucket from old owner
         self.serverToHeat[oldDst] -= self.bucketToHeat[bucket]
         self.serverToBuckets[oldDst].remove(bucket)
@@ -105,27 +253,146 @@ class TableIndirection(LoadBalancer):
         self.serverToHeat[dst] += self.bucketToHeat[bucket]
         self.bucketToServer[bucket] = dst
         self.serverToBuckets[dst].append(bucket)
+        # 2. record the new heats in the heaps
+        self.pushServer(oldDst)
+        self.pushServer(dst)
+        self.pushBucket(bucket)
+
+    ## Removes the metadata of a server that owns no buckets anymore
+    def forgetServer(self, shard_name):
+        del self.serverToHeat[shard_name]
+        del self.serverToBuckets[shard_name]
+        self.serverBucketHeap.pop(shard_name, None)
 
     ## Initializes shard metadata when adding the first shard
     def init_shard_metadata(self, shard_name):
         self.bucketToServer = [shard_name] * self.num_buckets
         self.serverToHeat[shard_name] = sum(self.bucketToHeat)
         self.serverToBuckets[shard_name] = list(range(self.num_buckets))
+        self.pushServer(shard_name)
+        for bucket in range(self.num_buckets):
+            self.pushBucket(bucket)
 
-    ## Finds an arbitrary spare bucket (i.e. one in which the owner has other buckets)
-    def find_arbitrary_bucket(self):
-        for s in self.serverToBuckets:
-            buckets = self.serverToBuckets[s]
-            if len(buckets) > 1:
-                return buckets[0]
-        return None
+    ## Returns the (bucket, new shard) moves giving each new shard an arbitrary spare bucket (i.e. one
+    ## in which the owner has other buckets), as adding them one at a time does
+    def addedBucketOwners(self, shard_names):
+        serverToBuckets = {s: list(buckets) for s, buckets in self.serverToBuckets.items()}
+        moves = []
+        for shard_name in shard_names:
+            for s, buckets in serverToBuckets.items():
+                if len(buckets) > 1:
+                    moves.append((buckets.pop(0), shard_name))
+                    serverToBuckets[shard_name] = [moves[-1][0]]
+                    break
+        return moves
+
+    ## Returns the (bucket, new owner) moves handing the buckets of removed shards out heaviest
+    ## first, each to the coolest server that stays, so they move once and the batch rebalance
+    ## rarely has to move them again
+    def removedBucketOwners(self, shard_names):
+        removed = set(shard_names)
+        stays = [(heat, server) for server, heat in self.serverToHeat.items() if server not in removed]
+        heapq.heapify(stays)
+        buckets = [bucket for shard_name in shard_names for bucket in self.serverToBuckets[shard_name]]
+        moves = []
+        for bucket in sorted(buckets, key=self.bucketToHeat.__getitem__, reverse=True):
+            heat, dest_shard = heapq.heappop(stays)
+            moves.append((bucket, dest_shard))
+            heapq.heappush(stays, (heat + self.bucketToHeat[bucket], dest_shard))
+        return moves
     
-    ## Returns first shard in shard_list not equal to `shard_name`
-    def find_arbitrary_shard_noteq(self, shard_name):
-        for s in self.shard_list:
-            if s != shard_name:
-                return s
-        
     ## Returns the bucket for a given `key`
     def getBucket(self, key):
-        return hash_fn(key) % self.num_buckets
+        return self.hash_fn(key) % self.num_buckets
+
+    ## Returns the server owning the bucket of `key`, or the one it waits on to be migrated from
+    def getShardNameForKey(self, key):
+        val = self.hash_fn(key)
+        return self.holder(key, val) or self.bucketToServer[val % self.num_buckets]
+
+    ## Returns the bucket table of this epoch
+    def build_routing(self):
+        servers = list(self.serverToBuckets)
+        ids = {server: i for i, server in enumerate(servers)}
+        return TableSnapshot(self.epoch, self.hash_fn, servers, [ids[server] for server in self.bucketToServer])
+
+    ### HEAT DECAY
+
+    ## Returns the heat one put adds now, renormalizing all heats when the scale gets large
+    def heatIncrement(self):
+        if not self.halfLife:
+            return 1
+        self.heatScale *= self.decayFactor
+        if self.heatScale > MAX_HEAT_SCALE:
+            self.renormalizeHeat()
+        return self.heatScale
+
+    ## Divides every heat by the current scale so the scale can restart at 1
+    def renormalizeHeat(self):
+        scale = self.heatScale
+        self.heatScale = 1.0
+        self.bucketToHeat = [heat / scale for heat in self.bucketToHeat]
+        for server, buckets in self.serverToBuckets.items():
+            self.serverToHeat[server] = sum(self.bucketToHeat[b] for b in buckets)
+        self.totalHeat = sum(self.bucketToHeat)
+        # every heap entry is stale now, rebuild them
+        self.maxServerHeap, self.minServerHeap = [], []
+        self.serverBucketHeap.clear()
+        self.dirtyBuckets.clear()
+        for server in self.serverToHeat:
+            self.pushServer(server)
+        for bucket in range(self.num_buckets):
+            if self.bucketToServer[bucket] is not None:
+                self.pushBucket(bucket)
+
+    ### HEAT HEAPS
+
+    ## Records the current heat of `server` in the server heaps
+    def pushServer(self, server):
+        heat = self.serverToHeat[server]
+        heapq.heappush(self.maxServerHeap, (-heat, server))
+        heapq.heappush(self.minServerHeap, (heat, server))
+        if len(self.maxServerHeap) > 4 * len(self.serverToHeat) + 64:
+            self.maxServerHeap = [(-h, s) for s, h in self.serverToHeat.items()]
+            self.minServerHeap = [(h, s) for s, h in self.serverToHeat.items()]
+            heapq.heapify(self.maxServerHeap)
+            heapq.heapify(self.minServerHeap)
+
+    ## Records the current heat of `bucket` in its owner's bucket heap
+    def pushBucket(self, bucket):
+        server = self.bucketToServer[bucket]
+        heap = self.serverBucketHeap[server]
+        heapq.heappush(heap, (-self.bucketToHeat[bucket], bucket))
+        if len(heap) > 4 * len(self.serverToBuckets[server]) + 64:
+            heap[:] = [(-self.bucketToHeat[b], b) for b in self.serverToBuckets[server]]
+            heapq.heapify(heap)
+
+    ## Pushes the heats changed by puts since the last flush
+    def flushHeat(self):
+        servers = set()
+        for bucket in self.dirtyBuckets:
+            self.pushBucket(bucket)
+            servers.add(self.bucketToServer[bucket])
+        self.dirtyBuckets.clear()
+        for server in servers:
+            self.pushServer(server)
+
+    ## Getting the overloaded/idle server
+    def maxHeatServer(self):
+        heap = self.maxServerHeap
+        while -heap[0][0] != self.serverToHeat.get(heap[0][1]):
+            heapq.heappop(heap)
+        return heap[0][1]
+
+    def minHeatServer(self):
+        heap = self.minServerHeap
+        while heap[0][0] != self.serverToHeat.get(heap[0][1]):
+            heapq.heappop(heap)
+        return heap[0][1]
+
+    ## Getting the heaviest bucket for overloaded server
+    def maxHeatBucketForServer(self, server):
+        heap = self.serverBucketHeap[server]
+        while self.bucketToServer[heap[0][1]] != server or -heap[0][0] != self.bucketToHeat[heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0][1]
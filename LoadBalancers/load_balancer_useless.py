@@ -1,5 +1,5 @@
 from .load_balancer import LoadBalancer
-from utils import hash_fn
+from routing import TableSnapshot
 
 """
 Useless Load Balancer
@@ -7,19 +7,39 @@ Doesn't rebalance shards, it puts everything in the first shard
 """
 class UselessLoadBalancer(LoadBalancer):
     # Initialize data structures
-    def __init__(self):
-        super().__init__()
+    def __init__(self, hash_fn=None):
+        super().__init__(hash_fn)
 
     # Adds a shard to the system and rebalances the system
     def add_shard(self, shard_name):
         super().add_shard(shard_name)
 
+    # Adds shards to the system
+    def add_shards(self, shard_names):
+        for shard_name in shard_names:
+            super().add_shard(shard_name)
+
     # Removes a shard from the system and rebalances the system
     def remove_shard(self, shard_name):
-        kvstore = super().remove_shard(shard_name)
+        self.remove_shards([shard_name])
+
+    # Removes shards and puts all of their keys in the first remaining shard
+    def remove_shards(self, shard_names):
+        kvstores = []
+        for shard_name in shard_names:
+            kvstores.append(super().remove_shard(shard_name))
         shard = self.shard_list[0]
-        for key in kvstore:
-            self.shards[shard].put(key, kvstore[key])
+        for kvstore in kvstores:
+            for key in kvstore:
+                self.shards[shard].put(key, kvstore[key])
+
+    # Gets the shard storing this key
+    def getShardNameForKey(self, key):
+        return self.shard_list[0]
+
+    # Returns a table sending every key to the first shard
+    def build_routing(self):
+        return TableSnapshot(self.epoch, self.hash_fn, self.shard_list[:1], [0])
 
     # Store the given key in a shard
     def put(self, k):
@@ -0,0 +1,284 @@
+from state_monitor import CompactStateMonitor
+from errors import Error
+from shard import CompactShard
+from remote_shard import RemoteShard
+from LoadBalancers.load_balancer import LoadBalancer
+import LoadBalancers
+from workloads.generate_synthetic_workload import uniform_keys, zipf_keys
+import argparse
+import importlib
+import inspect
+import json
+import pkgutil
+import platform
+import random
+import time
+import tracemalloc
+from argparse import Namespace
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PUT_BATCH_SIZE = 8192 # Same batches as test_framework.run_test
+
+# Metrics compared against a baseline, and whether higher values are better
+METRICS = {
+    'puts_per_sec': True,
+    'add_p50_ms': False,
+    'add_p99_ms': False,
+    'remove_p50_ms': False,
+    'remove_p99_ms': False,
+    'drain_ms': False,
+    'peak_memory_bytes': False,
+    'keys_moved': False,
+    'variance': False,
+}
+CONFIG = ['balancer', 'keys', 'shards', 'vnodes', 'skew'] # Fields identifying a result
+
+# Returns every concrete LoadBalancer subclass in LoadBalancers, by class name
+def find_balancers():
+    balancers = {}
+    for module in pkgutil.iter_modules(LoadBalancers.__path__):
+        for name, cls in inspect.getmembers(importlib.import_module('LoadBalancers.' + module.name), inspect.isclass):
+            if issubclass(cls, LoadBalancer) and cls is not LoadBalancer and cls.__module__ == 'LoadBalancers.' + module.name:
+                balancers[name] = cls
+    return balancers
+
+# Returns whether the balancer takes a number of virtual nodes per shard
+def takes_vnodes(cls):
+    return 'num_rounds' in inspect.signature(cls.__init__).parameters
+
+# Returns whether the balancer takes a half-life for the heat it keeps
+def takes_half_life(cls):
+    return 'halfLife' in inspect.signature(cls.__init__).parameters
+
+# Returns the pct percentile of values, by nearest rank
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(-(-len(ordered) * pct // 100)) - 1))]
+
+# Returns num_puts keys over num_keys distinct keys, zipf distributed with exponent skew (uniform for 0)
+def make_keys(num_keys, num_puts, skew, seed):
+    rng = random.Random(seed)
+    stream = zipf_keys if skew else uniform_keys
+    return ['key{}'.format(i) for i in stream(rng, num_keys, num_puts, Namespace(zipf_s=skew))]
+
+# Returns the shards changes of the benchmark: (shard to add, shard to remove) pairs
+def make_changes(num_shards, num_changes, seed):
+    rng = random.Random(seed)
+    live = ['server{}'.format(n) for n in range(num_shards)]
+    changes = []
+    for n in range(num_changes):
+        added = 'server{}'.format(num_shards + n)
+        live.append(added)
+        changes.append((added, live.pop(rng.randrange(len(live)))))
+    return changes
+
+# Builds the balancer with its initial shards, passing half_life to the ones that take it
+def setup(cls, vnodes, num_shards, half_life=None):
+    kwargs = {'num_rounds': vnodes} if vnodes is not None else {}
+    if half_life is not None and takes_half_life(cls):
+        kwargs['halfLife'] = half_life
+    lb = cls(**kwargs)
+    for n in range(num_shards):
+        lb.add_shard('server{}'.format(n))
+    return lb
+
+# Puts keys in batches, telling the monitor if there is one
+def put_all(lb, keys, sm=None):
+    for start in range(0, len(keys), PUT_BATCH_SIZE):
+        batch = keys[start:start + PUT_BATCH_SIZE]
+        lb.put_many(batch)
+        if sm is not None:
+            sm.put_many(batch)
+
+# Adds and removes shards as listed in changes
+def apply_changes(lb, changes):
+    for added, removed in changes:
+        lb.add_shard(added)
+        lb.remove_shard(removed)
+    lb.finish_migration()
+
+# Returns the peak memory in bytes traced while the balancer puts keys and goes
+# through changes. Tracing every allocation makes this much slower than the timed
+# run for balancers that allocate many objects, like the Maglev table rebuilds
+def peak_memory(cls, vnodes, num_shards, keys, changes, half_life=None):
+    tracemalloc.start()
+    try:
+        lb = setup(cls, vnodes, num_shards, half_life)
+        put_all(lb, keys)
+        apply_changes(lb, changes)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Runs one configuration and returns its result, None if the balancer is not implemented
+def run(cls, num_keys, num_shards, vnodes, skew, args):
+    result = {'balancer': cls.__name__, 'keys': num_keys, 'shards': num_shards, 'vnodes': vnodes, 'skew': skew}
+    keys = make_keys(num_keys, num_keys * args.puts_per_key, skew, args.seed)
+    changes = make_changes(num_shards, args.changes, args.seed)
+    try:
+        # Timed runs, the first one validated between membership changes
+        puts_per_sec = 0
+        adds = []
+        removes = []
+        drains = []
+        for attempt in range(args.repeat):
+            lb = setup(cls, vnodes, num_shards, args.half_life)
+            sm = CompactStateMonitor() if attempt == 0 else None
+            start = time.perf_counter()
+            put_all(lb, keys)
+            puts_per_sec = max(puts_per_sec, len(keys) / (time.perf_counter() - start))
+            if sm is not None:
+                sm.put_many(keys)
+                sm.check_valid(lb.shards)
+            for added, removed in changes:
+                start = time.perf_counter()
+                lb.add_shard(added)
+                adds.append(time.perf_counter() - start)
+                if sm is not None:
+                    sm.check_valid(lb.shards)
+                start = time.perf_counter()
+                lb.remove_shard(removed)
+                removes.append(time.perf_counter() - start)
+                if sm is not None:
+                    sm.check_valid(lb.shards)
+            # keys lazy load balancers have yet to move
+            start = time.perf_counter()
+            lb.finish_migration()
+            drains.append(time.perf_counter() - start)
+            if sm is not None:
+                sm.check_valid(lb.shards)
+                result['keys_moved'] = sm.count_moves()[1]
+        result['puts_per_sec'] = puts_per_sec
+        if changes:
+            result['add_p50_ms'] = percentile(adds, 50) * 1000
+            result['add_p99_ms'] = percentile(adds, 99) * 1000
+            result['remove_p50_ms'] = percentile(removes, 50) * 1000
+            result['remove_p99_ms'] = percentile(removes, 99) * 1000
+        if LoadBalancer.sweep_rate is not None:
+            result['drain_ms'] = percentile(drains, 50) * 1000
+
+        loads = [len(shard.kvstore) for shard in lb.shards.values()]
+        mean = sum(loads) / len(loads)
+        result['variance'] = sum((load - mean) ** 2 for load in loads) / len(loads)
+        result['load_ratio'] = max(loads) / mean if mean else 0
+        del lb, sm
+
+        # Untimed run of the balancer alone for its peak memory
+        if args.memory:
+            result['peak_memory_bytes'] = peak_memory(cls, vnodes, num_shards, keys, changes, args.half_life)
+    except NotImplementedError:
+        return None
+    except Error as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, str(e).splitlines()[0][:200])
+    return result
+
+# Yields every configuration of the matrix as (cls, keys, shards, vnodes, skew)
+def matrix(balancers, args):
+    for name, cls in balancers.items():
+        for num_keys in args.keys:
+            for num_shards in args.shards:
+                for vnodes in args.vnodes if takes_vnodes(cls) else [None]:
+                    for skew in args.skew:
+                        yield cls, num_keys, num_shards, vnodes, skew
+
+# Returns the metrics of results that got worse than in baseline by more than
+# threshold, ignoring latencies that grew by less than noise_ms
+def compare(results, baseline, threshold, noise_ms=0):
+    previous = {tuple(r[field] for field in CONFIG): r for r in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        old = previous.get(tuple(result[field] for field in CONFIG))
+        if old is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in result or not old.get(metric):
+                continue
+            if metric.endswith('_ms') and result[metric] - old[metric] < noise_ms:
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((result, metric, old[metric], result[metric], change))
+    return regressions
+
+# Parses a comma separated list of values of type kind
+def values(kind):
+    return lambda text: [kind(value) for value in text.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks load balancers over a matrix of configurations')
+    parser.add_argument('-b', metavar='balancers', type=values(str),
+                        help='comma separated class names, defaults to every LoadBalancer subclass')
+    parser.add_argument('--keys', type=values(int), help='comma separated key counts', default=[10000, 100000])
+    parser.add_argument('--shards', type=values(int), help='comma separated shard counts', default=[10, 100])
+    parser.add_argument('--vnodes', type=values(int), help='comma separated virtual nodes per shard, for balancers that have them', default=[5, 50])
+    parser.add_argument('--skew', type=values(float), help='comma separated zipf exponents, 0 for uniform keys', default=[0, 1.1])
+    parser.add_argument('--puts-per-key', type=int, help='puts per distinct key', default=4)
+    parser.add_argument('--changes', type=int, help='shards added and removed after the puts', default=20)
+    parser.add_argument('--repeat', type=int, help='timed runs per configuration, keeping the best put rate and pooling latencies', default=3)
+    parser.add_argument('--seed', type=int, help='random seed', default=0)
+    parser.add_argument('--compact-shards', help='stores keys in array-backed CompactShards, about half the memory of the default Shards but several times slower', action='store_true')
+    parser.add_argument('--shard-workers', metavar='N', type=int, help='keeps the shards in N worker processes (RemoteShards)')
+    parser.add_argument('--lazy', metavar='R', type=float,
+                        help='adds and removes only change the routing where the load balancer can plan it, sweeping R keys per key put; drain_ms times moving the keys left')
+    parser.add_argument('--half-life', metavar='N', type=int,
+                        help='halves the heat TableIndirection keeps per bucket every N puts, instead of counting every put ever made')
+    parser.add_argument('--no-memory', dest='memory', help='skips the extra traced run measuring peak memory', action='store_false')
+    parser.add_argument('-o', metavar='output', type=str, help='file to write the results to as JSON', default='benchmark.json')
+    parser.add_argument('--compare', metavar='baseline', type=str, help='JSON results to flag regressions against')
+    parser.add_argument('--threshold', type=float, help='relative change counted as a regression', default=0.1)
+    parser.add_argument('--noise-ms', type=float, help='smallest latency increase counted as a regression', default=1.0)
+    args = parser.parse_args()
+
+    if args.compact_shards and args.shard_workers:
+        parser.error('--compact-shards and --shard-workers pick different shard classes, pass only one')
+    if args.compact_shards:
+        LoadBalancer.shard_class = CompactShard
+    if args.shard_workers:
+        LoadBalancer.shard_class = RemoteShard
+        LoadBalancer.num_workers = args.shard_workers
+    LoadBalancer.sweep_rate = args.lazy
+
+    balancers = find_balancers()
+    if args.b:
+        unknown = set(args.b) - set(balancers)
+        if unknown:
+            print('Unknown load balancers {}, expected some of {}'.format(sorted(unknown), sorted(balancers)))
+            exit(1)
+        balancers = {name: balancers[name] for name in args.b}
+
+    results = {
+        'python': platform.python_version(),
+        'numpy': np.__version__ if np is not None else None,
+        'platform': platform.platform(),
+        'shard_class': LoadBalancer.shard_class.__name__,
+        'shard_workers': args.shard_workers,
+        'lazy': args.lazy,
+        'half_life': args.half_life,
+        'results': [],
+    }
+    for config in matrix(balancers, args):
+        result = run(*config, args)
+        if result is None:
+            print('skipping {}: not implemented'.format(config[0].__name__))
+            continue
+        results['results'].append(result)
+        print(json.dumps(result))
+
+    with open(args.o, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('wrote {} results to {}'.format(len(results['results']), args.o))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.noise_ms)
+        for result, metric, old, new, change in regressions:
+            print('REGRESSION {}: {} went from {:.6g} to {:.6g} ({:+.1%})'.format(
+                ', '.join('{}={}'.format(field, result[field]) for field in CONFIG), metric, old, new, change))
+        print('{} regressions against {}'.format(len(regressions), args.compare))
+        if regressions:
+            exit(1)
@@ -15,3 +15,8 @@ class KeyLostInTransitionError(Error):
 class ValueLostInTransitionError(Error):
     def __init__(self, message):
         self.message = message
+
+"""Error occurs when a key is not on the shard it routes to"""
+class KeyMisplacedError(Error):
+    def __init__(self, message):
+        self.message = message
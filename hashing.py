@@ -0,0 +1,188 @@
+import struct
+import zlib
+
+# NumPy is optional: without it the batch path falls back to the scalar one
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MASK32 = 0xffffffff
+MASK64 = 0xffffffffffffffff
+
+# Keys are hashed as their utf-8 bytes so every process agrees on the value
+def to_bytes(key):
+    if isinstance(key, bytes):
+        return key
+    return str(key).encode('utf-8')
+
+""" Scalar hash functions """
+
+FNV32_OFFSET, FNV32_PRIME = 0x811c9dc5, 0x01000193
+FNV64_OFFSET, FNV64_PRIME = 0xcbf29ce484222325, 0x100000001b3
+
+def fnv1a_32(key):
+    h = FNV32_OFFSET
+    for byte in to_bytes(key):
+        h = ((h ^ byte) * FNV32_PRIME) & MASK32
+    return h
+
+def fnv1a_64(key):
+    h = FNV64_OFFSET
+    for byte in to_bytes(key):
+        h = ((h ^ byte) * FNV64_PRIME) & MASK64
+    return h
+
+MURMUR_C1, MURMUR_C2 = 0xcc9e2d51, 0x1b873593
+
+# MurmurHash3 x86_32
+def murmur3_32(key, seed=0):
+    data = to_bytes(key)
+    length = len(data)
+    body = length & ~3
+    h = seed
+    for (k,) in struct.iter_unpack('<I', data[:body]):
+        k = (k * MURMUR_C1) & MASK32
+        k = ((k << 15) | (k >> 17)) & MASK32
+        k = (k * MURMUR_C2) & MASK32
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & MASK32
+        h = (h * 5 + 0xe6546b64) & MASK32
+    if body < length:
+        k = int.from_bytes(data[body:], 'little')
+        k = (k * MURMUR_C1) & MASK32
+        k = ((k << 15) | (k >> 17)) & MASK32
+        k = (k * MURMUR_C2) & MASK32
+        h ^= k
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & MASK32
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & MASK32
+    h ^= h >> 16
+    return h
+
+def crc32(key):
+    return zlib.crc32(to_bytes(key))
+
+# Python's salted hash, only reproducible across processes with PYTHONHASHSEED
+def builtin_32(key):
+    return hash(key) & MASK32
+
+""" Batch (NumPy) hash functions """
+
+# Packs keys into an (n, width) uint8 matrix, zero padded, where width is a
+# multiple of `align`; returns it with the byte length of every key
+def byte_matrix(keys, align=1):
+    chars = np.array(keys)
+    if chars.dtype.kind == 'U':
+        codes = chars.view(np.uint32).reshape(len(keys), -1)
+        if codes.size == 0 or codes.max() < 0x80:
+            # ascii keys: one byte per character, no per-key encoding needed
+            lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+            width = max(align, -(-codes.shape[1] // align) * align)
+            matrix = np.zeros((len(keys), width), dtype=np.uint8)
+            matrix[:, :codes.shape[1]] = codes
+            return matrix, lengths
+    data = [to_bytes(key) for key in keys]
+    lengths = np.fromiter(map(len, data), dtype=np.int64, count=len(data))
+    longest = int(lengths.max()) if len(data) else 0
+    width = max(align, -(-longest // align) * align)
+    matrix = np.zeros((len(data), width), dtype=np.uint8)
+    if longest:
+        packed = np.array(data, dtype='S{}'.format(longest))
+        matrix[:, :longest] = packed.view(np.uint8).reshape(len(data), longest)
+    return matrix, lengths
+
+def fnv1a_many(keys, offset, prime, dtype):
+    matrix, lengths = byte_matrix(keys)
+    h = np.full(len(lengths), offset, dtype=dtype)
+    prime = dtype(prime)
+    for col in range(matrix.shape[1]):
+        mixed = (h ^ matrix[:, col].astype(dtype)) * prime
+        h = np.where(lengths > col, mixed, h)
+    return h
+
+def fnv1a_32_many(keys):
+    return fnv1a_many(keys, FNV32_OFFSET, FNV32_PRIME, np.uint32)
+
+def fnv1a_64_many(keys):
+    return fnv1a_many(keys, FNV64_OFFSET, FNV64_PRIME, np.uint64)
+
+def rotl32(x, r):
+    return (x << np.uint32(r)) | (x >> np.uint32(32 - r))
+
+def murmur3_mix_k(k):
+    k = k * np.uint32(MURMUR_C1)
+    k = rotl32(k, 15)
+    return k * np.uint32(MURMUR_C2)
+
+def murmur3_32_many(keys, seed=0):
+    matrix, lengths = byte_matrix(keys, align=4)
+    blocks = matrix.view('<u4').astype(np.uint32)
+    nblocks = lengths // 4
+    h = np.full(len(lengths), seed, dtype=np.uint32)
+    for col in range(blocks.shape[1]):
+        mixed = h ^ murmur3_mix_k(blocks[:, col])
+        mixed = rotl32(mixed, 13) * np.uint32(5) + np.uint32(0xe6546b64)
+        h = np.where(nblocks > col, mixed, h)
+    # the tail block is zero padded past the key, matching the scalar path
+    rows = np.arange(len(lengths))
+    tail = blocks[rows, np.minimum(nblocks, blocks.shape[1] - 1)]
+    h = np.where(lengths & 3 > 0, h ^ murmur3_mix_k(tail), h)
+    h ^= lengths.astype(np.uint32)
+    h ^= h >> np.uint32(16)
+    h *= np.uint32(0x85ebca6b)
+    h ^= h >> np.uint32(13)
+    h *= np.uint32(0xc2b2ae35)
+    h ^= h >> np.uint32(16)
+    return h
+
+"""
+A named hash function with a scalar path, `hash_fn(key)`, and a batch path,
+`hash_fn.many(keys)`, that returns a NumPy array when NumPy is available
+(a list otherwise).
+"""
+class HashFunction:
+    def __init__(self, name, bits, scalar, batch=None):
+        self.name = name     # Name the function is registered under
+        self.bits = bits     # Every hash is in range(0, 2 ** bits)
+        self.scalar = scalar # key -> int
+        self.batch = batch   # sequence of keys -> NumPy array, if vectorized
+
+    def __call__(self, key):
+        return self.scalar(key)
+
+    def many(self, keys):
+        if np is None:
+            return [self.scalar(key) for key in keys]
+        if self.batch is not None and len(keys):
+            return self.batch(keys)
+        dtype = np.uint32 if self.bits <= 32 else np.uint64
+        return np.fromiter((self.scalar(key) for key in keys), dtype=dtype, count=len(keys))
+
+    def __repr__(self):
+        return 'HashFunction({!r})'.format(self.name)
+
+HASH_FUNCTIONS = {
+    'murmur3': HashFunction('murmur3', 32, murmur3_32, murmur3_32_many),
+    'fnv1a': HashFunction('fnv1a', 32, fnv1a_32, fnv1a_32_many),
+    'fnv1a64': HashFunction('fnv1a64', 64, fnv1a_64, fnv1a_64_many),
+    'crc32': HashFunction('crc32', 32, crc32),
+    'builtin': HashFunction('builtin', 32, builtin_32),
+}
+
+DEFAULT_HASH = 'murmur3'
+
+# Resolves a hash function by name; None picks the default and plain
+# callables are wrapped as 32-bit functions without a batch path
+def get_hash_fn(hash_fn=None):
+    if hash_fn is None:
+        hash_fn = DEFAULT_HASH
+    if isinstance(hash_fn, HashFunction):
+        return hash_fn
+    if isinstance(hash_fn, str):
+        if hash_fn not in HASH_FUNCTIONS:
+            raise ValueError('unknown hash function {!r}, expected one of {}'.format(hash_fn, sorted(HASH_FUNCTIONS)))
+        return HASH_FUNCTIONS[hash_fn]
+    return HashFunction(getattr(hash_fn, '__name__', 'custom'), 32, hash_fn)
@@ -0,0 +1,112 @@
+from benchmark import make_keys, percentile
+import argparse
+import asyncio
+import random
+import time
+from collections import deque
+
+"""
+Load generator for server.py. Every connection keeps up to `window`
+pipelined requests in flight, puts and gets of keys drawn from a uniform or
+zipf distribution, and times each request from the moment it is written to
+the moment its reply is read. With --changes, another connection creates a
+shard and removes the one created before it at evenly spaced points of the
+run, and the latencies of the requests in flight during a change are
+reported apart.
+"""
+
+# Returns the request lines of one connection
+def make_requests(num_requests, num_keys, skew, get_ratio, seed):
+    rng = random.Random(seed)
+    return [('get ' if rng.random() < get_ratio else 'put ').encode() + key.encode() + b'\n'
+            for key in make_keys(num_keys, num_requests, skew, seed)]
+
+# Sends the requests over one connection and records (send time, latency, failed) for each
+async def drive(host, port, requests, window, samples, progress):
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = deque() # send times of the requests in flight
+    i = 0
+    try:
+        while i < len(requests) or sent:
+            while i < len(requests) and len(sent) < window:
+                writer.write(requests[i])
+                sent.append(time.perf_counter())
+                i += 1
+            await writer.drain()
+            reply = await reader.readline()
+            if not reply:
+                raise ConnectionError('server closed the connection')
+            start = sent.popleft()
+            samples.append((start, time.perf_counter() - start, reply.startswith(b'ERR')))
+            progress[0] += 1
+    finally:
+        writer.close()
+
+# Creates a shard, then removes the previous one, whenever progress passes
+# the next of num_changes evenly spaced points, recording (start, end) of each
+async def change_shards(host, port, total, num_changes, progress, changes):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for n in range(num_changes):
+            while progress[0] < total * (n + 1) // (num_changes + 1):
+                await asyncio.sleep(0.001)
+            start = time.perf_counter()
+            writer.write('create loadgen{}\n'.format(n).encode())
+            if n > 0:
+                writer.write('remove loadgen{}\n'.format(n - 1).encode())
+            await writer.drain()
+            for _ in range(2 if n > 0 else 1):
+                reply = await reader.readline()
+                if reply.startswith(b'ERR'):
+                    print('change {} failed: {}'.format(n, reply.decode().strip()))
+            changes.append((start, time.perf_counter()))
+    finally:
+        writer.close()
+
+# Returns the count, percentiles and maximum of latencies in milliseconds
+def summarize(latencies):
+    if not latencies:
+        return {'requests': 0}
+    return {'requests': len(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'p999_ms': percentile(latencies, 99.9) * 1000,
+            'max_ms': max(latencies) * 1000}
+
+# Formats a summary as name value pairs
+def format_summary(summary):
+    return ', '.join('{} {:.3f}'.format(name, value) if isinstance(value, float) else '{} {}'.format(name, value)
+                     for name, value in summary.items())
+
+async def run(args):
+    samples, changes, progress = [], [], [0]
+    tasks = [drive(args.host, args.port, make_requests(args.requests, args.keys, args.skew, args.get_ratio, args.seed + c),
+                   args.window, samples, progress)
+             for c in range(args.connections)]
+    if args.changes:
+        tasks.append(change_shards(args.host, args.port, args.requests * args.connections, args.changes, progress, changes))
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    print('{} requests in {:.2f}s: {:.0f} requests/s, {} errors'.format(
+        len(samples), elapsed, len(samples) / elapsed, sum(failed for _, _, failed in samples)))
+    print('all requests: {}'.format(format_summary(summarize([latency for _, latency, _ in samples]))))
+    if changes:
+        during = [latency for sent, latency, _ in samples
+                  if any(sent < end and sent + latency > begin for begin, end in changes)]
+        print('during {} shard changes: {}'.format(len(changes), format_summary(summarize(during))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='sends pipelined requests to server.py and reports throughput and latency')
+    parser.add_argument('--host', type=str, help='server address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='server port', default=7070)
+    parser.add_argument('--connections', type=int, help='concurrent connections', default=4)
+    parser.add_argument('--window', type=int, help='requests in flight per connection', default=32)
+    parser.add_argument('--requests', type=int, help='requests per connection', default=100000)
+    parser.add_argument('--keys', type=int, help='number of distinct keys', default=100000)
+    parser.add_argument('--skew', type=float, help='zipf exponent, 0 for uniform keys', default=1.1)
+    parser.add_argument('--get-ratio', type=float, help='fraction of the requests that are gets', default=0.1)
+    parser.add_argument('--changes', type=int, help='shard creates and removes spread over the run', default=0)
+    parser.add_argument('--seed', type=int, help='random seed', default=0)
+    asyncio.run(run(parser.parse_args()))
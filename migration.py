@@ -0,0 +1,256 @@
+from bisect import bisect_left
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Planned, incremental key migrations.
+A MigrationPlan lists the moves a membership change needs, each the keys of a
+ring arc (lo, hi] (a Move) or of a bucket of a table (a BucketMove) going from
+one shard to another with the number of keys it holds, so the cost of the
+change is known before anything is applied.
+A Migration carries out a plan once its routing change is applied: it moves
+the arcs a bounded number of keys at a time, a step after every put batch
+(keys_per_put keys per key put) or whenever step is called. Until a move is
+done its arc (or bucket) is owned by both shards: keys route to dst, the
+ones not moved yet are still on src, and a put or get of such a key finds it
+there and moves it first. Removed shards stay in `shards` until drained.
+Several migrations can be in flight: only the oldest is stepped, and every
+key a migration moves goes to the shard it routes to now, which a later
+change may have made another one than the dst of its move.
+"""
+
+# Returns whether hash val lies on the arc (lo, hi], which wraps when lo >= hi
+def on_arc(val, lo, hi):
+    if lo < hi:
+        return lo < val <= hi
+    return val > lo or val <= hi
+
+"""The keys with hash on the arc (lo, hi] moving from shard src to shard dst"""
+class Move:
+    def __init__(self, src, dst, lo, hi, keys):
+        self.src = src
+        self.dst = dst
+        self.lo = lo     # advances as the keys of the arc are moved in hash order
+        self.hi = hi
+        self.keys = keys # keys the arc held when planned
+
+    def __repr__(self):
+        return 'Move({} -> {}, ({}, {}], {} keys)'.format(self.src, self.dst, self.lo, self.hi, self.keys)
+
+"""The keys of a bucket (or slot) of a table moving from shard src to shard dst"""
+class BucketMove:
+    def __init__(self, src, dst, bucket, keys):
+        self.src = src
+        self.dst = dst
+        self.bucket = bucket
+        self.keys = keys # keys the bucket held when planned
+        self.left = None # keys of the bucket not looked at yet, listed by the first step
+
+    def __repr__(self):
+        return 'BucketMove({} -> {}, bucket {}, {} keys)'.format(self.src, self.dst, self.bucket, self.keys)
+
+"""The moves of a membership change planned at epoch, applied with start_migration"""
+class MigrationPlan:
+    def __init__(self, epoch, added, removed, moves, layout):
+        self.epoch = epoch           # epoch of the load balancer the plan was made at
+        self.added = list(added)     # shards the change adds
+        self.removed = list(removed) # shards the change removes
+        self.moves = moves           # list of Move or BucketMove
+        self.layout = layout         # ring, or table, of the load balancer after the change
+
+    # Returns the number of keys the plan moves
+    def num_keys(self):
+        return sum(move.keys for move in self.moves)
+
+    # Returns {(src, dst): keys} over the moves of the plan
+    def cost(self):
+        cost = defaultdict(int)
+        for move in self.moves:
+            cost[move.src, move.dst] += move.keys
+        return dict(cost)
+
+    def __repr__(self):
+        return 'MigrationPlan(epoch {}, +{} -{}, {} moves, {} keys)'.format(
+            self.epoch, self.added, self.removed, len(self.moves), self.num_keys())
+
+"""The execution of a MigrationPlan of Moves on the load balancer it was applied
+to, which is expected to have `key_index`, `shards` and a `rekey(items, kvstore)`
+moving (key, hash) pairs out of kvstore to the shards they route to"""
+class Migration:
+    def __init__(self, load_balancer, plan, keys_per_put=1.0):
+        self.load_balancer = load_balancer
+        self.plan = plan
+        self.keys_per_put = keys_per_put # keys moved per key put, 0 to move only on step
+        self.credit = 0.0                # keys the puts so far paid for but were not moved yet
+        self.moved = 0                   # keys moved so far
+        self.pending = [move for move in plan.moves if move.keys]
+        self.index_moves()
+
+    # Whether every move is done
+    def done(self):
+        return not self.pending
+
+    # Sorts the pending moves by the end of their arc; the arcs never overlap,
+    # so a hash can only be on the arc of the first move ending at or after it
+    def index_moves(self):
+        self.pending.sort(key=lambda move: move.hi)
+        self.his = [move.hi for move in self.pending]
+
+    # Returns, for every hash in vals, the pending move whose arc it is on, or None
+    def locate_many(self, vals):
+        if not self.pending:
+            return [None] * len(vals)
+        if np is not None:
+            vals = np.asarray(vals, dtype=np.uint64)
+            his = np.array(self.his, dtype=np.uint64)
+            i = np.searchsorted(his, vals, side='left') % len(his)
+            lo = np.array([move.lo for move in self.pending], dtype=np.uint64)[i]
+            hi = his[i]
+            on = np.where(lo < hi, (lo < vals) & (vals <= hi), (vals > lo) | (vals <= hi))
+            return [self.pending[j] if j >= 0 else None for j in np.where(on, i, -1).tolist()]
+        located = []
+        for val in vals:
+            move = self.pending[bisect_left(self.his, val) % len(self.his)]
+            located.append(move if on_arc(val, move.lo, move.hi) else None)
+        return located
+
+    # Returns the shard holding key (with hash val) if it is still waiting on
+    # the source of a move, otherwise None
+    def holder(self, key, val):
+        move = self.locate_many([val])[0]
+        if move is not None and key in self.load_balancer.shards[move.src].kvstore:
+            return move.src
+        return None
+
+    # Moves the keys (with hashes vals) that are still on the source of their
+    # move to its destination, before a put changes them there
+    def claim(self, keys, vals):
+        if not self.pending:
+            return
+        located = self.locate_many(vals)
+        if np is not None and isinstance(vals, np.ndarray):
+            vals = vals.tolist()
+        groups = defaultdict(list)
+        for key, val, move in zip(keys, vals, located):
+            if move is not None:
+                groups[move].append((key, val))
+        for move, pairs in groups.items():
+            kvstore = self.load_balancer.shards[move.src].kvstore
+            pairs = [(key, val) for key, val in pairs if key in kvstore]
+            if pairs:
+                self.moved += self.move_keys(move, pairs, kvstore)
+
+    # Moves the (key, hash) pairs of move, all found in kvstore, to the shards
+    # they route to and returns how many moved
+    def move_keys(self, move, pairs, kvstore):
+        lb = self.load_balancer
+        for key, val in pairs:
+            lb.key_index[move.src].discard(key, val)
+        lb.rekey(pairs, kvstore)
+        return len(pairs)
+
+    # Moves as many keys as num_keys puts paid for; only called on the oldest
+    # migration in flight
+    def pace(self, num_keys):
+        if not self.keys_per_put:
+            return
+        self.credit += num_keys * self.keys_per_put
+        if self.credit >= 1:
+            self.credit -= self.step(int(self.credit))
+
+    # Moves up to max_keys keys in hash order, the keys sharing a hash with the
+    # last one included, and returns how many were moved
+    def step(self, max_keys):
+        lb = self.load_balancer
+        moved = 0
+        while self.pending and moved < max_keys:
+            move = self.pending[0]
+            index = lb.key_index[move.src]
+            remaining = index.count_arc(move.lo, move.hi)
+            budget = max_keys - moved
+            if remaining > budget:
+                cut = index.arc_hash(move.lo, budget - 1)
+                if cut != move.hi:
+                    items = index.pop_arc(move.lo, cut)
+                    lb.rekey(items, lb.shards[move.src].kvstore)
+                    moved += len(items)
+                    move.lo = cut
+                    continue
+            items = index.pop_arc(move.lo, move.hi)
+            lb.rekey(items, lb.shards[move.src].kvstore)
+            moved += len(items)
+            self.pending.pop(0)
+            self.his.pop(0)
+        self.moved += moved
+        if not self.pending:
+            lb.end_migrations()
+        return moved
+
+"""The execution of a MigrationPlan of BucketMoves, on a load balancer that is
+expected to have `shards`, a `bucket_of(vals)` giving the bucket of hashes (or
+of a NumPy array of them), `bucket_keys(bucket)` giving the keys stored for a
+bucket and a `rekey_bucket(bucket, keys, kvstore)` moving keys of a bucket out
+of kvstore to the shard the bucket routes to"""
+class BucketMigration(Migration):
+
+    # Indexes the pending moves by bucket, which a plan moves at most once, and
+    # reverses them so steps pop the next one off the end
+    def index_moves(self):
+        self.by_bucket = {move.bucket: move for move in self.pending}
+        self.pending.reverse()
+
+    # Returns, for every hash in vals, the pending move of its bucket, or None
+    def locate_many(self, vals):
+        if not self.pending:
+            return [None] * len(vals)
+        buckets = self.load_balancer.bucket_of(np.asarray(vals, dtype=np.uint64) if np is not None else vals)
+        buckets = buckets.tolist() if np is not None else buckets
+        return list(map(self.by_bucket.get, buckets))
+
+    def move_keys(self, move, pairs, kvstore):
+        self.load_balancer.rekey_bucket(move.bucket, [key for key, _ in pairs], kvstore)
+        return len(pairs)
+
+    # Moves the keys of bucket still on the source of its move, before the
+    # bucket changes owner again
+    def claim_bucket(self, bucket):
+        move = self.by_bucket.pop(bucket, None)
+        if move is None:
+            return
+        self.pending.remove(move)
+        lb = self.load_balancer
+        kvstore = lb.shards[move.src].kvstore
+        keys = [key for key in (lb.bucket_keys(bucket) if move.left is None else move.left) if key in kvstore]
+        if keys:
+            lb.rekey_bucket(bucket, keys, kvstore)
+            self.moved += len(keys)
+
+    # Looks at up to max_keys keys of the pending buckets in order, moves the
+    # ones still on the source of their move and returns how many were moved
+    def step(self, max_keys):
+        lb = self.load_balancer
+        moved = looked = 0
+        while self.pending and looked < max_keys:
+            move = self.pending[-1]
+            if move.left is None:
+                move.left = list(lb.bucket_keys(move.bucket))
+            count = min(max_keys - looked, len(move.left))
+            batch = move.left[len(move.left) - count:]
+            del move.left[len(move.left) - count:]
+            looked += count
+            kvstore = lb.shards[move.src].kvstore
+            keys = [key for key in batch if key in kvstore] # claimed keys already left
+            if keys:
+                lb.rekey_bucket(move.bucket, keys, kvstore)
+                moved += len(keys)
+            if not move.left:
+                self.pending.pop()
+                del self.by_bucket[move.bucket]
+        self.moved += moved
+        if not self.pending:
+            lb.end_migrations()
+        return moved
@@ -0,0 +1,359 @@
+import multiprocessing
+import os
+import queue
+import threading
+import weakref
+from collections import deque
+from collections.abc import MutableMapping
+from shard import Shard
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Shards that live in worker processes. A WorkerPool starts the workers and
+spreads the shards of a load balancer over them; each worker keeps plain
+Shards and serves requests, (op, args) tuples, over a pipe, in order. The
+load balancer side holds RemoteShard proxies: put_many only sends its batch
+and returns a Pending reply, so one batch of puts is routed to every worker
+before waiting on any of them, and the workers apply their groups in
+parallel. Migrations between shards of the same worker happen inside it;
+between workers they are one bulk pop and one bulk put.
+A reader thread per worker receives the replies as soon as they are sent, so
+a worker never blocks on a full pipe while the parent is still sending.
+"""
+
+# Worker side
+
+"""Shards of one worker process, by shard id"""
+class ShardServer:
+    def __init__(self):
+        self.shards = {}
+
+    def create(self, i, server_name):
+        self.shards[i] = Shard(server_name)
+
+    def drop(self, ids):
+        for i in ids:
+            self.shards.pop(i, None)
+
+    def put(self, i, k, v, h):
+        return self.shards[i].put(k, v, h)
+
+    def put_many(self, i, keys, values, hashes):
+        return self.shards[i].put_many(keys, values, hashes)
+
+    def get(self, i, k):
+        return self.shards[i].get(k)
+
+    def remove(self, i, k):
+        return self.shards[i].remove(k)
+
+    def len(self, i):
+        return len(self.shards[i].kvstore)
+
+    def keys(self, i):
+        return list(self.shards[i].kvstore)
+
+    def items(self, i):
+        return list(self.shards[i].kvstore.items())
+
+    def contains(self, i, k):
+        return k in self.shards[i].kvstore
+
+    def getitem(self, i, k):
+        return self.shards[i].kvstore[k]
+
+    def setitem(self, i, k, v):
+        self.shards[i].kvstore[k] = v
+
+    def delitem(self, i, k):
+        del self.shards[i].kvstore[k]
+
+    def pop(self, i, k, *default):
+        return self.shards[i].kvstore.pop(k, *default)
+
+    def clear(self, i):
+        self.shards[i].kvstore.clear()
+
+    def pop_many(self, i, keys):
+        return self.shards[i].kvstore.pop_many(keys)
+
+    # Removes the keys and returns their counts and hashes, None if any hash is unknown
+    def pop_hashed(self, i, keys):
+        hashes = self.shards[i].kvstore.hashes_of(keys)
+        return self.shards[i].kvstore.pop_many(keys), None if None in hashes else hashes
+
+    def hashes_of(self, i, keys):
+        return self.shards[i].kvstore.hashes_of(keys)
+
+    def set_hashes(self, i, keys, hashes):
+        kvstore = self.shards[i].kvstore
+        kvstore.hashes.update((k, h) for k, h in zip(keys, hashes) if k in kvstore)
+
+    # Moves keys from shard src to shard i, both in this worker
+    def move(self, i, src, keys):
+        self.shards[i].take(self.shards[src].kvstore, keys)
+
+    # Returns the (key, count) of every key mutated since the last sync, with
+    # count None for the keys that are gone
+    def sync(self, i):
+        kvstore = self.shards[i].kvstore
+        return [(k, kvstore.get(k)) for k in self.shards[i].take_journal()]
+
+# Runs the requests received on conn until it is told to stop or closed
+def serve(conn):
+    server = ShardServer()
+    while True:
+        try:
+            op, args = conn.recv()
+        except EOFError:
+            return
+        if op == 'stop':
+            return
+        try:
+            reply = True, getattr(server, op)(*args)
+        except Exception as e:
+            reply = False, e
+        conn.send(reply)
+
+# Load balancer side
+
+"""Reply to a request sent to a worker, received in request order"""
+class Pending:
+    def __init__(self, worker, then=None):
+        self.worker = worker
+        self.then = then  # applied to the reply once it arrives
+        self.done = False
+        self.value = None
+
+    # Waits for the reply and returns it
+    def result(self):
+        while not self.done:
+            self.worker.receive()
+        return self.value
+
+    def __iter__(self):
+        return iter(self.result())
+
+    def __len__(self):
+        return len(self.result())
+
+"""A worker process and the pipe its requests go through"""
+class Worker:
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=serve, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.replies = queue.SimpleQueue() # replies read off the pipe, in request order
+        self.pending = deque()             # Pending replies not received yet, in request order
+        self.dropped = []                  # ids of the shards to drop with the next request
+        self.num_shards = 0
+        threading.Thread(target=self.read, daemon=True).start()
+
+    # Moves every reply off the pipe into replies
+    def read(self):
+        try:
+            while True:
+                self.replies.put(self.conn.recv())
+        except (EOFError, OSError):
+            self.replies.put((False, EOFError('shard worker exited')))
+
+    # Sends a request and returns its Pending reply, after taking in the
+    # replies that already arrived. Whatever request fails raises when its
+    # reply is received
+    def send(self, op, *args, then=None):
+        while self.pending and not self.replies.empty():
+            self.receive()
+        if self.dropped:
+            ids, self.dropped = self.dropped, []
+            self.send('drop', ids)
+        self.conn.send((op, args))
+        reply = Pending(self, then)
+        self.pending.append(reply)
+        return reply
+
+    # Sends a request and waits for its reply
+    def call(self, op, *args):
+        return self.send(op, *args).result()
+
+    # Waits for the oldest pending reply
+    def receive(self):
+        reply = self.pending.popleft()
+        ok, value = self.replies.get()
+        if not ok:
+            reply.done = True
+            raise value
+        reply.value = reply.then(value) if reply.then else value
+        reply.done = True
+
+    def close(self):
+        try:
+            self.conn.send(('stop', ()))
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+# Stops the workers
+def close_workers(workers):
+    for worker in workers:
+        worker.close()
+
+"""
+Worker processes the shards of a load balancer are spread over, num_workers
+of them (one per CPU for None). The workers stop once the pool is garbage
+collected or when the program exits.
+"""
+class WorkerPool:
+    def __init__(self, num_workers=None):
+        context = multiprocessing.get_context()
+        self.workers = [Worker(context) for _ in range(num_workers or os.cpu_count() or 1)]
+        self.next_id = 0
+        weakref.finalize(self, close_workers, self.workers)
+
+    # Creates a shard on the worker with the fewest shards and returns the worker and the shard id
+    def place(self, server_name):
+        worker = min(self.workers, key=lambda w: w.num_shards)
+        i = self.next_id
+        self.next_id += 1
+        worker.num_shards += 1
+        worker.send('create', i, server_name)
+        return worker, i
+
+"""
+kvstore of a RemoteShard: a mapping whose every operation is a request to
+the worker holding the shard. The shard is dropped from the worker once its
+last RemoteKVStore is garbage collected.
+"""
+class RemoteKVStore(MutableMapping):
+    def __init__(self, worker, shard_id):
+        self.worker = worker
+        self.id = shard_id
+        weakref.finalize(self, release, worker, shard_id)
+
+    def __len__(self):
+        return self.worker.call('len', self.id)
+
+    def __iter__(self):
+        return iter(self.worker.call('keys', self.id))
+
+    def __contains__(self, key):
+        return self.worker.call('contains', self.id, key)
+
+    def __getitem__(self, key):
+        return self.worker.call('getitem', self.id, key)
+
+    def __setitem__(self, key, value):
+        self.worker.call('setitem', self.id, key, value)
+
+    def __delitem__(self, key):
+        self.worker.call('delitem', self.id, key)
+
+    def pop(self, key, *default):
+        return self.worker.call('pop', self.id, key, *default)
+
+    def clear(self):
+        self.worker.call('clear', self.id)
+
+    def items(self):
+        return self.worker.call('items', self.id)
+
+    # Removes the (distinct) keys and returns their counts
+    def pop_many(self, keys):
+        return self.worker.call('pop_many', self.id, keys)
+
+    # Returns the known hash of each key, None for the keys whose hash is not
+    def hashes_of(self, keys):
+        return self.worker.call('hashes_of', self.id, keys)
+
+    # Returns the hash_fn hash of each key, hashing the keys whose hash is not
+    # known yet in this process, as a NumPy array if NumPy is installed
+    def hash_many(self, keys, hash_fn):
+        hashes = self.hashes_of(keys)
+        missing = [pos for pos, h in enumerate(hashes) if h is None]
+        if missing:
+            computed = hash_fn.many([keys[pos] for pos in missing])
+            computed = computed.tolist() if np is not None else computed
+            for pos, h in zip(missing, computed):
+                hashes[pos] = h
+            self.worker.send('set_hashes', self.id, [keys[pos] for pos in missing], computed)
+        if np is not None:
+            return np.array(hashes, dtype=np.uint32 if hash_fn.bits <= 32 else np.uint64)
+        return hashes
+
+# Drops a shard from its worker with the next request
+def release(worker, shard_id):
+    worker.dropped.append(shard_id)
+
+"""
+Shard kept by a worker process of a WorkerPool. put_many returns a Pending
+reply that is only waited on when its positions are read. snapshot()
+refreshes a local copy of the shard with the keys mutated since the previous
+snapshot, which is what a StateMonitor validates.
+"""
+class RemoteShard(Shard):
+    def __init__(self, server_name, workers):
+        self.server_name = server_name           # Name of the server
+        worker, shard_id = workers.place(server_name)
+        self.kvstore = RemoteKVStore(worker, shard_id) # internal kvstore, in the worker
+        self.local = Shard(server_name)          # copy of the shard at the last snapshot
+
+    # Increments count of key k by value v, keeping h as the hash of k if given
+    def put(self, k, v, h=None):
+        return self.kvstore.worker.call('put', self.kvstore.id, k, v, h)
+
+    # Increments the count of each (distinct) keys[i] by values[i] and returns
+    # the Pending positions i of the keys that were not in the shard before
+    def put_many(self, keys, values, hashes=None):
+        if np is not None and isinstance(hashes, np.ndarray):
+            hashes = hashes.tolist()
+        return self.kvstore.worker.send('put_many', self.kvstore.id, keys, values, hashes)
+
+    # Returns the count associated with k
+    def get(self, k):
+        return self.kvstore.worker.call('get', self.kvstore.id, k)
+
+    # Removes a key from the kvstore if it exists
+    def remove(self, k):
+        return self.kvstore.worker.call('remove', self.kvstore.id, k)
+
+    # Moves the (distinct) keys with their counts out of kvstore into this
+    # shard: within the worker if kvstore is on the same one, otherwise as one
+    # bulk pop from its worker and one bulk put to this one
+    def take(self, kvstore, keys):
+        if not isinstance(kvstore, RemoteKVStore):
+            return super().take(kvstore, keys)
+        if kvstore.worker is self.kvstore.worker:
+            self.kvstore.worker.send('move', self.kvstore.id, kvstore.id, keys)
+        else:
+            counts, hashes = kvstore.worker.call('pop_hashed', kvstore.id, keys)
+            self.put_many(keys, counts, hashes)
+
+    # Requests the keys mutated since the previous snapshot and returns the
+    # Pending local copy of the shard they are applied to
+    def snapshot(self):
+        return self.kvstore.worker.send('sync', self.kvstore.id, then=self.apply)
+
+    # Applies the (key, count) changes of a sync to the local copy and returns it
+    def apply(self, changes):
+        kvstore = self.local.kvstore
+        for k, count in changes:
+            if count is None:
+                kvstore.pop(k, None)
+            else:
+                kvstore[k] = count
+        return self.local
+
+# Returns shards with every RemoteShard replaced by its local copy, all of
+# them requested before waiting on any
+def snapshot_shards(shards):
+    pending = {name: shard.snapshot() for name, shard in shards.items() if isinstance(shard, RemoteShard)}
+    if not pending:
+        return shards
+    return {name: pending[name].result() if name in pending else shard for name, shard in shards.items()}
@@ -0,0 +1,120 @@
+from array import array
+from bisect import bisect_left
+from itertools import repeat
+from operator import itemgetter
+
+# NumPy is optional: without it merges and batch lookups use plain Python
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Hash ring stored as a sorted array of tokens plus a parallel array of owner
+ids (positions in `names`). A hash belongs to the first token at or after it,
+wrapping around at the end. Tokens of different shards can collide: the shard
+that placed it first keeps such a token and the later copies own no keys,
+until the first one is removed.
+Changes never touch the arrays in place, they build new ones, so a snapshot
+only copies references and keeps seeing the ring as it was.
+"""
+class Ring:
+    def __init__(self, bits=32):
+        self.typecode = 'I' if bits <= 32 else 'Q'
+        self.tokens = array(self.typecode) # sorted tokens
+        self.owners = array('i')           # owner id of each token
+        self.names = []                    # owner id -> shard name (None if free)
+        self.ids = {}                      # shard name -> owner id
+
+    def __len__(self):
+        return len(self.tokens)
+
+    # Returns a read-only view of the ring that shares its arrays
+    def snapshot(self):
+        snap = Ring.__new__(Ring)
+        snap.typecode, snap.tokens, snap.owners = self.typecode, self.tokens, self.owners
+        snap.names, snap.ids = list(self.names), dict(self.ids)
+        return snap
+
+    """ Membership """
+
+    # Places all `tokens` of shard_name on the ring in a single merge
+    def add(self, shard_name, tokens):
+        owner = self.assign_id(shard_name)
+        new = sorted(tokens)
+        if np is not None and len(self.tokens):
+            current = np.frombuffer(self.tokens, dtype=self.typecode)
+            # after any equal token, like the stable sort below
+            positions = np.searchsorted(current, new, side='right')
+            tokens = np.insert(current, positions, new)
+            owners = np.insert(np.frombuffer(self.owners, dtype='i'), positions, owner)
+            self.tokens = array(self.typecode, tokens.tobytes())
+            self.owners = array('i', owners.tobytes())
+        else:
+            # both runs are sorted, so this sort is a linear merge
+            merged = list(zip(self.tokens, self.owners))
+            merged.extend(zip(new, repeat(owner)))
+            merged.sort(key=itemgetter(0))
+            self.tokens = array(self.typecode, map(itemgetter(0), merged))
+            self.owners = array('i', map(itemgetter(1), merged))
+
+    # Takes every token of shard_name off the ring
+    def remove(self, shard_name):
+        owner = self.ids.pop(shard_name)
+        self.names[owner] = None
+        keep = [i for i, o in enumerate(self.owners) if o != owner]
+        self.tokens = array(self.typecode, map(self.tokens.__getitem__, keep))
+        self.owners = array('i', map(self.owners.__getitem__, keep))
+
+    def assign_id(self, shard_name):
+        if shard_name in self.ids:
+            return self.ids[shard_name]
+        owner = self.names.index(None) if None in self.names else len(self.names)
+        if owner == len(self.names):
+            self.names.append(shard_name)
+        else:
+            self.names[owner] = shard_name
+        self.ids[shard_name] = owner
+        return owner
+
+    """ Lookup """
+
+    # Gets the position in tokens that owns hash val
+    def slot(self, val):
+        slot = bisect_left(self.tokens, val)
+        return 0 if slot == len(self.tokens) else slot
+
+    # Gets the shard name that owns hash val
+    def lookup(self, val):
+        return self.names[self.owners[self.slot(val)]]
+
+    # Gets the owner id of every hash in vals, as a NumPy array if available
+    def lookup_many(self, vals):
+        if np is not None:
+            tokens = np.frombuffer(self.tokens, dtype=self.typecode)
+            slots = np.searchsorted(tokens, vals, side='left') % len(tokens)
+            return np.frombuffer(self.owners, dtype='i')[slots]
+        return [self.owners[self.slot(val)] for val in vals]
+
+    # Returns (lo, hi, next_owner) for every arc (lo, hi] owned by shard_name,
+    # where next_owner is the closest other shard clockwise (None if there is
+    # none), i.e. who owned the arc before shard_name or owns it after. The
+    # shards in exclude are skipped too, to find who owned the arc before a
+    # batch of shards was added. A token equal to the one before it owns
+    # nothing, so it gets no arc: (t, t] would read as the whole circle
+    def arcs(self, shard_name, exclude=()):
+        owner = self.ids[shard_name]
+        skip = {owner} | {self.ids[name] for name in exclude}
+        n = len(self.tokens)
+        arcs = []
+        for slot in range(n):
+            if self.owners[slot] != owner or (slot and self.tokens[slot - 1] == self.tokens[slot]):
+                continue
+            next_owner = None
+            for step in range(1, n):
+                o = self.owners[(slot + step) % n]
+                if o not in skip:
+                    next_owner = self.names[o]
+                    break
+            arcs.append((self.tokens[slot - 1], self.tokens[slot], next_owner))
+        return arcs
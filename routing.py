@@ -0,0 +1,208 @@
+import struct
+from array import array
+from hashing import get_hash_fn
+from ring import Ring
+from utils import jump_hash, jump_hash_many, rendezvous_owners
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Immutable routing snapshots of load balancers. A snapshot holds what a load
+balancer routed keys with at one epoch, its ring tokens, bucket or slot
+table or shard list, and routes keys on its own, so a client can cache it,
+route locally and only fetch a new one once the load balancer's epoch moved
+past it. overrides lists the keys stored off their regular route, like the
+spilled keys of bounded loads.
+A snapshot serializes to a little endian HEADER followed by columns, each a
+COLUMN header and its items, 8-byte aligned: the shard names (utf-8, newline
+separated, empty for a free ring id), the columns of its kind, then the keys
+and shard ids of the overrides.
+"""
+
+MAGIC = b'LBRT'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHQ16s') # magic, version, kind, num columns, epoch, hash name
+COLUMN = struct.Struct('<c7xQ')      # array typecode, num items
+
+# Rounds offset up to a multiple of 8
+def align(offset):
+    return (offset + 7) & ~7
+
+# Returns the newline separated utf-8 text of names as a column, None as ''
+def text_column(names):
+    return array('B', '\n'.join(name or '' for name in names).encode())
+
+# Returns the names of a text column, '' as None
+def column_text(column):
+    return [name or None for name in column.tobytes().decode().split('\n')] if len(column) else []
+
+# Returns the smallest unsigned array typecode that holds num_ids ids
+def id_typecode(num_ids):
+    return 'B' if num_ids <= 1 << 8 else 'H' if num_ids <= 1 << 16 else 'I'
+
+"""Routing of a load balancer at one epoch, routing keys by their hash_fn hash"""
+class RoutingSnapshot:
+    kind = None # id of the subclass in the serialized form
+
+    def __init__(self, epoch, hash_fn, names, overrides=None):
+        self.epoch = epoch                      # epoch of the load balancer this is a snapshot of
+        self.hash_fn = get_hash_fn(hash_fn)     # hash function keys are routed with
+        self.names = tuple(names)               # shard id -> shard name
+        self.overrides = dict(overrides or {})  # key -> shard name, for keys off their route
+
+    # Returns the name of the shard key routes to
+    def route(self, key):
+        if self.overrides:
+            name = self.overrides.get(key)
+            if name is not None:
+                return name
+        return self.names[self.locate(self.hash_fn(key))]
+
+    # Returns the name of the shard every key routes to, reusing hashes[i], the
+    # hash_fn hash of keys[i], when given
+    def route_many(self, keys, hashes=None):
+        if hashes is None:
+            hashes = self.hash_fn.many(keys)
+        ids = self.locate_many(hashes)
+        names = [self.names[i] for i in (ids.tolist() if np is not None and isinstance(ids, np.ndarray) else ids)]
+        if self.overrides:
+            names = [self.overrides.get(key, name) for key, name in zip(keys, names)]
+        return names
+
+    # Should be implemented in child classes: the shard id hash val routes to
+    def locate(self, val):
+        raise NotImplementedError
+
+    # The shard id of every hash in vals
+    def locate_many(self, vals):
+        return [self.locate(val) for val in vals]
+
+    # Should be implemented in child classes: the arrays the snapshot routes with
+    def columns(self):
+        raise NotImplementedError
+
+    # Returns the snapshot in the serialized form
+    def to_bytes(self):
+        keys = list(self.overrides)
+        ids = {name: i for i, name in enumerate(self.names)}
+        columns = [text_column(self.names)] + self.columns() + [text_column(keys), array('i', [ids[self.overrides[key]] for key in keys])]
+        out = bytearray(HEADER.pack(MAGIC, VERSION, self.kind, len(columns), self.epoch, self.hash_fn.name.encode()))
+        for column in columns:
+            out += COLUMN.pack(column.typecode.encode(), len(column))
+            out += column.tobytes()
+            out += bytes(align(len(out)) - len(out))
+        return bytes(out)
+
+    # Returns the snapshot serialized in data
+    @staticmethod
+    def from_bytes(data):
+        view = memoryview(data)
+        magic, version, kind, num_columns, epoch, hash_name = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION or kind not in KINDS:
+            raise ValueError('not a version {} routing snapshot'.format(VERSION))
+        offset = HEADER.size
+        columns = []
+        for _ in range(num_columns):
+            typecode, count = COLUMN.unpack_from(view, offset)
+            column = array(typecode.decode())
+            offset += COLUMN.size
+            end = offset + count * column.itemsize
+            column.frombytes(view[offset:end])
+            columns.append(column)
+            offset = align(end)
+        names = column_text(columns[0])
+        overrides = {key: names[i] for key, i in zip(column_text(columns[-2]), columns[-1])}
+        return KINDS[kind].from_columns(epoch, hash_name.rstrip(b'\0').decode(), names, columns[1:-2], overrides)
+
+"""Routes a hash to the shard of the first ring token at or after it"""
+class RingSnapshot(RoutingSnapshot):
+    kind = 1
+
+    def __init__(self, epoch, hash_fn, ring, overrides=None):
+        super().__init__(epoch, hash_fn, ring.names, overrides)
+        self.ring = ring # a Ring snapshot: its arrays are never changed in place
+
+    def locate(self, val):
+        return self.ring.owners[self.ring.slot(val)]
+
+    def locate_many(self, vals):
+        return self.ring.lookup_many(vals)
+
+    def columns(self):
+        return [self.ring.tokens, self.ring.owners]
+
+    @classmethod
+    def from_columns(cls, epoch, hash_fn, names, columns, overrides):
+        ring = Ring.__new__(Ring)
+        ring.tokens, ring.owners = columns
+        ring.typecode = ring.tokens.typecode
+        ring.names = names
+        ring.ids = {name: i for i, name in enumerate(names) if name is not None}
+        return cls(epoch, hash_fn, ring, overrides)
+
+"""Routes a hash to the shard id in slot hash % len(table) of the table"""
+class TableSnapshot(RoutingSnapshot):
+    kind = 2
+
+    def __init__(self, epoch, hash_fn, names, table, overrides=None):
+        super().__init__(epoch, hash_fn, names, overrides)
+        self.table = array(id_typecode(len(self.names)), table) # slot -> shard id
+
+    def locate(self, val):
+        return self.table[val % len(self.table)]
+
+    def locate_many(self, vals):
+        if np is not None:
+            return np.frombuffer(self.table, dtype=self.table.typecode)[np.asarray(vals) % len(self.table)]
+        return super().locate_many(vals)
+
+    def columns(self):
+        return [self.table]
+
+    @classmethod
+    def from_columns(cls, epoch, hash_fn, names, columns, overrides):
+        return cls(epoch, hash_fn, names, columns[0], overrides)
+
+"""Routes a hash to shard id jump_hash(hash, len(names))"""
+class JumpSnapshot(RoutingSnapshot):
+    kind = 3
+
+    def locate(self, val):
+        return jump_hash(val, len(self.names))
+
+    def locate_many(self, vals):
+        return jump_hash_many(vals, len(self.names))
+
+    def columns(self):
+        return []
+
+    @classmethod
+    def from_columns(cls, epoch, hash_fn, names, columns, overrides):
+        return cls(epoch, hash_fn, names, overrides)
+
+"""Routes a hash to the shard with the highest weighted rendezvous score"""
+class RendezvousSnapshot(RoutingSnapshot):
+    kind = 4
+
+    def __init__(self, epoch, hash_fn, names, seeds, weights, overrides=None):
+        super().__init__(epoch, hash_fn, names, overrides)
+        self.seeds = array('Q', seeds)     # shard id -> seed mixed into its scores
+        self.weights = array('d', weights) # shard id -> weight
+
+    def locate(self, val):
+        return int(self.locate_many([val])[0])
+
+    def locate_many(self, vals):
+        return rendezvous_owners(vals, self.seeds, self.weights)
+
+    def columns(self):
+        return [self.seeds, self.weights]
+
+    @classmethod
+    def from_columns(cls, epoch, hash_fn, names, columns, overrides):
+        return cls(epoch, hash_fn, names, columns[0], columns[1], overrides)
+
+KINDS = {cls.kind: cls for cls in (RingSnapshot, TableSnapshot, JumpSnapshot, RendezvousSnapshot)}
@@ -0,0 +1,202 @@
+from benchmark import find_balancers, takes_half_life
+from hashing import HASH_FUNCTIONS, DEFAULT_HASH
+from shard import CompactShard
+from remote_shard import RemoteShard
+from LoadBalancers.load_balancer import LoadBalancer
+import argparse
+import asyncio
+
+"""
+asyncio TCP front-end for a load balancer. Clients send the commands of the
+text workload format, `put <key>`, `create <shard_name>` and
+`remove <shard_name>`, plus `get <key>`, one per line, and may pipeline them:
+the replies come back in order, one line each, `OK` for put, create and
+remove, the access count of the key (or `NONE`) for get and `ERR <message>`
+for a command that failed. The runs of puts read off a connection at once go
+to the load balancer in one put_many.
+Commands run on the event loop one batch at a time, so a request that
+arrives while a rebalance is running waits for it, like on a single threaded
+server. With --migrate-rate, load balancers that can plan their migrations
+(see migration.py) only change their routing on create and remove and move
+the keys afterwards, migrate_rate keys per key put plus MIGRATE_STEP keys
+between batches of requests, so requests never wait for a whole rebalance.
+With --lazy, they move a key only when it is next accessed, plus a few per
+key put and a low priority sweeper for the keys that stay cold.
+"""
+
+READ_SIZE = 1 << 16 # Bytes read off a connection at once
+MAX_LINE = 1 << 12  # Bytes a command line may take, longer lines are discarded with an ERR reply
+MIGRATE_STEP = 1024 # Keys migrated at a time between batches of requests
+SWEEP_STEP = 256    # Keys the sweeper of a lazy load balancer moves at a time
+SWEEP_PAUSE = 0.01  # Seconds the sweeper waits between steps
+
+class BalancerServer:
+    def __init__(self, load_balancer, migrate_rate=None):
+        self.load_balancer = load_balancer
+        self.migrate_rate = migrate_rate # keys migrated per key put, None to rebalance right away
+        self.num_requests = 0 # Commands executed
+        self.drainer = None   # task finishing the migration in flight
+
+    # Serves one connection until the client closes it, executing a last
+    # command that has no newline once the client stops sending
+    async def handle(self, reader, writer):
+        tail = b''
+        discarding = False # whether the rest of a too long line is still coming
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                lines = (tail + data).split(b'\n')
+                tail = lines.pop() # incomplete last line, finished by the next read
+                if discarding and lines:
+                    lines.pop(0)
+                    discarding = False
+                replies = self.execute(lines)
+                if discarding or len(tail) > MAX_LINE:
+                    if not discarding:
+                        replies += TOO_LONG
+                    tail = b''
+                    discarding = True
+                writer.write(replies)
+                await writer.drain()
+            if tail and not discarding:
+                writer.write(self.execute([tail]))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # Executes the command lines in order and returns their replies
+    def execute(self, lines):
+        replies = []
+        puts = []
+        for line in lines:
+            command = line.split() if len(line) <= MAX_LINE else None
+            if command == []:
+                continue
+            if command is not None and len(command) == 2 and command[0] == b'put':
+                puts.append(command[1])
+                continue
+            if puts:
+                replies.append(self.put_many(puts))
+                puts = []
+            replies.append(self.command(command) if command is not None else TOO_LONG)
+        if puts:
+            replies.append(self.put_many(puts))
+        return b''.join(replies)
+
+    # Puts a run of keys, replying to each put
+    def put_many(self, keys):
+        self.num_requests += len(keys)
+        try:
+            self.load_balancer.put_many([key.decode() for key in keys])
+        except Exception as e:
+            return error(e) * len(keys)
+        return b'OK\n' * len(keys)
+
+    # Executes one command other than put and returns its reply
+    def command(self, command):
+        self.num_requests += 1
+        if len(command) != 2:
+            return b'ERR expected <command> <arg>\n'
+        lb = self.load_balancer
+        try:
+            name, arg = command[0].decode(), command[1].decode()
+            if name == 'get':
+                count = lb.get(arg)
+                return b'NONE\n' if count is None else b'%d\n' % count
+            if name == 'create':
+                if arg in lb.shards:
+                    return b'ERR shard ' + command[1] + b' already exists\n'
+                self.change(lb.plan_add_shards([arg]) if self.migrate_rate is not None else None, lb.add_shard, arg)
+            elif name == 'remove':
+                if arg not in lb.shards:
+                    return b'ERR no shard ' + command[1] + b'\n'
+                if len(lb.shards) == 1:
+                    return b'ERR cannot remove the last shard\n'
+                self.change(lb.plan_remove_shards([arg]) if self.migrate_rate is not None else None, lb.remove_shard, arg)
+            else:
+                return b'ERR unknown command ' + command[0] + b'\n'
+        except Exception as e:
+            return error(e)
+        return b'OK\n'
+
+    # Applies a membership change, starting the migration of plan if there is
+    # one and calling apply(shard_name) otherwise, and drains the migrations
+    # it left in flight in the background
+    def change(self, plan, apply, shard_name):
+        if plan is None:
+            apply(shard_name)
+        else:
+            self.load_balancer.start_migration(plan, self.migrate_rate)
+        if self.load_balancer.migrations and (self.drainer is None or self.drainer.done()):
+            self.drainer = asyncio.ensure_future(self.drain())
+
+    # Migrates keys until no migration is in flight, MIGRATE_STEP at a time
+    # with the requests that arrived in between run after every step; lazy
+    # load balancers are swept at low priority, SWEEP_STEP keys every SWEEP_PAUSE
+    async def drain(self):
+        lazy = self.load_balancer.sweep_rate is not None
+        while self.load_balancer.migrations:
+            self.load_balancer.migrate(SWEEP_STEP if lazy else MIGRATE_STEP)
+            await asyncio.sleep(SWEEP_PAUSE if lazy else 0)
+
+TOO_LONG = b'ERR line longer than %d bytes\n' % MAX_LINE
+
+# Returns the reply to a command that raised e
+def error(e):
+    return 'ERR {}: {}\n'.format(type(e).__name__, str(e).splitlines()[0] if str(e) else '').encode()
+
+# Serves the load balancer on host:port until cancelled
+async def serve(load_balancer, host, port, migrate_rate=None):
+    balancer_server = BalancerServer(load_balancer, migrate_rate)
+    server = await asyncio.start_server(balancer_server.handle, host, port)
+    print('serving {} with {} shards on {}'.format(type(load_balancer).__name__, len(load_balancer.shards),
+                                                 ', '.join('{}:{}'.format(*sock.getsockname()[:2]) for sock in server.sockets)))
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serves a load balancer over TCP')
+    parser.add_argument('-b', metavar='balancer', type=str, help='LoadBalancer class name', default='ConsistentHashingLoadBalancer')
+    parser.add_argument('--host', type=str, help='address to listen on', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='port to listen on', default=7070)
+    parser.add_argument('--shards', type=int, help='shards server0 to server<N-1> created before serving', default=10)
+    parser.add_argument('--hash', metavar='hash_fn', type=str, choices=sorted(HASH_FUNCTIONS),
+                        help='hash function the load balancer uses {}'.format(sorted(HASH_FUNCTIONS)), default=DEFAULT_HASH)
+    parser.add_argument('--compact-shards', help='stores keys in array-backed CompactShards, about half the memory of the default Shards but several times slower', action='store_true')
+    parser.add_argument('--migrate-rate', metavar='R', type=float,
+                        help='migrates keys in the background after create and remove, R keys per key put, where the load balancer can plan it')
+    parser.add_argument('--lazy', metavar='R', type=float,
+                        help='only changes the routing on create and remove and moves keys when accessed, sweeping R keys per key put, where the load balancer can plan it')
+    parser.add_argument('--half-life', metavar='N', type=int,
+                        help='halves the heat TableIndirection keeps per bucket every N puts, instead of counting every put ever made')
+    parser.add_argument('--shard-workers', metavar='N', type=int, help='keeps the shards in N worker processes (RemoteShards)')
+    args = parser.parse_args()
+
+    if args.compact_shards and args.shard_workers:
+        parser.error('--compact-shards and --shard-workers pick different shard classes, pass only one')
+    if args.compact_shards:
+        LoadBalancer.shard_class = CompactShard
+    if args.shard_workers:
+        LoadBalancer.shard_class = RemoteShard
+        LoadBalancer.num_workers = args.shard_workers
+    LoadBalancer.sweep_rate = args.lazy
+
+    balancers = find_balancers()
+    if args.b not in balancers:
+        print('Unknown load balancer {}, expected one of {}'.format(args.b, sorted(balancers)))
+        exit(1)
+    if args.half_life is not None and not takes_half_life(balancers[args.b]):
+        parser.error('--half-life only applies to load balancers that keep heat, like TableIndirection')
+    kwargs = {'halfLife': args.half_life} if args.half_life is not None else {}
+    lb = balancers[args.b](args.hash, **kwargs)
+    for n in range(args.shards):
+        lb.add_shard('server{}'.format(n))
+
+    try:
+        asyncio.run(serve(lb, args.host, args.port, args.migrate_rate))
+    except KeyboardInterrupt:
+        pass
@@ -1,13 +1,116 @@
+from array import array
+from collections.abc import MutableMapping
+from itertools import accumulate, compress, repeat
+from operator import add, not_
+from hashing import get_hash_fn
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Dictionary that records every key it mutates in `journal`, whichever code
+path mutates it, so a checker can look at only the keys that changed. It also
+keeps the hash of its keys in `hashes` once a caller hands them in, so
+migrations do not hash the keys again, and forgets it with the key.
+"""
+class JournaledDict(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.journal = set(self) # keys mutated since the journal was last taken
+        self.hashes = {}         # key -> hash of the key, for the keys whose hash is known
+
+    # Pickles the items as a plain dict, so they are not put back through
+    # __setitem__ before the journal exists
+    def __reduce__(self):
+        return type(self), (dict(self),), self.__dict__
+
+    def __setitem__(self, key, value):
+        self.journal.add(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.journal.add(key)
+        dict.__delitem__(self, key)
+        self.hashes.pop(key, None)
+
+    def pop(self, key, *default):
+        self.journal.add(key)
+        self.hashes.pop(key, None)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.journal.add(key)
+        self.hashes.pop(key, None)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        self.journal.add(key)
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        self.journal.update(items)
+        dict.update(self, items)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        self.journal.update(self)
+        dict.clear(self)
+        self.hashes.clear()
+
+    # Removes the (distinct) keys and returns their counts
+    def pop_many(self, keys):
+        return list(map(self.pop, keys))
+
+    # Returns the known hash of each key, None for the keys whose hash is not
+    def hashes_of(self, keys):
+        return list(map(self.hashes.get, keys))
+
+    # Returns the hash_fn hash of each key, hashing (once) the keys whose hash
+    # is not known yet, as a NumPy array if NumPy is installed
+    def hash_many(self, keys, hash_fn):
+        hashes = self.hashes_of(keys)
+        missing = [pos for pos, h in enumerate(hashes) if h is None]
+        if missing:
+            computed = hash_fn.many([keys[pos] for pos in missing])
+            for pos, h in zip(missing, computed.tolist() if np is not None else computed):
+                hashes[pos] = h
+                if keys[pos] in self:
+                    self.hashes[keys[pos]] = h
+        if np is not None:
+            return np.array(hashes, dtype=np.uint32 if hash_fn.bits <= 32 else np.uint64)
+        return hashes
+
 """Wrapper for a dictionary"""
 class Shard:
     def __init__(self, server_name):
-        self.server_name = server_name # Name of the server
-        self.kvstore = {}              # internal kvstore
+        self.server_name = server_name   # Name of the server
+        self.kvstore = JournaledDict()   # internal kvstore
 
-    # Increments count of key k by value v 
-    def put(self, k, v):
-        self.kvstore[k] = self.kvstore.get(k, 0) + v
-        return self.kvstore[k]
+    # Increments count of key k by value v, keeping h as the hash of k if given
+    def put(self, k, v, h=None):
+        count = self.kvstore.get(k, 0) + v
+        self.kvstore[k] = count
+        if h is not None:
+            self.kvstore.hashes[k] = h
+        return count
+
+    # Increments the count of each (distinct) keys[i] by values[i] and returns
+    # the positions i of the keys that were not in the shard before. hashes[i],
+    # if given, is kept as the hash of keys[i] when it is new
+    def put_many(self, keys, values, hashes=None):
+        old = list(map(self.kvstore.get, keys, repeat(0)))
+        self.kvstore.update(zip(keys, map(add, old, values)))
+        new = list(compress(range(len(keys)), map(not_, old)))
+        if hashes is not None:
+            self.kvstore.hashes.update(zip(map(keys.__getitem__, new), map(hashes.__getitem__, new)))
+        return new
 
     # Returns the count associated with k
     def get(self, k):
@@ -23,4 +126,475 @@ class Shard:
             del self.kvstore[k]
             return (k, v)
         else:
-            return None
\ No newline at end of file
+            return None
+
+    # Moves the (distinct) keys with their counts, and their hashes if all are known, out of kvstore into this shard
+    def take(self, kvstore, keys):
+        hashes = kvstore.hashes_of(keys)
+        self.put_many(keys, kvstore.pop_many(keys), None if None in hashes else hashes)
+
+    # Returns the keys mutated since the last call, or None if the kvstore
+    # does not keep a journal
+    def take_journal(self):
+        journal = getattr(self.kvstore, 'journal', None)
+        if journal is None:
+            return None
+        self.kvstore.journal = set()
+        return journal
+
+JOURNAL_SLACK = 1024 # Journaled ids past twice the table size before the journal of a CompactKVStore is deduplicated
+
+"""
+Keys of all the shards of a load balancer, interned to integer ids and
+stored in columns: the key table holds every key once as utf-8 bytes, and
+the owner, count and cached hash_fn hash of key id i are the i-th items of
+typed arrays. Keys cannot contain newlines, which separate them in the
+table. Keys are found by a stable 64-bit fingerprint (a hash function of
+hashing.py, fnv1a64 by default), in sorted NumPy arrays with a dict for the
+keys added since the last merge. Every fingerprint hit is checked against the
+stored key: a key whose fingerprint another key had first is kept in an exact
+dict instead, so two keys never share an id.
+"""
+class KeyTable:
+    def __init__(self, hash_fn=None, fingerprint='fnv1a64'):
+        self.hash_fn = get_hash_fn(hash_fn)
+        self.fingerprint = get_hash_fn(fingerprint) # hash that finds the id of a key
+        self.ids = {}                  # fingerprint -> key id, for keys not in sorted_fps yet
+        self.collided = {}             # key -> key id, for keys whose fingerprint another key has
+        self.key_bytes = bytearray()   # every key, utf-8 encoded and newline terminated
+        self.offsets = array('Q', [0]) # key id -> start of the key in key_bytes, and of the next one at id + 1
+        self.owners = array('i')       # key id -> number of the shard holding the key, -1 if none
+        self.counts = array('q')       # key id -> access count in its owner
+        self.hashes = array('I' if self.hash_fn.bits <= 32 else 'Q') # key id -> hash_fn hash
+        self.num_shards = 0            # shard numbers handed out
+        if np is not None:
+            self.sorted_fps = np.empty(0, dtype=np.uint64) # fingerprints of the other keys, sorted
+            self.sorted_ids = np.empty(0, dtype=np.uint32) # key id of each of sorted_fps
+
+    def __len__(self):
+        return len(self.owners)
+
+    # Returns a number for a new shard to own keys under
+    def add_shard(self):
+        self.num_shards += 1
+        return self.num_shards - 1
+
+    # Returns the key with id i
+    def key(self, i):
+        return self.key_bytes[self.offsets[i]:self.offsets[i + 1] - 1].decode()
+
+    # Returns the keys with the given ids
+    def keys_of(self, ids):
+        if np is not None and isinstance(ids, np.ndarray):
+            ids = ids.tolist()
+        if len(ids) * 8 > len(self.owners):
+            # decoding the whole table at once beats slicing out this many keys
+            keys = self.key_bytes.decode().split('\n')
+            return [keys[i] for i in ids]
+        key_bytes, offsets = self.key_bytes, self.offsets
+        return [key_bytes[offsets[i]:offsets[i + 1] - 1].decode() for i in ids]
+
+    # Returns the id of key, -1 if it was never interned
+    def lookup(self, key):
+        i = self.lookup_fp(self.fingerprint(key))
+        if i != -1 and self.key(i) != key: # another key has its fingerprint
+            return self.collided.get(key, -1)
+        return i
+
+    # Returns the id of the key interned under fingerprint fp, -1 if none
+    def lookup_fp(self, fp):
+        i = self.ids.get(fp, -1)
+        if i == -1 and np is not None:
+            fps = self.sorted_fps
+            pos = fps.searchsorted(np.uint64(fp))
+            if pos < len(fps) and fps.item(pos) == fp:
+                return self.sorted_ids.item(pos)
+        return i
+
+    # Returns the id of each key, -1 for keys that were never interned
+    def lookup_many(self, keys):
+        return self.find_many(keys, self.fingerprint.many(keys))[0]
+
+    # Returns the id of each key, given their fingerprints fps, -1 for keys that were never
+    # interned, and the positions of the keys not interned whose fingerprint another key has
+    def find_many(self, keys, fps):
+        if np is None:
+            ids = [self.ids.get(fp, -1) for fp in fps]
+            hits = [pos for pos, i in enumerate(ids) if i != -1]
+            stored = self.keys_of([ids[pos] for pos in hits])
+            wrong = [pos for pos, key in zip(hits, stored) if key != keys[pos]]
+        else:
+            ids = self.lookup_fps(fps)
+            hits = np.flatnonzero(ids != -1)
+            wrong = hits[~self.matches(ids[hits], [keys[pos] for pos in hits.tolist()])].tolist()
+        taken = []
+        for pos in wrong:
+            ids[pos] = self.collided.get(keys[pos], -1)
+            if ids[pos] == -1:
+                taken.append(pos)
+        return ids, taken
+
+    # Returns the id of each fingerprint, -1 for keys that were never interned
+    def lookup_fps(self, fps):
+        ids = np.full(len(fps), -1, dtype=np.int64)
+        if len(self.sorted_fps):
+            pos = np.minimum(np.searchsorted(self.sorted_fps, fps), len(self.sorted_fps) - 1)
+            hit = self.sorted_fps[pos] == fps
+            ids[hit] = self.sorted_ids[pos[hit]]
+        if self.ids:
+            miss = np.flatnonzero(ids == -1)
+            ids[miss] = [self.ids.get(fp, -1) for fp in fps[miss].tolist()]
+        return ids
+
+    # Returns, for each of the (NumPy array of) ids, whether its key is keys[n],
+    # comparing the utf-8 bytes of all keys at once
+    def matches(self, ids, keys):
+        encoded = [key.encode() for key in keys]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.frombuffer(self.offsets, dtype=np.uint64)
+        starts = offsets[ids].astype(np.int64)
+        same = offsets[ids + 1].astype(np.int64) - starts - 1 == lengths
+        del offsets
+        check = np.flatnonzero(same & (lengths > 0))
+        if len(check):
+            lengths = lengths[check]
+            firsts = np.cumsum(lengths) - lengths # start of each key in the bytes compared
+            table = np.frombuffer(self.key_bytes, dtype=np.uint8)
+            stored = table[np.repeat(starts[check] - firsts, lengths) + np.arange(firsts[-1] + lengths[-1])]
+            del table # a bytearray cannot grow while NumPy views it
+            given = np.frombuffer(b''.join(encoded) if len(check) == len(keys) else b''.join(map(encoded.__getitem__, check.tolist())), dtype=np.uint8)
+            same[check[np.add.reduceat(stored != given, firsts) > 0]] = False
+        return same
+
+    # Returns the id of key, interning it with hash h, or its hash_fn hash if h is None, if it is new
+    def intern(self, key, h=None):
+        fp = self.fingerprint(key)
+        i = self.lookup_fp(fp)
+        taken = i != -1 and self.key(i) != key # another key has its fingerprint
+        if taken:
+            i = self.collided.get(key, -1)
+        if i == -1:
+            i = self.add_many([fp], [key], [self.hash_fn(key) if h is None else h], [0] if taken else ())
+            self.merge()
+        return i
+
+    # Returns the id of each (distinct) key, interning the new ones with their
+    # hash in hashes, or their hash_fn hash if hashes is not given
+    def intern_many(self, keys, hashes=None):
+        fps = self.fingerprint.many(keys)
+        ids, taken = self.find_many(keys, fps)
+        new = np.flatnonzero(ids == -1).tolist() if np is not None else [pos for pos, i in enumerate(ids) if i == -1]
+        if new:
+            if taken:
+                taken = set(taken)
+                taken = [n for n, pos in enumerate(new) if pos in taken]
+            new_keys = [keys[pos] for pos in new]
+            if hashes is None:
+                new_hashes = self.hash_fn.many(new_keys)
+                new_hashes = new_hashes.tolist() if np is not None else new_hashes
+            else:
+                new_hashes = [hashes[pos] for pos in new]
+            new_fps = fps[new].tolist() if np is not None else [fps[pos] for pos in new]
+            start = self.add_many(new_fps, new_keys, new_hashes, taken)
+            if np is not None:
+                ids[new] = np.arange(start, start + len(new))
+            else:
+                for i, pos in enumerate(new, start):
+                    ids[pos] = i
+            self.merge()
+        return ids
+
+    # Appends keys with fingerprints fps and hashes to the columns and returns the id of the first one;
+    # the keys at the positions in taken, whose fingerprint another key has, are found by key instead
+    def add_many(self, fps, keys, hashes, taken=()):
+        start = len(self.owners)
+        encoded = [key.encode() for key in keys]
+        self.key_bytes += b'\n'.join(encoded) + b'\n'
+        end = self.offsets.pop() # the end of the table is the start of the first new key
+        self.offsets.extend(accumulate((len(key) + 1 for key in encoded), initial=end))
+        self.owners.extend(repeat(-1, len(keys)))
+        self.counts.extend(repeat(0, len(keys)))
+        self.hashes.extend(hashes)
+        pairs = zip(fps, range(start, start + len(keys)))
+        if taken:
+            for pos in taken:
+                self.collided[keys[pos]] = start + pos
+            taken = set(taken)
+            pairs = [pair for pos, pair in enumerate(pairs) if pos not in taken]
+        else:
+            pairs = list(pairs)
+        before = len(self.ids)
+        self.ids.update(pairs)
+        if len(self.ids) - before < len(pairs): # new keys sharing a fingerprint: all but the last are found by key
+            for fp, i in pairs:
+                if self.ids[fp] != i:
+                    self.collided[self.key(i)] = i
+        return start
+
+    # Moves the recently added keys into the sorted arrays once they are an eighth of them
+    def merge(self):
+        if np is None or len(self.ids) * 8 <= len(self.sorted_fps):
+            return
+        fps = np.concatenate([self.sorted_fps, np.fromiter(self.ids.keys(), dtype=np.uint64, count=len(self.ids))])
+        ids = np.concatenate([self.sorted_ids, np.fromiter(self.ids.values(), dtype=np.uint32, count=len(self.ids))])
+        order = np.argsort(fps)
+        self.sorted_fps = fps[order]
+        self.sorted_ids = ids[order]
+        self.ids = {}
+
+"""
+Mapping from key to count for one shard of a KeyTable: the keys whose owner
+column holds the shard number, plus an overflow dict for the keys the shard
+holds while another shard owns their columns, which only a broken load
+balancer does. Like JournaledDict it journals the keys it mutates, as key ids
+in an array that is deduplicated whenever it outgrows the table.
+"""
+class CompactKVStore(MutableMapping):
+    def __init__(self, table):
+        self.table = table
+        self.number = table.add_shard() # Number of the shard in the owner column
+        self.size = 0                   # Number of keys held in the columns
+        self.overflow = {}              # key id -> count, for keys owned by another shard
+        self.journal = array('I')       # key ids mutated since the journal was last taken
+
+    def __len__(self):
+        return self.size + len(self.overflow)
+
+    def __iter__(self):
+        return iter(self.table.keys_of(self.ids()) + self.table.keys_of(list(self.overflow)))
+
+    def __contains__(self, key):
+        return self.count(self.table.lookup(key)) is not None
+
+    def __getitem__(self, key):
+        count = self.count(self.table.lookup(key))
+        if count is None:
+            raise KeyError(key)
+        return count
+
+    def __setitem__(self, key, value):
+        i = self.table.intern(key)
+        self.log(i)
+        if i in self.overflow:
+            self.overflow[i] = value
+            return
+        owner = self.table.owners[i]
+        if owner == -1:
+            self.table.owners[i] = self.number
+            self.size += 1
+        elif owner != self.number:
+            self.overflow[i] = value
+            return
+        self.table.counts[i] = value
+
+    def __delitem__(self, key):
+        i = self.table.lookup(key)
+        if self.count(i) is None:
+            raise KeyError(key)
+        self.remove_id(i)
+
+    def pop(self, key, *default):
+        i = self.table.lookup(key)
+        if self.count(i) is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return self.remove_id(i)
+
+    def clear(self):
+        self.remove_ids(self.ids())
+        self.log_many(list(self.overflow))
+        self.overflow.clear()
+
+    # Returns the counts, in the order of iteration
+    def values(self):
+        ids = self.ids()
+        if np is not None:
+            counts = np.frombuffer(self.table.counts, dtype=np.int64)[ids].tolist() if len(ids) else []
+        else:
+            counts = [self.table.counts[i] for i in ids]
+        return counts + list(self.overflow.values())
+
+    # Returns the (key, count) pairs, in the order of iteration
+    def items(self):
+        return list(zip(self, self.values()))
+
+    # Returns the ids of the keys held in the columns
+    def ids(self):
+        if np is None:
+            return [i for i, owner in enumerate(self.table.owners) if owner == self.number]
+        if not len(self.table.owners):
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(np.frombuffer(self.table.owners, dtype=np.int32) == self.number)
+
+    # Journals key id i
+    def log(self, i):
+        self.journal.append(i)
+        if len(self.journal) > 2 * len(self.table) + JOURNAL_SLACK:
+            self.compact_journal()
+
+    # Journals the key ids
+    def log_many(self, ids):
+        if np is not None:
+            self.journal.frombytes(np.asarray(ids, dtype=np.uint32).tobytes())
+        else:
+            self.journal.extend(ids)
+        if len(self.journal) > 2 * len(self.table) + JOURNAL_SLACK:
+            self.compact_journal()
+
+    # Drops the repeated ids from the journal
+    def compact_journal(self):
+        if np is not None:
+            self.journal = array('I', np.unique(np.frombuffer(self.journal, dtype=np.uint32)).tobytes())
+        else:
+            self.journal = array('I', sorted(set(self.journal)))
+
+    # Returns the hash of each key, which the table always knows
+    def hashes_of(self, keys):
+        return self.hash_many(keys).tolist() if np is not None else self.hash_many(keys)
+
+    # Returns the hash of each key, as a NumPy array if NumPy is installed.
+    # The table hashed every key with the hash_fn of its load balancer already
+    def hash_many(self, keys, hash_fn=None):
+        ids = self.table.lookup_many(keys)
+        if np is None:
+            return [self.table.hashes[i] for i in ids]
+        if not len(ids):
+            return np.empty(0, dtype=np.uint32 if self.table.hashes.itemsize == 4 else np.uint64)
+        return np.frombuffer(self.table.hashes, dtype=np.uint32 if self.table.hashes.itemsize == 4 else np.uint64)[ids]
+
+    # Returns the count of key id i, None if the shard does not hold it
+    def count(self, i):
+        if i == -1:
+            return None
+        if i in self.overflow:
+            return self.overflow[i]
+        return self.table.counts[i] if self.table.owners[i] == self.number else None
+
+    # Adds v to the count of key id i and returns the new count
+    def put_id(self, i, v):
+        self.log(i)
+        if i in self.overflow:
+            self.overflow[i] += v
+            return self.overflow[i]
+        owner = self.table.owners[i]
+        if owner == self.number:
+            self.table.counts[i] += v
+            return self.table.counts[i]
+        if owner == -1:
+            self.table.owners[i] = self.number
+            self.table.counts[i] = v
+            self.size += 1
+        else:
+            self.overflow[i] = v
+        return v
+
+    # Adds values[j] to the count of each (distinct) key id ids[j] and returns
+    # the positions j of the ids the shard held no count for
+    def put_ids(self, ids, values):
+        if np is not None:
+            ids = np.asarray(ids, dtype=np.int64)
+        if np is not None and not self.overflow and len(ids):
+            self.log_many(ids)
+            owners = np.frombuffer(self.table.owners, dtype=np.int32)
+            held = owners[ids]
+            if not ((held != self.number) & (held != -1)).any():
+                counts = np.frombuffer(self.table.counts, dtype=np.int64)
+                old = np.where(held == self.number, counts[ids], 0)
+                counts[ids] = old + np.asarray(values, dtype=np.int64)
+                owners[ids] = self.number
+                self.size += int(np.count_nonzero(held == -1))
+                return np.flatnonzero(old == 0).tolist()
+            del owners # some ids are owned by another shard
+        return [pos for pos, (i, v) in enumerate(zip(ids.tolist() if np is not None else ids, values)) if self.put_id(i, v) == v]
+
+    # Removes key id i, which the shard holds, and returns its count
+    def remove_id(self, i):
+        self.log(i)
+        if i in self.overflow:
+            return self.overflow.pop(i)
+        self.table.owners[i] = -1
+        self.size -= 1
+        return self.table.counts[i]
+
+    # Removes the (distinct) key ids, which the shard all holds, and returns their counts
+    def remove_ids(self, ids):
+        if np is not None:
+            ids = np.asarray(ids, dtype=np.int64)
+        if np is not None and not self.overflow and len(ids):
+            owners = np.frombuffer(self.table.owners, dtype=np.int32)
+            if (owners[ids] != self.number).any():
+                raise KeyError(self.table.keys_of(ids[owners[ids] != self.number][:1])[0])
+            owners[ids] = -1
+            self.size -= len(ids)
+            self.log_many(ids)
+            return np.frombuffer(self.table.counts, dtype=np.int64)[ids].tolist()
+        counts = []
+        for i in (ids.tolist() if np is not None else ids):
+            if self.count(i) is None:
+                raise KeyError(self.table.key(i))
+            counts.append(self.remove_id(i))
+        return counts
+
+    # Removes the (distinct) keys and returns their counts
+    def pop_many(self, keys):
+        ids = self.table.lookup_many(keys)
+        if np is not None and (ids == -1).any() or np is None and -1 in ids:
+            raise KeyError([key for key, i in zip(keys, ids) if i == -1][0])
+        return self.remove_ids(ids)
+
+    # Moves the (distinct) key ids, which src all holds, from src to this shard
+    # by handing over their owner column
+    def move_ids(self, src, ids):
+        if np is not None:
+            ids = np.asarray(ids, dtype=np.int64)
+        if np is not None and not self.overflow and not src.overflow and len(ids):
+            owners = np.frombuffer(self.table.owners, dtype=np.int32)
+            if (owners[ids] == src.number).all():
+                owners[ids] = self.number
+                self.size += len(ids)
+                src.size -= len(ids)
+                self.log_many(ids)
+                src.log_many(ids)
+                return
+            del owners
+        self.put_ids(ids, src.remove_ids(ids))
+
+"""
+Shard whose kvstore is a CompactKVStore over a KeyTable shared with the other
+shards of the load balancer. It stores a key in a few dozen bytes instead of a
+dict entry and a string object, and moves keys to another shard of the same
+table by rewriting their owner column.
+"""
+class CompactShard(Shard):
+    def __init__(self, server_name, table):
+        self.server_name = server_name          # Name of the server
+        self.kvstore = CompactKVStore(table)    # internal kvstore
+
+    # Increments count of key k by value v, interning k with hash h if given
+    def put(self, k, v, h=None):
+        return self.kvstore.put_id(self.kvstore.table.intern(k, h), v)
+
+    # Increments the count of each (distinct) keys[i] by values[i] and returns
+    # the positions i of the keys that were not in the shard before. hashes[i],
+    # if given, is the hash of keys[i], cached instead of hashing new keys again
+    def put_many(self, keys, values, hashes=None):
+        return self.kvstore.put_ids(self.kvstore.table.intern_many(keys, hashes), values)
+
+    # Moves the (distinct) keys with their counts out of kvstore into this shard
+    def take(self, kvstore, keys):
+        if isinstance(kvstore, CompactKVStore) and kvstore.table is self.kvstore.table:
+            ids = kvstore.table.lookup_many(keys)
+            if np is not None and (ids == -1).any() or np is None and -1 in ids:
+                raise KeyError([key for key, i in zip(keys, ids) if i == -1][0])
+            self.kvstore.move_ids(kvstore, ids)
+        else:
+            super().take(kvstore, keys)
+
+    # Returns the keys mutated since the last call
+    def take_journal(self):
+        if not isinstance(self.kvstore, CompactKVStore):
+            return super().take_journal()
+        self.kvstore.compact_journal()
+        journal, self.kvstore.journal = self.kvstore.journal, array('I')
+        return set(self.kvstore.table.keys_of(journal))
@@ -1,24 +1,63 @@
 from shard import Shard 
+from remote_shard import snapshot_shards
+from array import array
+from collections import Counter, defaultdict, deque
+from hashing import get_hash_fn
 import errors
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Monitors the state of the keys and checks the validity of the shard states
+# With incremental=True, checks after the first one only look at the keys the
+# shards journaled or that were put since the previous check, falling back to
+# a full scan whenever a shard does not keep a journal
+# With relaxed=True, check_placement accepts keys still waiting on the shard a
+# migration in flight (see migration.py) has yet to move them from
 class StateMonitor:
-    def __init__(self):
+    def __init__(self, incremental=True, relaxed=False):
         self.previous = None   # Previous information about which keys belong to which shards
         self.key_tracking = {} # Tracks the correct key access count
         self.failed = False    # Whether the load balancer has failed or not based on state violations
         self.moveCounter = {}  # Counts the number of times a key has moved
         self.key_history = {}  # History of key to help track key movement
         self.num_shards = 0    # Number of shards currently managing
+        self.incremental = incremental
+        self.put_keys = set()  # Keys put since the previous check
+        self.shard_refs = {}   # Shard objects seen at the previous check
+        self.relaxed = relaxed # Whether keys may lag behind a membership change
 
     """Puts the key in to track key access count for later comparison"""
     def put(self, key):
         self.key_tracking[key] = self.key_tracking.get(key, 0) + 1
         if key not in self.key_history:
             self.key_history[key] = []
+        self.put_keys.add(key)
+
+    """Puts a batch of keys in to track their access counts"""
+    def put_many(self, keys):
+        for key, count in Counter(keys).items():
+            self.key_tracking[key] = self.key_tracking.get(key, 0) + count
+            if key not in self.key_history:
+                self.key_history[key] = []
+        self.put_keys.update(keys)
 
-    """Checks the validity of the current state of shards"""
+    """Checks the validity of the current state of shards, shards in worker processes through their snapshot"""
     def check_valid(self, shards, debug=False):
+        shards = snapshot_shards(shards)
+        journals = {shard: getattr(shards[shard], 'take_journal', lambda: None)() for shard in shards}
+        if self.previous is None or not self.incremental or None in journals.values():
+            self.check_all(shards, debug)
+        else:
+            self.check_touched(shards, journals, debug)
+        self.shard_refs = dict(shards)
+        self.put_keys = set()
+        self.num_shards = len(shards)
+
+    """Checks every key in every shard"""
+    def check_all(self, shards, debug=False):
         # process shards
         tracking = {}
         seen = set()
@@ -71,18 +110,137 @@ class StateMonitor:
                 for shard in shards:
                     print(shard, shards[shard].kvstore)
             raise errors.KeyLostInTransitionError("keys {} not found on any shard".format(diff))
-        self.num_shards = len(shards)
+
+    """Checks only the keys touched since the previous check, given the journal of every shard"""
+    def check_touched(self, shards, journals, debug=False):
+        touched, journaled_in = self.touched_keys(shards, journals)
+        if len(touched) * 2 > len(self.previous):
+            # most keys changed, a full scan is cheaper
+            return self.check_all(shards, debug)
+
+        moved = 0
+        added = 0
+        lost = set()
+        for key in touched:
+            # the key can only be where it was at the previous check or where it was journaled
+            prev = self.previous.get(key)
+            candidates = set(journaled_in.get(key, ()))
+            if prev in shards:
+                candidates.add(prev)
+            owners = [shard for shard in candidates if key in shards[shard].kvstore]
+            expected = self.key_tracking.get(key)
+
+            # Makes sure that keys only exist in one shard at a time
+            if len(owners) > 1:
+                self.fail(shards, debug)
+                kv = shards[owners[1]].kvstore
+                history = self.key_history.setdefault(key, [])
+                history.append((owners[0], shards[owners[0]].kvstore[key]))
+                history.append((owners[1], kv[key]))
+                raise errors.KeyPresentInMultipleShardsError("Found key '{}' in {} with count {} when already in {} with count {}\nhistory: {}".format(key, owners[1], kv[key], owners[0], shards[owners[0]].kvstore[key], history))
+
+            # Makes sure that we still have the key
+            if not owners:
+                if expected:
+                    lost.add(key)
+                self.previous.pop(key, None)
+                continue
+
+            # Makes sure that the value for the key matches the internal tracking
+            owner = owners[0]
+            count = shards[owner].kvstore[key]
+            if count != expected:
+                self.fail(shards, debug)
+                history = self.key_history.setdefault(key, [])
+                history.append((prev, expected))
+                history.append((owner, count))
+                raise errors.ValueLostInTransitionError("The count was lost when moving key '{}' from {} to {}. Expected count {}, got count {}.\nhistory: {}".format(key, prev, owner, expected, count, history))
+
+            # Keeps track of movement/key additions since previous check
+            if prev is None:
+                added += 1
+            elif prev != owner:
+                self.key_history[key].append((prev, expected))
+                self.moveCounter[key] = self.moveCounter.get(key, 0) + 1
+                moved += 1
+            self.previous[key] = owner
+
+        if (debug): print("Since previous check, moved {} keys and added {} keys".format(moved, added))
+        if lost:
+            self.fail(shards, debug)
+            raise errors.KeyLostInTransitionError("keys {} not found on any shard".format(lost))
+
+    """Returns the keys touched since the previous check and, for each, the shards that journaled it"""
+    def touched_keys(self, shards, journals):
+        touched = set(self.put_keys)
+        journaled_in = defaultdict(list) # key -> shards whose journal has it
+        for shard, journal in journals.items():
+            if self.shard_refs.get(shard) is not shards[shard]:
+                # new shard: everything it holds arrived since the previous check
+                journal = journal | set(shards[shard].kvstore)
+            touched |= journal
+            for key in journal:
+                journaled_in[key].append(shard)
+        for shard, old in self.shard_refs.items():
+            if shards.get(shard) is not old:
+                # removed shard: its keys either are still in it or were journaled when they left
+                touched |= old.take_journal() or set()
+                touched.update(old.kvstore)
+        return touched, journaled_in
+
+    """Checks that every key is on the shard the routing of load_balancer sends it to or, when
+    relaxed, on the shard a migration in flight has yet to move it from; load balancers
+    without a RoutingSnapshot are not checked"""
+    def check_placement(self, load_balancer, debug=False):
+        if not load_balancer.shards:
+            return
+        try:
+            routing = load_balancer.routing()
+        except NotImplementedError:
+            return
+        shards = snapshot_shards(load_balancer.shards)
+        migrations = load_balancer.migrations if self.relaxed else []
+        for shard in shards:
+            keys = list(shards[shard].kvstore.keys())
+            if not keys:
+                continue
+            hashes = routing.hash_fn.many(keys)
+            for key, val, owner in zip(keys, hashes, routing.route_many(keys, hashes)):
+                if owner == shard or any(migration.holder(key, int(val)) == shard for migration in migrations):
+                    continue
+                self.fail(shards, debug)
+                raise errors.KeyMisplacedError("Found key '{}' in {} when it routes to {}".format(key, shard, owner))
+
+    """Marks the run as failed, printing every shard in debug mode"""
+    def fail(self, shards, debug):
+        self.failed = True
+        if debug:
+            for shard in shards:
+                print(shard, shards[shard].kvstore)
+
+    """Returns the number of keys put so far"""
+    def num_keys(self):
+        return len(self.key_tracking)
+
+    """Returns how many keys moved and how many moves they made in total"""
+    def count_moves(self, debug=False):
+        total_moved = 0
+        for key in self.moveCounter:
+            if (debug): print('moved \'{}\' {} times'.format(key, self.moveCounter[key]))
+            total_moved += self.moveCounter[key]
+        return len(self.moveCounter), total_moved
 
     """Returns the statistics for the run"""
     def get_stats(self, shards, debug=False):
         minimum = float('inf')
         maximum = 0
-        total = len(self.key_tracking)
         nums = []
         print('\n--------------- stats ---------------')
         if self.failed:
             print("FAIL: Failed to complete workload without errors")
         
+        total = self.num_keys()
+
         # Gets statistics from shards
         for shard in shards:
             curr = len(shards[shard].kvstore)
@@ -94,22 +252,312 @@ class StateMonitor:
             if (debug): print("{} has {} keys".format(shard, curr))
 
         # Counts the total number of keys moved
-        total_moved = 0
-        for key in self.moveCounter:
-            if (debug): print('moved \'{}\' {} times'.format(key, self.moveCounter[key]))
-            total_moved += self.moveCounter[key]
-        print("moved {} keys out of {} keys a total of {} times".format(len(self.moveCounter), len(self.key_tracking), total_moved))
+        moved_keys, total_moved = self.count_moves(debug)
+        print("moved {} keys out of {} keys a total of {} times".format(moved_keys, total, total_moved))
 
         # Gets mean and variance
         mean = total / len(shards)
         variance = sum((i - mean) ** 2 for i in nums) / len(nums)
         
-        print("minimum: {} \nmaximum: {} \nmean: {} \nvariance: {}".format(minimum, maximum, mean, variance))
+        # Gets how far the most loaded shard is above the mean
+        load_ratio = maximum / mean if mean else 0
+
+        print("minimum: {} \nmaximum: {} \nmean: {} \nvariance: {} \nmax/mean load: {}".format(minimum, maximum, mean, variance, load_ratio))
         return {"num_keys": total, 
                 "key_movement": total_moved, 
                 "minimum": minimum, 
                 "maximum": maximum, 
                 "mean": mean, 
                 "variance": variance, 
+                "load_ratio": load_ratio, 
                 "num_shards": self.num_shards} 
-                
\ No newline at end of file
+                
+
+"""
+StateMonitor for workloads too large to track by key name. Every key is
+identified by a 64-bit fingerprint and given a dense id, and key_tracking,
+previous and moveCounter are typed arrays indexed by that id: the expected
+count, the index of the shard owning the key at the previous check (-1 for
+none) and the number of moves. With NumPy, fingerprints are looked up in a
+sorted array, with only recently added keys in a dict, which keeps the
+bookkeeping under 50 bytes per key. Keys put since the previous check are
+flagged in a byte column rather than kept by name: a put changes the shard it
+lands on, whose journal names the key, so a flagged key no journal names sends
+the check to a full scan. History is only recorded for keys
+involved in a violation, in a deque of the last history_size events. Two keys
+with the same fingerprint would be tracked as one, which at 10M keys has a
+chance of about 3e-6.
+"""
+class CompactStateMonitor(StateMonitor):
+    def __init__(self, incremental=True, history_size=1024, fingerprint='fnv1a64', relaxed=False):
+        super().__init__(incremental, relaxed)
+        self.fingerprint = get_hash_fn(fingerprint)
+        self.ids = {}                   # fingerprint -> key id, for keys not in sorted_fps yet
+        self.key_fps = array('Q')       # key id -> fingerprint
+        self.key_tracking = array('q')  # key id -> expected access count
+        self.moveCounter = array('I')   # key id -> number of times the key moved
+        self.put_flags = array('B')     # key id -> 1 if the key was put since the previous check
+        self.key_history = deque(maxlen=history_size) # (key, shard, count) events of violations
+        self.shard_ids = {}             # shard name -> shard index used in previous
+        self.shard_names = []           # shard index -> shard name
+        if np is not None:
+            self.sorted_fps = np.empty(0, dtype=np.uint64) # fingerprints of the other keys, sorted
+            self.sorted_ids = np.empty(0, dtype=np.uint32) # key id of each of sorted_fps
+
+    """Puts the key in to track key access count for later comparison"""
+    def put(self, key):
+        i = self.key_id(self.fingerprint(key))
+        self.key_tracking[i] += 1
+        self.put_flags[i] = 1
+        self.merge_ids()
+
+    """Puts a batch of keys in to track their access counts"""
+    def put_many(self, keys):
+        counted = Counter(keys)
+        fps = self.fingerprint.many(list(counted))
+        ids = self.lookup_fps(fps)
+        new = np.flatnonzero(ids == -1).tolist() if np is not None else [pos for pos, i in enumerate(ids) if i == -1]
+        for pos in new:
+            ids[pos] = self.new_id(int(fps[pos]))
+        if np is not None:
+            np.add.at(np.frombuffer(self.key_tracking, dtype=np.int64), ids, np.fromiter(counted.values(), dtype=np.int64, count=len(counted)))
+            np.frombuffer(self.put_flags, dtype=np.uint8)[ids] = 1
+        else:
+            for i, count in zip(ids, counted.values()):
+                self.key_tracking[i] += count
+                self.put_flags[i] = 1
+        self.merge_ids()
+
+    """Returns the id of the key with fingerprint fp, assigning one if it is new"""
+    def key_id(self, fp):
+        if np is not None and len(self.sorted_fps):
+            pos = int(np.searchsorted(self.sorted_fps, np.uint64(fp)))
+            if pos < len(self.sorted_fps) and self.sorted_fps[pos] == fp:
+                return int(self.sorted_ids[pos])
+        return self.new_id(fp)
+
+    """Returns the id of the key with fingerprint fp, given it is not in sorted_fps"""
+    def new_id(self, fp):
+        i = self.ids.get(fp)
+        if i is None:
+            i = self.ids[fp] = len(self.key_fps)
+            self.key_fps.append(fp)
+            self.key_tracking.append(0)
+            self.moveCounter.append(0)
+            self.put_flags.append(0)
+            if self.previous is not None:
+                self.previous.append(-1)
+        return i
+
+    """Checks the validity of the current state of shards and clears the put flags"""
+    def check_valid(self, shards, debug=False):
+        super().check_valid(shards, debug)
+        if np is not None:
+            np.frombuffer(self.put_flags, dtype=np.uint8)[:] = 0
+        else:
+            self.put_flags = array('B', bytes(len(self.put_flags)))
+
+    """Returns whether a key put since the previous check is not among the key ids"""
+    def missed_puts(self, ids):
+        if np is not None:
+            flags = np.frombuffer(self.put_flags, dtype=np.uint8)
+            ids = np.unique(ids[ids != -1])
+            return int(np.count_nonzero(flags)) != int(np.count_nonzero(flags[ids]))
+        ids = set(ids)
+        return any(flag and i not in ids for i, flag in enumerate(self.put_flags))
+
+    """Returns the id of each fingerprint, -1 for keys that were never put"""
+    def lookup_fps(self, fps):
+        if np is None:
+            return [self.ids.get(fp, -1) for fp in fps]
+        ids = np.full(len(fps), -1, dtype=np.int64)
+        if len(self.sorted_fps):
+            pos = np.minimum(np.searchsorted(self.sorted_fps, fps), len(self.sorted_fps) - 1)
+            hit = self.sorted_fps[pos] == fps
+            ids[hit] = self.sorted_ids[pos[hit]]
+        if self.ids:
+            miss = np.flatnonzero(ids == -1)
+            ids[miss] = [self.ids.get(fp, -1) for fp in fps[miss].tolist()]
+        return ids
+
+    """Returns the id of each key, -1 for keys that were never put"""
+    def lookup_ids(self, keys):
+        return self.lookup_fps(self.fingerprint.many(keys))
+
+    """Moves the recently added keys into the sorted arrays once they are an eighth of them"""
+    def merge_ids(self):
+        if np is None or len(self.ids) * 8 <= len(self.sorted_fps):
+            return
+        fps = np.frombuffer(self.key_fps, dtype=np.uint64)
+        order = np.argsort(fps, kind='stable')
+        self.sorted_fps = fps[order]
+        self.sorted_ids = order.astype(np.uint32)
+        self.ids = {}
+
+    """Returns the index of a shard name in shard_names"""
+    def shard_id(self, shard):
+        sid = self.shard_ids.get(shard)
+        if sid is None:
+            sid = self.shard_ids[shard] = len(self.shard_names)
+            self.shard_names.append(shard)
+        return sid
+
+    """Returns the name of the shard owning key id i at the previous check, None if none did"""
+    def previous_owner(self, i):
+        if i == -1 or self.previous is None or self.previous[i] == -1:
+            return None
+        return self.shard_names[self.previous[i]]
+
+    """Checks every key in every shard"""
+    def check_all(self, shards, debug=False):
+        current = array('i', [-1]) * len(self.key_fps) # key id -> shard index at this check
+        seen = 0
+
+        # Makes sure that keys only exist in one shard at a time and that
+        # the value for each key matches the internal tracking
+        for shard in shards:
+            sid = self.shard_id(shard)
+            kv = shards[shard].kvstore
+            keys = list(kv)
+            ids = self.lookup_ids(keys)
+            if np is not None and len(keys):
+                owners = np.frombuffer(current, dtype=np.int32)
+                counts = np.fromiter(kv.values(), dtype=np.int64, count=len(keys))
+                bad = (ids == -1) | (owners[ids] != -1) | (np.frombuffer(self.key_tracking, dtype=np.int64)[ids] != counts)
+                for pos in np.flatnonzero(bad)[:1].tolist():
+                    self.check_key(shards, keys[pos], int(ids[pos]), shard, current, debug)
+                owners[ids] = sid
+                del owners
+            else:
+                for key, i in zip(keys, ids):
+                    self.check_key(shards, key, i, shard, current, debug)
+                    current[i] = sid
+            seen += len(keys)
+
+        # Keeps track of movement/key additions since previous check
+        if self.previous is not None:
+            moved, added = self.count_changes(self.previous, current)
+            if (debug): print("Since previous check, moved {} keys and added {} keys".format(moved, added))
+        self.previous = current
+
+        # Makes sure that we still have all the keys.
+        if seen < len(current):
+            lost = [i for i, sid in enumerate(current) if sid == -1]
+            self.fail(shards, debug)
+            raise errors.KeyLostInTransitionError("keys with fingerprints {} not found on any shard".format(
+                ['{:#018x}'.format(self.key_fps[i]) for i in lost]))
+
+    """Raises if key, with id i and found in shard, is a duplicate or has the wrong count"""
+    def check_key(self, shards, key, i, shard, current, debug):
+        count = shards[shard].kvstore[key]
+        if i == -1:
+            self.value_lost(shards, key, None, shard, None, count, debug)
+        if current[i] != -1:
+            self.duplicate(shards, key, self.shard_names[current[i]], shard, debug)
+        if count != self.key_tracking[i]:
+            self.value_lost(shards, key, self.previous_owner(i), shard, self.key_tracking[i], count, debug)
+
+    """Counts the keys that moved or appeared between two owner columns, adding moves to moveCounter"""
+    def count_changes(self, old, new):
+        if np is not None and len(new):
+            old_owners = np.frombuffer(old, dtype=np.int32)
+            new_owners = np.frombuffer(new, dtype=np.int32)
+            moved = (old_owners != -1) & (new_owners != -1) & (old_owners != new_owners)
+            np.frombuffer(self.moveCounter, dtype=np.uint32)[moved] += 1
+            return int(moved.sum()), int(((old_owners == -1) & (new_owners != -1)).sum())
+        moved = added = 0
+        for i, (before, after) in enumerate(zip(old, new)):
+            if before == -1:
+                added += after != -1
+            elif after != -1 and after != before:
+                self.moveCounter[i] += 1
+                moved += 1
+        return moved, added
+
+    """Checks only the keys touched since the previous check, given the journal of every shard"""
+    def check_touched(self, shards, journals, debug=False):
+        touched, journaled_in = self.touched_keys(shards, journals)
+        if len(touched) * 2 > len(self.key_fps):
+            # most keys changed, a full scan is cheaper
+            return self.check_all(shards, debug)
+
+        moved = 0
+        added = 0
+        lost = set()
+        keys = list(touched)
+        ids = self.lookup_ids(keys)
+        if self.missed_puts(ids):
+            # every put is journaled by the shard it changed: a full scan finds where this one went
+            return self.check_all(shards, debug)
+        for key, i in zip(keys, ids.tolist() if np is not None else ids):
+            # the key can only be where it was at the previous check or where it was journaled
+            prev = self.previous_owner(i)
+            candidates = set(journaled_in.get(key, ()))
+            if prev in shards:
+                candidates.add(prev)
+            owners = [shard for shard in candidates if key in shards[shard].kvstore]
+            expected = None if i == -1 else self.key_tracking[i]
+
+            # Makes sure that keys only exist in one shard at a time
+            if len(owners) > 1:
+                self.duplicate(shards, key, owners[0], owners[1], debug)
+
+            # Makes sure that we still have the key
+            if not owners:
+                if expected:
+                    lost.add(key)
+                    self.previous[i] = -1
+                continue
+
+            # Makes sure that the value for the key matches the internal tracking
+            owner = owners[0]
+            count = shards[owner].kvstore[key]
+            if count != expected:
+                self.value_lost(shards, key, prev, owner, expected, count, debug)
+
+            # Keeps track of movement/key additions since previous check
+            if prev is None:
+                added += 1
+            elif prev != owner:
+                self.moveCounter[i] += 1
+                moved += 1
+            self.previous[i] = self.shard_id(owner)
+
+        if (debug): print("Since previous check, moved {} keys and added {} keys".format(moved, added))
+        if lost:
+            self.fail(shards, debug)
+            raise errors.KeyLostInTransitionError("keys {} not found on any shard".format(lost))
+
+    """Records the history of a key found in two shards and raises"""
+    def duplicate(self, shards, key, first, second, debug):
+        self.fail(shards, debug)
+        first_count = shards[first].kvstore[key]
+        second_count = shards[second].kvstore[key]
+        history = self.record(key, (first, first_count), (second, second_count))
+        raise errors.KeyPresentInMultipleShardsError("Found key '{}' in {} with count {} when already in {} with count {}\nhistory: {}".format(key, second, second_count, first, first_count, history))
+
+    """Records the history of a key whose count is wrong and raises"""
+    def value_lost(self, shards, key, prev, owner, expected, count, debug):
+        self.fail(shards, debug)
+        history = self.record(key, (prev, expected), (owner, count))
+        raise errors.ValueLostInTransitionError("The count was lost when moving key '{}' from {} to {}. Expected count {}, got count {}.\nhistory: {}".format(key, prev, owner, expected, count, history))
+
+    """Appends (shard, count) events for key to the bounded history and returns the ones still kept for it"""
+    def record(self, key, *events):
+        self.key_history.extend((key, shard, count) for shard, count in events)
+        return [(shard, count) for k, shard, count in self.key_history if k == key]
+
+    """Returns the number of keys put so far"""
+    def num_keys(self):
+        return len(self.key_fps)
+
+    """Returns how many keys moved and how many moves they made in total"""
+    def count_moves(self, debug=False):
+        if debug:
+            for i, moves in enumerate(self.moveCounter):
+                if moves:
+                    print('moved key with fingerprint {:#018x} {} times'.format(self.key_fps[i], moves))
+        if np is not None:
+            moves = np.frombuffer(self.moveCounter, dtype=np.uint32)
+            return int(np.count_nonzero(moves)), int(moves.sum(dtype=np.int64))
+        return sum(1 for moves in self.moveCounter if moves), sum(self.moveCounter)
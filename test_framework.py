@@ -1,6 +1,10 @@
-from state_monitor import StateMonitor
+from state_monitor import StateMonitor, CompactStateMonitor
 from errors import Error
+from shard import CompactShard
+from remote_shard import RemoteShard
+from hashing import HASH_FUNCTIONS, DEFAULT_HASH
 import argparse
+from LoadBalancers.load_balancer import LoadBalancer
 from LoadBalancers.load_balancer_broken import BrokenLoadBalancer
 from LoadBalancers.load_balancer_useless import UselessLoadBalancer
 from LoadBalancers.load_balancer_simple import SimpleLoadBalancer
@@ -8,6 +12,10 @@ from LoadBalancers.load_balancer_hash_key import HashKeyLoadBalancer
 from LoadBalancers.load_balancer_hash_shard_once import HashShardLoadBalancer
 from LoadBalancers.load_balancer_hash_shard_mult import ConsistentHashingLoadBalancer
 from LoadBalancers.load_balancer_table_indirection import TableIndirection
+from LoadBalancers.load_balancer_jump import JumpHashLoadBalancer
+from LoadBalancers.load_balancer_rendezvous import RendezvousLoadBalancer
+from LoadBalancers.load_balancer_maglev import MaglevLoadBalancer
+from LoadBalancers.load_balancer_bounded_loads import BoundedLoadsLoadBalancer
 
 import inspect
 import tqdm
@@ -23,77 +31,135 @@ def new_print(*args, **kwargs):
 # globaly replace print with new_print
 inspect.builtins.print = new_print
 
-# Used for tqdm
-import mmap
-def get_num_lines(file_path):
-    fp = open(file_path, "r+")
-    buf = mmap.mmap(fp.fileno(), 0)
-    lines = 0
-    while buf.readline():
-        lines += 1
-    return lines
-
-# Runs the implemented load_balancer against the workload
-def run_test(load_balancer, workload, debug):
-    sm = StateMonitor()
+import contextlib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from workload import open_workload
+
+# Maximum number of consecutive puts handed to put_many at once
+PUT_BATCH_SIZE = 8192
+
+# Monitor used to validate runs, CompactStateMonitor for very large workloads
+STATE_MONITOR = StateMonitor
+
+# Whether runs of consecutive creates, or of consecutive removes, go to the load
+# balancer as one add_shards or remove_shards, validated before and after the run
+BATCH_MEMBERSHIP = False
+
+# Keys migrated per key put after a create or remove, None to move every key
+# before the next operation; load balancers that cannot plan migrations
+# always move them right away
+MIGRATE_RATE = None
+
+# Whether every check also makes sure keys are on the shard the load balancer
+# routes them to (or, during a migration, on the shard it has yet to move them from)
+CHECK_PLACEMENT = False
+
+# Half-life in puts of the heat TableIndirection keeps, None to count every put
+HALF_LIFE = None
+
+# Yields the replayed operations with every run of consecutive creates, or of
+# consecutive removes, merged into one (command, [shard_names], None)
+def coalesce_membership(replay):
+    run = None
+    for command, arg, hashes in replay:
+        if run is not None and command == run[0]:
+            run[1].append(arg)
+            continue
+        if run is not None:
+            yield run
+            run = None
+        if command in ('create', 'remove'):
+            run = (command, [arg], None)
+        else:
+            yield command, arg, hashes
+    if run is not None:
+        yield run
+
+# Runs the implemented load_balancer against the workload, with the progress
+# bar labelled desc on line position of the terminal if given
+def run_test(load_balancer, workload, debug, desc=None, position=None):
+    sm = STATE_MONITOR(relaxed=MIGRATE_RATE is not None or load_balancer.sweep_rate is not None)
     create_count = 0 # Keeps track of how many creates went through
     remove_count = 0 # Keeps track of how many removes went through
-    with open(workload) as f:
+
+    with open_workload(workload) as ops, tqdm.tqdm(total=ops.num_ops, desc=desc, position=position) as progress:
         # returns (None, sm.failed) if there are any errors
-        # otherwise runs through the workload
-        for line in tqdm.tqdm(f, total=get_num_lines(workload)):
-            
-            # Parse command
-            command, arg = line.split()
+        # otherwise runs through the workload, with runs of consecutive puts in batches
+        replay = ops.replay(PUT_BATCH_SIZE, load_balancer.hash_fn.name)
+        if BATCH_MEMBERSHIP:
+            replay = coalesce_membership(replay)
+        for command, arg, hashes in replay:
+
+            if command == 'put':
+                if hashes is None:
+                    load_balancer.put_many(arg)
+                else:
+                    load_balancer.put_many(arg, hashes)
+                sm.put_many(arg)
+                progress.update(len(arg))
+                continue
+
+            shard_names = arg if BATCH_MEMBERSHIP else [arg]
+            progress.update(len(shard_names))
 
             if command == 'create':
 
-                if debug: print('\n{} {}'.format(command, arg))
+                if debug: print('\n{} {}'.format(command, ' '.join(shard_names)))
 
                 try:
-                    check_valid(sm, load_balancer.shards, debug)
+                    check_valid(sm, load_balancer, debug)
                 except Error as e:
                     print('\nbefore create {}\n{}'.format(create_count, e))
                     return None, sm.failed
 
-                load_balancer.add_shard(arg)
+                plan = load_balancer.plan_add_shards(shard_names) if MIGRATE_RATE is not None else None
+                if plan is not None:
+                    load_balancer.start_migration(plan, MIGRATE_RATE)
+                elif BATCH_MEMBERSHIP:
+                    load_balancer.add_shards(shard_names)
+                else:
+                    load_balancer.add_shard(arg)
 
                 try:
-                    check_valid(sm, load_balancer.shards, debug)
+                    check_valid(sm, load_balancer, debug)
                 except Error as e:
                     print('\nafter create {}\n{}'.format(create_count, e))
                     return None, sm.failed
 
-                create_count += 1
+                create_count += len(shard_names)
 
             elif command == 'remove':
 
-                if debug: print('\n{} {}'.format(command, arg))
+                if debug: print('\n{} {}'.format(command, ' '.join(shard_names)))
 
                 try:
-                    check_valid(sm, load_balancer.shards, debug)
+                    check_valid(sm, load_balancer, debug)
                 except Error as e:
                     print('\nbefore remove {}\n{}'.format(create_count, e))
                     return None, sm.failed
 
-                load_balancer.remove_shard(arg)
+                plan = load_balancer.plan_remove_shards(shard_names) if MIGRATE_RATE is not None else None
+                if plan is not None:
+                    load_balancer.start_migration(plan, MIGRATE_RATE)
+                elif BATCH_MEMBERSHIP:
+                    load_balancer.remove_shards(shard_names)
+                else:
+                    load_balancer.remove_shard(arg)
 
                 try:
-                    check_valid(sm, load_balancer.shards, debug)
+                    check_valid(sm, load_balancer, debug)
                 except Error as e:
                     print('\nafter remove {}\n{}'.format(create_count, e))
                     return None, sm.failed
 
-                remove_count += 1
-
-            elif command == 'put':
-
-                load_balancer.put(arg)
-                sm.put(arg)
+                remove_count += len(shard_names)
 
         # Final check 
+        load_balancer.finish_migration()
         try:
-            check_valid(sm, load_balancer.shards, debug)
+            check_valid(sm, load_balancer, debug)
         except Error as e:
             print('\nat the end\n{}'.format(e))
             return None, sm.failed
@@ -101,64 +167,166 @@ def run_test(load_balancer, workload, debug):
         stats = sm.get_stats(load_balancer.shards, debug)
         return stats, sm.failed
 
-"""Checks validity using StateManager sm"""
-def check_valid(sm, shards, debug):
-    sm.check_valid(shards, debug)
-
-def part0(workload, debug, stats, max_score=0):
+# Load balancer tested by each part
+PARTS = {0: BrokenLoadBalancer, 1: SimpleLoadBalancer, 2: HashKeyLoadBalancer, 3: HashShardLoadBalancer,
+         4: ConsistentHashingLoadBalancer, 5: TableIndirection, 6: JumpHashLoadBalancer,
+         7: RendezvousLoadBalancer, 8: MaglevLoadBalancer, 9: BoundedLoadsLoadBalancer}
+
+# part -> future of the (stats, fail) of a part already started with --jobs
+results = {}
+
+# Returns the (stats, fail) of the part, from the worker pool if it ran there
+# after printing what it printed
+def run_part_test(part, load_balancer, workload, debug):
+    if part in results:
+        stats, fail, output = results.pop(part).result()
+        print(output, end='')
+        return stats, fail
+    return run_test(load_balancer, workload, debug)
+
+# Returns the load balancer a part tests, with the heat half-life for part 5
+def new_load_balancer(part, hash_fn):
+    if PARTS[part] is TableIndirection:
+        return TableIndirection(hash_fn, halfLife=HALF_LIFE)
+    return PARTS[part](hash_fn)
+
+# Sets up a worker process like the parent was set up by the command line options
+def init_worker(state_monitor, batch_membership, migrate_rate, check_placement, shard_class, num_workers, sweep_rate, half_life, lock):
+    global STATE_MONITOR, BATCH_MEMBERSHIP, MIGRATE_RATE, CHECK_PLACEMENT, HALF_LIFE
+    STATE_MONITOR = state_monitor
+    BATCH_MEMBERSHIP = batch_membership
+    MIGRATE_RATE = migrate_rate
+    CHECK_PLACEMENT = check_placement
+    LoadBalancer.shard_class = shard_class
+    LoadBalancer.num_workers = num_workers
+    LoadBalancer.sweep_rate = sweep_rate
+    HALF_LIFE = half_life
+    tqdm.tqdm.set_lock(lock)
+
+# Runs the test of one part in a worker process and returns its (stats, fail)
+# with what it printed, for the parent to print under the header of the part
+def run_part(part, workload, debug, hash_fn, position):
+    with io.StringIO() as output:
+        with contextlib.redirect_stdout(output):
+            stats, fail = run_test(new_load_balancer(part, hash_fn), workload, debug, 'part {}'.format(part), position)
+        return stats, fail, output.getvalue()
+
+# Starts the tests of the parts (part -> workload) in a pool of jobs processes,
+# leaving their results for run_part_test. Scoring stays in this process, where
+# parts are compared with each other in order
+def start_parts(part_workloads, debug, hash_fn, jobs):
+    pool = ProcessPoolExecutor(jobs, initializer=init_worker,
+                               initargs=(STATE_MONITOR, BATCH_MEMBERSHIP, MIGRATE_RATE, CHECK_PLACEMENT, LoadBalancer.shard_class, LoadBalancer.num_workers, LoadBalancer.sweep_rate, HALF_LIFE, tqdm.tqdm.get_lock()))
+    for position, (part, workload) in enumerate(part_workloads.items()):
+        results[part] = pool.submit(run_part, part, workload, debug, hash_fn, position)
+    return pool
+
+"""Checks validity of the shards of load_balancer using StateManager sm"""
+def check_valid(sm, load_balancer, debug):
+    sm.check_valid(load_balancer.shards, debug)
+    if CHECK_PLACEMENT:
+        sm.check_placement(load_balancer, debug)
+
+def part0(workload, debug, stats, max_score=0, hash_fn=None):
     print('------------------------- testing part 0 -----------------------------------')
-    load_balancer = BrokenLoadBalancer()
-    s, fail = run_test(load_balancer, workload, debug)
+    load_balancer = BrokenLoadBalancer(hash_fn)
+    s, fail = run_part_test(0, load_balancer, workload, debug)
     stats[0] = s
     score = eval_results(stats, fail, max_score, 0, debug)
     print("score: {}/{}".format(score, max_score))
     return score
 
-def part1(workload, debug, stats, max_score=5):
+def part1(workload, debug, stats, max_score=5, hash_fn=None):
     print('------------------------- testing part 1 -----------------------------------')
-    load_balancer = SimpleLoadBalancer()
-    s, fail = run_test(load_balancer, workload, debug)
+    load_balancer = SimpleLoadBalancer(hash_fn)
+    s, fail = run_part_test(1, load_balancer, workload, debug)
     stats[1] = s
     score = eval_results(stats, fail, max_score, 1, debug)
     print("score: {}/{}".format(score, max_score))
     return score
 
-def part2(workload, debug, stats, max_score=10):
+def part2(workload, debug, stats, max_score=10, hash_fn=None):
     print('------------------------- testing part 2 -----------------------------------')
-    load_balancer = HashKeyLoadBalancer()
-    s, fail = run_test(load_balancer, workload, debug)
+    load_balancer = HashKeyLoadBalancer(hash_fn)
+    s, fail = run_part_test(2, load_balancer, workload, debug)
     stats[2] = s
     score = eval_results(stats, fail, max_score, 2, debug)
     print("score: {}/{}".format(score, max_score))
     return score
 
-def part3(workload, debug, stats, max_score=15):
+def part3(workload, debug, stats, max_score=15, hash_fn=None):
     print('------------------------- testing part 3 -----------------------------------')
-    load_balancer = HashShardLoadBalancer()
-    s, fail = run_test(load_balancer, workload, debug)
+    load_balancer = HashShardLoadBalancer(hash_fn)
+    s, fail = run_part_test(3, load_balancer, workload, debug)
     stats[3] = s
     score = eval_results(stats, fail, max_score, 3, debug)
     print("score: {}/{}".format(score, max_score))
     return score
 
-def part4(workload, debug, stats, max_score=20):
+def part4(workload, debug, stats, max_score=20, hash_fn=None):
     print('------------------------- testing part 4 -----------------------------------')
-    load_balancer = ConsistentHashingLoadBalancer()
-    s, fail = run_test(load_balancer, workload, debug)
+    load_balancer = ConsistentHashingLoadBalancer(hash_fn)
+    s, fail = run_part_test(4, load_balancer, workload, debug)
     stats[4] = s
     score = eval_results(stats, fail, max_score, 4, debug)
     print("score: {}/{}".format(score, max_score))
     return score
 
-def part5(workload, debug, stats, max_score=20):
+def part5(workload, debug, stats, max_score=20, hash_fn=None):
     print('------------------------- testing part 5 -----------------------------------')
-    load_balancer = TableIndirection()
-    s, fail = run_test(load_balancer, workload, debug)
+    load_balancer = new_load_balancer(5, hash_fn)
+    s, fail = run_part_test(5, load_balancer, workload, debug)
     stats[5] = s
     score = eval_results(stats, fail, max_score, 5, debug)
     print("score: {}/{}".format(score, max_score))
     return score
 
+def part6(workload, debug, stats, max_score=0, hash_fn=None):
+    print('------------------------- testing part 6 -----------------------------------')
+    load_balancer = JumpHashLoadBalancer(hash_fn)
+    s, fail = run_part_test(6, load_balancer, workload, debug)
+    stats[6] = s
+    score = eval_results(stats, fail, max_score, 6, debug)
+    print("score: {}/{}".format(score, max_score))
+    return score
+
+def part7(workload, debug, stats, max_score=0, hash_fn=None):
+    print('------------------------- testing part 7 -----------------------------------')
+    load_balancer = RendezvousLoadBalancer(hash_fn)
+    s, fail = run_part_test(7, load_balancer, workload, debug)
+    stats[7] = s
+    score = eval_results(stats, fail, max_score, 7, debug)
+    print("score: {}/{}".format(score, max_score))
+    return score
+
+def part8(workload, debug, stats, max_score=0, hash_fn=None):
+    print('------------------------- testing part 8 -----------------------------------')
+    load_balancer = MaglevLoadBalancer(hash_fn)
+    s, fail = run_part_test(8, load_balancer, workload, debug)
+    stats[8] = s
+    score = eval_results(stats, fail, max_score, 8, debug)
+    print("score: {}/{}".format(score, max_score))
+    return score
+
+def part9(workload, debug, stats, max_score=0, hash_fn=None):
+    print('------------------------- testing part 9 -----------------------------------')
+    load_balancer = BoundedLoadsLoadBalancer(hash_fn)
+    s, fail = run_part_test(9, load_balancer, workload, debug)
+    stats[9] = s
+    score = eval_results(stats, fail, max_score, 9, debug)
+    print("score: {}/{}".format(score, max_score))
+    return score
+
+# Parts past 5 are extra load balancers: they are not graded, only compared
+# against consistent hashing (part 4) when it ran in the same invocation
+EXTRA_PARTS = {6: 'jump consistent hashing', 7: 'rendezvous hashing', 8: 'maglev', 9: 'consistent hashing with bounded loads'}
+
+def compare_to_part4(stats, part):
+    if stats.get(4) is None:
+        return
+    for stat in ['key_movement', 'variance', 'load_ratio']:
+        print("{}: {} vs {} for consistent hashing (part 4)".format(stat, stats[part][stat], stats[4][stat]))
+
 def eval_results(stats, fail, max_score, part, debug):
     if fail:
         return 0
@@ -179,6 +347,8 @@ def eval_results(stats, fail, max_score, part, debug):
             key_move_3 = stats[3]['key_movement']
             if key_move_2 < key_move_3:
                 score *= 0.5
+    elif part in EXTRA_PARTS:
+        compare_to_part4(stats, part)
     elif part == 4:
         # Check that there's lower key movement than part 2
         if 2 in stats:
@@ -200,10 +370,24 @@ def eval_results(stats, fail, max_score, part, debug):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='parsing options for running tests')
     parser.add_argument('-p', metavar='part', type=str, 
-                        help='part in the lab [0..5]')
+                        help='part in the lab [0..5], or extra load balancers [6..9]')
     parser.add_argument('-w', metavar='workload', type=str, 
-                        help='workload to test this on [simple or default]', default='default')
+                        help='workload to test this on [simple or default], or the path of a text or compiled workload', default='default')
     parser.add_argument('--debug', help='prints checks on create and remove', action='store_true')
+    parser.add_argument('--hash', metavar='hash_fn', type=str, choices=sorted(HASH_FUNCTIONS),
+                        help='hash function the load balancers use {}'.format(sorted(HASH_FUNCTIONS)), default=DEFAULT_HASH)
+    parser.add_argument('--compact-monitor', help='tracks keys by fingerprint to validate very large workloads', action='store_true')
+    parser.add_argument('--compact-shards', help='stores the keys of the load balancers in array-backed CompactShards, about half the memory of the default Shards but several times slower', action='store_true')
+    parser.add_argument('--shard-workers', metavar='N', type=int, help='keeps the shards in N worker processes (RemoteShards)')
+    parser.add_argument('--batch-membership', help='applies runs of consecutive creates or removes as one batch (add_shards/remove_shards)', action='store_true')
+    parser.add_argument('--migrate-rate', metavar='R', type=float,
+                        help='migrates the keys of a create or remove in the background, R keys per key put, where the load balancer can plan it')
+    parser.add_argument('--lazy', metavar='R', type=float,
+                        help='creates and removes only change the routing and keys move when accessed, sweeping R keys per key put, where the load balancer can plan it')
+    parser.add_argument('--half-life', metavar='N', type=int,
+                        help='halves the heat TableIndirection keeps per bucket every N puts, instead of counting every put ever made')
+    parser.add_argument('--check-placement', help='also checks that keys are on the shard they route to', action='store_true')
+    parser.add_argument('--jobs', metavar='N', type=int, help='runs the parts in N processes at once, scoring them once all are done', default=1)
 
     workloads = {"default": "Workloads/test_workload.txt", 
                  "simple": "Workloads/simple_workload.txt"}
@@ -211,21 +395,37 @@ if __name__ == '__main__':
     parts = out.p.split(',') if out.p else None
     workload = out.w
     debug = out.debug
+    hash_fn = out.hash
+    if out.compact_monitor:
+        STATE_MONITOR = CompactStateMonitor
+    if out.batch_membership:
+        BATCH_MEMBERSHIP = True
+    MIGRATE_RATE = out.migrate_rate
+    LoadBalancer.sweep_rate = out.lazy
+    HALF_LIFE = out.half_life
+    CHECK_PLACEMENT = out.check_placement
+    if out.compact_shards and out.shard_workers:
+        parser.error('--compact-shards and --shard-workers pick different shard classes, pass only one')
+    if out.compact_shards:
+        LoadBalancer.shard_class = CompactShard
+    if out.shard_workers:
+        LoadBalancer.shard_class = RemoteShard
+        LoadBalancer.num_workers = out.shard_workers
 
     # print(part, workload, debug)
 
-    if parts != None and (set(parts) - set(['0','1','2','3','4','5'])):
-        print('There are only parts 0 to 5 inclusive')
+    if parts != None and (set(parts) - set(['0','1','2','3','4','5','6','7','8','9'])):
+        print('There are only parts 0 to 9 inclusive')
         exit()
 
-    if workload not in ['default', 'simple', 'amazon']:
-        print('There are only 3 valid workloads \'simple\', \'default\', or \'amazon\'') 
+    if workload not in ['default', 'simple', 'amazon'] and not os.path.isfile(workload):
+        print('There are only 3 valid workloads \'simple\', \'default\', or \'amazon\', or a workload file') 
         exit()
 
-    if parts == None and workload != 'simple':
+    if parts == None and workload in ['default', 'amazon']:
         workload = 'default'
 
-    workload = workloads[workload]
+    workload = workloads.get(workload, workload)
     total = 0    # total points
     current = 0  # current points
 
@@ -234,47 +434,70 @@ if __name__ == '__main__':
 
     stats = {}
 
+    # Part 5, and the extra parts run after it, replay the skewed workloads
+    skewed_workloads = {"default": "Workloads/test_skewed_workload.txt",
+                        "amazon": "Workloads/test_skewed_workload_amazon0312.txt"}
+
+    pool = None
+    if out.jobs > 1:
+        # starts the same parts on the same workloads as the sequence below
+        selected = [part for part in PARTS if (parts == None and 1 <= part <= 5) or (parts != None and str(part) in parts)]
+        part_workloads = {part: skewed_workloads.get(out.w, workload) if part >= 5 and 5 in selected else workload
+                          for part in selected}
+        pool = start_parts(part_workloads, debug, hash_fn, min(out.jobs, len(selected)))
+
     if parts != None and '0' in parts:
-        part0(workload, debug, stats)
+        part0(workload, debug, stats, hash_fn=hash_fn)
 
     if parts == None or '1' in parts:
         try:
             total += 5
-            current += part1(workload, debug, stats, 5)
+            current += part1(workload, debug, stats, 5, hash_fn)
         except NotImplementedError:
             print('part1 was not implemented')
 
     if parts == None or '2' in parts:
         try:
             total += 10
-            current += part2(workload, debug, stats, 10)
+            current += part2(workload, debug, stats, 10, hash_fn)
         except NotImplementedError:
             print('part2 was not implemented')
 
     if parts == None or '3' in parts:
         try:
             total += 15
-            current += part3(workload, debug, stats, 15)
+            current += part3(workload, debug, stats, 15, hash_fn)
         except NotImplementedError:
             print('part3 was not implemented')
 
     if parts == None or '4' in parts:
         try:
             total += 20
-            current += part4(workload, debug, stats, 20)
+            current += part4(workload, debug, stats, 20, hash_fn)
         except NotImplementedError:
             print('part4 was not implemented')
 
     if parts == None or '5' in parts:
         try:
             total += 20
-            workloads = {"default": "Workloads/test_skewed_workload.txt",  
-                         "amazon": "Workloads/test_skewed_workload_amazon0312.txt"}
-            workload = workloads[out.w]
-            current += part5(workload, debug, stats, 20)
+            workload = skewed_workloads.get(out.w, workload)
+            current += part5(workload, debug, stats, 20, hash_fn)
         except NotImplementedError:
             print('part5 was not implemented')
 
+    # Extra load balancers only run when asked for
+    if parts != None and '6' in parts:
+        part6(workload, debug, stats, hash_fn=hash_fn)
+    if parts != None and '7' in parts:
+        part7(workload, debug, stats, hash_fn=hash_fn)
+    if parts != None and '8' in parts:
+        part8(workload, debug, stats, hash_fn=hash_fn)
+    if parts != None and '9' in parts:
+        part9(workload, debug, stats, hash_fn=hash_fn)
+
+    if pool is not None:
+        pool.shutdown()
+
     print('---------------------------------------')
     if current == total == 0:
         score = 0.0
@@ -0,0 +1,19 @@
+import pytest
+
+from LoadBalancers.load_balancer_maglev import MaglevLoadBalancer
+
+
+@pytest.mark.parametrize('table_size', [16, 65536, 1, 0])
+def test_table_size_must_be_prime(table_size):
+    # a non-prime size leaves permutations that never reach a free slot
+    with pytest.raises(ValueError):
+        MaglevLoadBalancer(table_size=table_size)
+
+
+def test_prime_table_is_filled():
+    lb = MaglevLoadBalancer(table_size=17)
+    lb.add_shards(['server{}'.format(n) for n in range(6)])
+    assert sorted(set(lb.table)) == list(range(6))
+    lb.put_many(['key{}'.format(i) for i in range(100)])
+    lb.remove_shards(['server{}'.format(n) for n in range(6)])
+    assert not lb.shards
@@ -0,0 +1,52 @@
+from collections import Counter
+
+from LoadBalancers.load_balancer_hash_shard_mult import ConsistentHashingLoadBalancer
+from LoadBalancers.load_balancer_bounded_loads import BoundedLoadsLoadBalancer
+from shard import Shard
+
+KEYS = ['key{}'.format(i) for i in range(20000)]
+
+
+def misplaced(lb):
+    return [key for key in KEYS if key not in lb.shards[lb.ring.lookup(lb.hash_fn(key))].kvstore]
+
+
+def filled_lb():
+    lb = ConsistentHashingLoadBalancer(num_rounds=20)
+    lb.add_shard('server0')
+    lb.add_shard('server2')
+    lb.put_many(KEYS)
+    return lb
+
+
+def test_add_shards_with_colliding_tokens():
+    # 'server1' + '10' and 'server11' + '0' hash to the same token
+    lb = filled_lb()
+    lb.add_shards(['server1', 'server11'])
+    assert sum(len(shard.kvstore) for shard in lb.shards.values()) == len(KEYS)
+    assert misplaced(lb) == []
+
+
+def test_add_shards_matches_one_at_a_time():
+    batched, single = filled_lb(), filled_lb()
+    batched.add_shards(['server1', 'server11'])
+    single.add_shard('server1')
+    single.add_shard('server11')
+    for shard_name in batched.shards:
+        assert batched.shards[shard_name].kvstore == single.shards[shard_name].kvstore
+
+
+def test_bounded_add_shards_moves_each_key_once(monkeypatch):
+    lb = BoundedLoadsLoadBalancer()
+    for n in range(10):
+        lb.add_shard('server{}'.format(n))
+    for key in KEYS[:5000]:
+        lb.put(key)
+    moves = Counter()
+    take, store = Shard.take, BoundedLoadsLoadBalancer.store
+    monkeypatch.setattr(Shard, 'take', lambda self, kvstore, keys: moves.update(keys) or take(self, kvstore, keys))
+    monkeypatch.setattr(BoundedLoadsLoadBalancer, 'store', lambda self, key, *args: moves.update([key]) or store(self, key, *args))
+    lb.add_shards(['server{}'.format(n) for n in range(10, 14)])
+    assert moves and max(moves.values()) == 1
+    assert max(len(shard.kvstore) for shard in lb.shards.values()) <= lb.capacity()
+    assert all(lb.get(key) == 1 for key in KEYS[:5000])
@@ -0,0 +1,130 @@
+import functools
+import random
+
+import pytest
+
+from LoadBalancers.load_balancer import LoadBalancer
+from LoadBalancers.load_balancer_hash_shard_mult import ConsistentHashingLoadBalancer
+from LoadBalancers.load_balancer_hash_shard_once import HashShardLoadBalancer
+from LoadBalancers.load_balancer_maglev import MaglevLoadBalancer
+from LoadBalancers.load_balancer_table_indirection import TableIndirection
+
+KEYS = ['key{}'.format(i) for i in range(20000)]
+
+
+@pytest.fixture
+def lb():
+    # 'server1' + '10' and 'server11' + '0' hash to the same token
+    lb = ConsistentHashingLoadBalancer(num_rounds=20)
+    for shard_name in ('server0', 'server2', 'server1', 'server11'):
+        lb.add_shard(shard_name)
+    lb.put_many(KEYS)
+    return lb
+
+
+def run(lb, plan):
+    migration = lb.start_migration(plan, keys_per_put=0)
+    lb.finish_migration()
+    return migration.moved
+
+
+def test_plan_remove_counts_keys_moved(lb):
+    plan = lb.plan_remove_shards(['server1'])
+    assert plan.num_keys() == len(lb.shards['server1'].kvstore)
+    assert run(lb, plan) == plan.num_keys()
+
+
+def test_plan_add_counts_keys_moved(lb):
+    plan = lb.plan_add_shards(['server3', 'server12'])
+    assert run(lb, plan) == plan.num_keys()
+    assert sum(len(shard.kvstore) for shard in lb.shards.values()) == len(KEYS)
+
+
+def table_lb(cls):
+    lb = cls()
+    for shard_name in ('server0', 'server1', 'server2'):
+        lb.add_shard(shard_name)
+    lb.put_many(KEYS)
+    return lb
+
+
+small_maglev = functools.partial(MaglevLoadBalancer, table_size=1009)
+TABLES = [pytest.param(TableIndirection, id='TableIndirection'), pytest.param(small_maglev, id='Maglev')]
+
+
+@pytest.mark.parametrize('cls', TABLES)
+def test_table_plan_add_counts_keys_moved(cls):
+    lb = table_lb(cls)
+    plan = lb.plan_add_shards(['server3', 'server4'])
+    assert plan.num_keys() > 0
+    assert run(lb, plan) == plan.num_keys()
+    assert sum(len(shard.kvstore) for shard in lb.shards.values()) == len(KEYS)
+    assert all(lb.getShardNameForKey(key) == shard_name for shard_name, shard in lb.shards.items() for key in shard.kvstore)
+
+
+@pytest.mark.parametrize('cls', TABLES)
+def test_table_plan_remove_counts_keys_moved(cls):
+    lb = table_lb(cls)
+    plan = lb.plan_remove_shards(['server1'])
+    # a rebuilt Maglev table also moves a few slots between the shards that stay
+    drained = sum(keys for (src, _), keys in plan.cost().items() if src == 'server1')
+    assert drained == len(lb.shards['server1'].kvstore)
+    migration = lb.start_migration(plan, keys_per_put=0)
+    assert 'server1' in lb.shards # drained by the migration first
+    lb.finish_migration()
+    assert migration.moved == plan.num_keys()
+    assert sorted(lb.shards) == ['server0', 'server2']
+    assert sum(len(shard.kvstore) for shard in lb.shards.values()) == len(KEYS)
+
+
+def interleave(lb, seed, keys_per_put=None, steps=300):
+    # random puts, gets, adds and removes; removes plan 0 keys whenever the
+    # arcs the shard still owns are empty while an older move drains it
+    rng = random.Random(seed)
+    counts, live = {}, []
+    for _ in range(steps):
+        op = rng.random()
+        if op < 0.1 or len(live) < 2:
+            shard_name = 's{}'.format(rng.randrange(12))
+            if shard_name not in live:
+                plan = lb.plan_add_shards([shard_name]) if keys_per_put is not None else None
+                if plan is None: # the first shards of a table have no keys to take
+                    lb.add_shard(shard_name)
+                else:
+                    lb.start_migration(plan, keys_per_put)
+                live.append(shard_name)
+        elif op < 0.18:
+            shard_name = rng.choice(live)
+            if keys_per_put is None:
+                lb.remove_shard(shard_name)
+            else:
+                lb.start_migration(lb.plan_remove_shards([shard_name]), keys_per_put)
+            live.remove(shard_name)
+        elif op < 0.8:
+            keys = ['k{}'.format(rng.randrange(300)) for _ in range(rng.randrange(1, 6))]
+            lb.put_many(keys)
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+        else:
+            key = 'k{}'.format(rng.randrange(300))
+            assert lb.get(key) == counts.get(key)
+    lb.finish_migration()
+    assert not lb.migrations
+    assert sorted(lb.shards) == sorted(live)
+    assert {key: lb.get(key) for key in counts} == counts
+
+
+PLANNERS = [ConsistentHashingLoadBalancer, HashShardLoadBalancer] + TABLES
+
+
+@pytest.mark.parametrize('cls', PLANNERS)
+@pytest.mark.parametrize('seed', range(20))
+def test_overlapping_migrations_keep_keys(cls, seed):
+    interleave(cls(), seed, keys_per_put=0.3)
+
+
+@pytest.mark.parametrize('cls', PLANNERS)
+@pytest.mark.parametrize('seed', range(20))
+def test_overlapping_lazy_migrations_keep_keys(cls, seed, monkeypatch):
+    monkeypatch.setattr(LoadBalancer, 'sweep_rate', 0.02)
+    interleave(cls(), seed)
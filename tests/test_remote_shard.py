@@ -0,0 +1,72 @@
+import pytest
+
+from LoadBalancers.load_balancer import LoadBalancer
+from LoadBalancers.load_balancer_hash_shard_mult import ConsistentHashingLoadBalancer
+from remote_shard import RemoteShard, WorkerPool, close_workers, snapshot_shards
+from shard import Shard
+from state_monitor import StateMonitor
+
+KEYS = ['key{}'.format(i) for i in range(2000)]
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(2)
+    yield pool
+    close_workers(pool.workers)
+
+
+def contents(shards):
+    return {name: dict(shard.kvstore) for name, shard in snapshot_shards(shards).items()}
+
+
+def test_take_matches_in_process_shards(pool):
+    # a and c share a worker, b is on the other one
+    local = {name: Shard(name) for name in 'abc'}
+    remote = {name: RemoteShard(name, pool) for name in 'abc'}
+    assert remote['a'].kvstore.worker is remote['c'].kvstore.worker is not remote['b'].kvstore.worker
+    for shards in (local, remote):
+        shards['a'].put_many(KEYS, [1] * len(KEYS))
+        shards['a'].put('key7', 2)
+        shards['b'].take(shards['a'].kvstore, KEYS[:500])   # between workers
+        shards['c'].take(shards['a'].kvstore, KEYS[500:900]) # within a worker
+        shards['a'].take(shards['c'].kvstore, KEYS[800:900])
+    assert contents(remote) == contents(local)
+    assert sum(map(len, contents(remote).values())) == len(KEYS)
+
+
+def test_snapshot_applies_only_changes(pool):
+    shard = RemoteShard('a', pool)
+    shard.put_many(KEYS[:10], [1] * 10)
+    assert dict(shard.snapshot().result().kvstore) == dict.fromkeys(KEYS[:10], 1)
+    other = RemoteShard('b', pool)
+    other.take(shard.kvstore, KEYS[:4])
+    shard.put('key9', 5)
+    assert dict(shard.snapshot().result().kvstore) == dict(zip(KEYS[4:10], [1] * 5 + [6]))
+
+
+def run(shard_class, monkeypatch):
+    monkeypatch.setattr(LoadBalancer, 'shard_class', shard_class)
+    monkeypatch.setattr(LoadBalancer, 'num_workers', 2)
+    lb = ConsistentHashingLoadBalancer()
+    sm = StateMonitor()
+    for n in range(4):
+        lb.add_shard('server{}'.format(n))
+    for start in range(0, len(KEYS), 500):
+        batch = KEYS[start:start + 500] * 2
+        lb.put_many(batch)
+        sm.put_many(batch)
+        sm.check_valid(lb.shards)
+        lb.add_shard('server{}'.format(4 + start // 500))
+        sm.check_valid(lb.shards)
+    lb.remove_shards(['server0', 'server2'])
+    sm.check_valid(lb.shards)
+    assert not sm.failed
+    stats = (sm.num_keys(), sm.count_moves(), contents(lb.shards))
+    if lb.workers is not None:
+        close_workers(lb.workers.workers)
+    return stats
+
+
+def test_load_balancer_stats_match_in_process_shards(monkeypatch):
+    assert run(RemoteShard, monkeypatch) == run(Shard, monkeypatch)
@@ -0,0 +1,39 @@
+import pytest
+
+import ring
+from ring import Ring
+
+
+@pytest.fixture(params=[True, False], ids=['numpy', 'no-numpy'])
+def with_numpy(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(ring, 'np', None)
+    elif ring.np is None:
+        pytest.skip('numpy is not installed')
+
+
+def test_colliding_token_stays_with_first_shard(with_numpy):
+    r = Ring()
+    r.add('a', [10, 20])
+    r.add('b', [20, 30])
+    assert r.lookup(15) == 'a'
+    assert r.lookup(20) == 'a'
+    assert r.lookup(25) == 'b'
+    r.remove('a')
+    assert r.lookup(15) == 'b'
+
+
+def test_arcs_skip_colliding_tokens(with_numpy):
+    r = Ring()
+    r.add('a', [10, 20])
+    r.add('b', [20, 30])
+    assert r.arcs('b') == [(20, 30, 'a')]
+    assert r.arcs('a') == [(30, 10, 'b'), (10, 20, 'b')]
+    for shard_name in ('a', 'b'):
+        assert all(lo != hi for lo, hi, _ in r.arcs(shard_name))
+
+
+def test_single_token_arc_is_whole_ring(with_numpy):
+    r = Ring()
+    r.add('a', [10])
+    assert r.arcs('a') == [(10, 10, None)]
@@ -0,0 +1,84 @@
+import pytest
+
+import routing
+from LoadBalancers.load_balancer_bounded_loads import BoundedLoadsLoadBalancer
+from LoadBalancers.load_balancer_hash_key import HashKeyLoadBalancer
+from LoadBalancers.load_balancer_hash_shard_mult import ConsistentHashingLoadBalancer
+from LoadBalancers.load_balancer_jump import JumpHashLoadBalancer
+from LoadBalancers.load_balancer_maglev import MaglevLoadBalancer
+from LoadBalancers.load_balancer_rendezvous import RendezvousLoadBalancer
+from LoadBalancers.load_balancer_table_indirection import TableIndirection
+from routing import RoutingSnapshot
+
+KEYS = ['key{}'.format(i) for i in range(5000)]
+
+BALANCERS = {
+    'ring': ConsistentHashingLoadBalancer,
+    'bounded': lambda: BoundedLoadsLoadBalancer(epsilon=0.05), # spills keys, routed by the overrides
+    'hash_key': HashKeyLoadBalancer,
+    'jump': JumpHashLoadBalancer,
+    'rendezvous': RendezvousLoadBalancer,
+    'table': TableIndirection,
+    'maglev': lambda: MaglevLoadBalancer(table_size=1009),
+}
+
+
+@pytest.fixture(params=[True, False], ids=['numpy', 'no-numpy'])
+def with_numpy(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(routing, 'np', None)
+    elif routing.np is None:
+        pytest.skip('numpy is not installed')
+
+
+@pytest.fixture(params=sorted(BALANCERS))
+def filled_lb(request):
+    lb = BALANCERS[request.param]()
+    for n in range(5):
+        lb.add_shard('server{}'.format(n))
+    lb.put_many(KEYS)
+    return lb
+
+
+# The shard every key is stored on
+def placement(lb):
+    return [next(name for name, shard in lb.shards.items() if key in shard.kvstore) for key in KEYS]
+
+
+def test_snapshot_routes_keys_where_they_are_stored(filled_lb, with_numpy):
+    snapshot = filled_lb.routing()
+    assert snapshot.epoch == filled_lb.epoch
+    assert snapshot.route_many(KEYS) == placement(filled_lb)
+    assert [snapshot.route(key) for key in KEYS[:200]] == placement(filled_lb)[:200]
+
+
+def test_snapshot_round_trips_through_bytes(filled_lb, with_numpy):
+    snapshot = filled_lb.routing()
+    data = snapshot.to_bytes()
+    copy = RoutingSnapshot.from_bytes(data)
+    assert type(copy) is type(snapshot)
+    assert (copy.epoch, copy.hash_fn.name, copy.names, copy.overrides) == (snapshot.epoch, snapshot.hash_fn.name, snapshot.names, snapshot.overrides)
+    assert copy.route_many(KEYS) == snapshot.route_many(KEYS)
+    assert copy.to_bytes() == data
+    assert len(data) % 8 == 0
+
+
+def test_snapshot_is_unchanged_by_later_epochs(filled_lb):
+    snapshot = filled_lb.routing()
+    data, routes = snapshot.to_bytes(), snapshot.route_many(KEYS)
+    assert filled_lb.routing() is snapshot
+    filled_lb.add_shard('server5')
+    filled_lb.remove_shard('server1')
+    filled_lb.put_many(KEYS)
+    latest = filled_lb.routing()
+    assert latest is not snapshot and latest.epoch > snapshot.epoch
+    assert latest.route_many(KEYS) == placement(filled_lb) != routes
+    assert snapshot.to_bytes() == data
+    assert snapshot.route_many(KEYS) == routes
+
+
+def test_from_bytes_rejects_other_data():
+    data = ConsistentHashingLoadBalancer().routing().to_bytes()
+    for bad in (b'XXXX' + data[4:], data[:4] + bytes([routing.VERSION + 1]) + data[5:]):
+        with pytest.raises(ValueError):
+            RoutingSnapshot.from_bytes(bad)
@@ -0,0 +1,53 @@
+import asyncio
+
+from LoadBalancers.load_balancer_hash_shard_mult import ConsistentHashingLoadBalancer
+from server import BalancerServer, MAX_LINE, TOO_LONG
+
+
+def new_server():
+    lb = ConsistentHashingLoadBalancer()
+    for n in range(3):
+        lb.add_shard('server{}'.format(n))
+    return BalancerServer(lb)
+
+
+# Sends the chunks over one connection, closing its write side after the
+# last one, and returns every reply the server sent
+async def exchange(balancer_server, chunks):
+    server = await asyncio.start_server(balancer_server.handle, '127.0.0.1', 0)
+    async with server:
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        for chunk in chunks:
+            writer.write(chunk)
+            await writer.drain()
+        writer.write_eof()
+        replies = await reader.read()
+        writer.close()
+    return replies.split(b'\n')[:-1]
+
+
+def test_pipelined_commands_are_answered_in_order():
+    commands = [b'put a', b'put b', b'get a', b'put a', b'create server3', b'get a', b'get c',
+                b'create server3', b'remove server0', b'put c', b'frob x', b'get c', b'get']
+    data = b''.join(command + b'\n' for command in commands)
+    replies = asyncio.run(exchange(new_server(), [data[:8], data[8:] + data])) # the second put is split
+    assert replies == [b'OK', b'OK', b'1', b'OK', b'OK', b'2', b'NONE',
+                       b'ERR shard server3 already exists', b'OK', b'OK', b'ERR unknown command frob', b'1',
+                       b'ERR expected <command> <arg>',
+                       b'OK', b'OK', b'3', b'OK', b'ERR shard server3 already exists', b'4', b'1',
+                       b'ERR shard server3 already exists', b'ERR no shard server0', b'OK', b'ERR unknown command frob', b'2',
+                       b'ERR expected <command> <arg>']
+
+
+def test_last_command_without_newline_runs_at_eof():
+    balancer_server = new_server()
+    assert asyncio.run(exchange(balancer_server, [b'put a\nput a\nge', b't a'])) == [b'OK', b'OK', b'2']
+    assert balancer_server.num_requests == 3
+
+
+def test_too_long_lines_are_rejected():
+    long_key = b'k' * MAX_LINE
+    balancer_server = new_server()
+    chunks = [b'put a\nput ' + long_key[:100], long_key, long_key + b'\nget a\nput ' + long_key + b'\nget a']
+    assert asyncio.run(exchange(balancer_server, chunks)) == [b'OK', TOO_LONG.rstrip(), b'1', TOO_LONG.rstrip(), b'1']
+    assert balancer_server.load_balancer.get('a') == 1
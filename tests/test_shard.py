@@ -0,0 +1,54 @@
+import pickle
+
+import pytest
+
+import shard
+from hashing import HashFunction
+from shard import KeyTable, CompactShard, Shard
+
+# every key has the same fingerprint
+COLLIDING = HashFunction('colliding', 64, lambda key: 42)
+
+
+@pytest.fixture(params=[True, False], ids=['numpy', 'no-numpy'])
+def with_numpy(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(shard, 'np', None)
+    elif shard.np is None:
+        pytest.skip('numpy is not installed')
+
+
+def test_key_table_keeps_colliding_keys_apart(with_numpy):
+    table = KeyTable(fingerprint=COLLIDING)
+    assert (table.intern('a'), table.intern('b'), table.intern('a')) == (0, 1, 0)
+    assert list(table.intern_many(['c', 'd', 'x', 'a', 'b'])) == [2, 3, 4, 0, 1]
+    table.intern_many(['key{}'.format(i) for i in range(5000)]) # merges the fingerprints
+    assert list(table.lookup_many(['d', 'key7', 'c', 'e'])) == [3, 12, 2, -1]
+    assert (table.lookup('b'), table.lookup('e')) == (1, -1)
+
+
+def test_compact_shard_counts_colliding_keys_apart(with_numpy):
+    s = CompactShard('s', KeyTable(fingerprint=COLLIDING))
+    for key in ('a', 'b', 'a', 'a'):
+        s.put(key, 1)
+    s.put_many(['b', 'c'], [1, 1])
+    assert (s.kvstore['a'], s.kvstore['b'], s.kvstore['c']) == (3, 2, 1)
+    assert len(s.kvstore) == 3
+
+
+def test_key_table_fingerprints_are_stable(with_numpy):
+    # ids do not depend on the salted builtin hash of the process
+    table = KeyTable()
+    table.intern_many(['a', 'b'])
+    assert table.fingerprint('a') == 0xaf63dc4c8601ec8c # fnv1a64 of b'a'
+    assert (table.lookup_fp(0xaf63dc4c8601ec8c), table.lookup_fp(table.fingerprint('b'))) == (0, 1)
+
+
+def test_shard_pickles_with_its_journal():
+    s = Shard('s')
+    s.put('a', 1, 5)
+    s.put('b', 1)
+    copy = pickle.loads(pickle.dumps(s))
+    assert dict(copy.kvstore) == {'a': 1, 'b': 1}
+    assert copy.kvstore.journal == {'a', 'b'}
+    assert copy.kvstore.hashes == {'a': 5}
@@ -0,0 +1,48 @@
+import pytest
+
+import errors
+import state_monitor
+from shard import Shard
+from state_monitor import CompactStateMonitor
+
+
+@pytest.fixture(params=[True, False], ids=['numpy', 'no-numpy'])
+def with_numpy(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(state_monitor, 'np', None)
+    elif state_monitor.np is None:
+        pytest.skip('numpy is not installed')
+
+
+def setup():
+    sm = CompactStateMonitor()
+    shards = {'a': Shard('a'), 'b': Shard('b')}
+    for key in ('x', 'y', 'z'):
+        shards['a'].put(key, 1)
+    sm.put_many(['x', 'y', 'z'])
+    sm.check_valid(shards)
+    return sm, shards
+
+
+def test_compact_monitor_keeps_no_key_names(with_numpy):
+    sm, shards = setup()
+    shards['b'].put('w', 1)
+    sm.put('w')
+    assert not sm.put_keys
+    sm.check_valid(shards)
+    assert not any(sm.put_flags)
+
+
+def test_compact_monitor_catches_dropped_put(with_numpy):
+    sm, shards = setup()
+    sm.put('x')
+    with pytest.raises(errors.ValueLostInTransitionError):
+        sm.check_valid(shards)
+
+
+def test_compact_monitor_catches_dropped_new_key(with_numpy):
+    sm, shards = setup()
+    sm.put_many(['x', 'new'])
+    shards['a'].put('x', 1)
+    with pytest.raises(errors.KeyLostInTransitionError):
+        sm.check_valid(shards)
@@ -0,0 +1,34 @@
+from collections import Counter
+
+from LoadBalancers.load_balancer_table_indirection import TableIndirection
+from shard import Shard
+
+
+def test_single_hot_bucket_is_not_bounced():
+    lb = TableIndirection()
+    for n in range(10):
+        lb.add_shard('server{}'.format(n))
+    lb.put_many(['key{}'.format(i) for i in range(1000)])
+    for _ in range(5000):
+        lb.put('hot')
+    # the hot bucket alone is over the threshold: once no move can lower
+    # the hottest server, puts and membership changes leave it in place
+    assert not lb.isOverloaded(lb.getShardNameForKey('hot'))
+    epoch = lb.epoch
+    for _ in range(1000):
+        lb.put('hot')
+    assert lb.epoch == epoch
+    lb.add_shard('server10')
+    assert lb.get('hot') == 6000
+
+
+def test_remove_shards_moves_each_key_once(monkeypatch):
+    lb = TableIndirection()
+    for n in range(10):
+        lb.add_shard('server{}'.format(n))
+    lb.put_many(['key{}'.format(i % 5000) for i in range(20000)])
+    moves = Counter()
+    take = Shard.take
+    monkeypatch.setattr(Shard, 'take', lambda self, kvstore, keys: moves.update(keys) or take(self, kvstore, keys))
+    lb.remove_shards(['server1', 'server4', 'server7'])
+    assert moves and max(moves.values()) == 1
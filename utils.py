@@ -1,3 +1,212 @@
-# Hash function with mask for first 32 bits
-def hash_fn(a):
-    return hash(a) & 0xffffffff
\ No newline at end of file
+from bisect import bisect_left, bisect_right
+import math
+from collections import defaultdict
+from hashing import get_hash_fn
+
+# NumPy is optional: without it the batch paths fall back to plain loops
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Default hash function: a stable 32-bit hash, identical in every process
+# (see hashing.py for the alternatives a load balancer can be built with)
+hash_fn = get_hash_fn()
+
+# Splits parallel columns by owner: returns {owner: (column_0 values,
+# column_1 values, ...)} holding the entries i with owners[i] == owner
+def group_by_owner(owners, *columns):
+    if len(owners) == 0:
+        return {}
+    if np is not None and isinstance(owners, np.ndarray):
+        order = np.argsort(owners, kind='stable')
+        sorted_owners = owners[order]
+        bounds = (np.flatnonzero(np.diff(sorted_owners)) + 1).tolist()
+        starts, ends = [0] + bounds, bounds + [len(order)]
+        columns = [as_array(column)[order] for column in columns]
+        return {sorted_owners[s].item(): tuple(column[s:e].tolist() for column in columns)
+                for s, e in zip(starts, ends)}
+    groups = defaultdict(lambda: tuple([] for _ in columns))
+    for i, owner in enumerate(owners):
+        for group, column in zip(groups[owner], columns):
+            group.append(column[i])
+    return groups
+
+# Converts a sequence to a NumPy array, keeping arbitrary objects (e.g. keys) as objects
+def as_array(seq):
+    if isinstance(seq, np.ndarray):
+        return seq
+    array = np.empty(len(seq), dtype=object)
+    array[:] = seq
+    return array
+
+"""
+Keys of a single shard ordered by their hash.
+New keys are buffered and merged in lazily, so puts stay O(1) and the sorting
+cost is only paid by the shards a membership change actually reads from.
+"""
+class HashIndex:
+    def __init__(self):
+        self.hashes = []  # sorted key hashes
+        self.keys = []    # keys, parallel to hashes
+        self.pending = [] # (hash, key) pairs not merged into hashes/keys yet
+
+    def __len__(self):
+        return len(self.hashes) + len(self.pending)
+
+    # Records that `key` with hash `h` now lives in this shard
+    def add(self, key, h):
+        self.pending.append((h, key))
+
+    # Records many keys at once, hashes[i] being the hash of keys[i]
+    def add_many(self, keys, hashes):
+        self.pending.extend(zip(hashes, keys))
+
+    # Returns all (key, hash) pairs in the index
+    def items(self):
+        self.merge()
+        return list(zip(self.keys, self.hashes))
+
+    # Removes and returns the (key, hash) pairs with hash in the arc (lo, hi],
+    # wrapping around the end of the hash space when lo >= hi
+    def pop_arc(self, lo, hi):
+        if lo < hi:
+            return self.pop_range(lo, hi)
+        return self.pop_range(lo, None) + self.pop_range(None, hi)
+
+    # Returns the number of keys with hash in the arc (lo, hi]
+    def count_arc(self, lo, hi):
+        self.merge()
+        if lo < hi:
+            return bisect_right(self.hashes, hi) - bisect_right(self.hashes, lo)
+        return len(self.hashes) - bisect_right(self.hashes, lo) + bisect_right(self.hashes, hi)
+
+    # Returns the hash of the n-th key (from 0) going clockwise from lo
+    def arc_hash(self, lo, n):
+        self.merge()
+        return self.hashes[(bisect_right(self.hashes, lo) + n) % len(self.hashes)]
+
+    # Removes and returns the (key, hash) pairs with lo < hash <= hi, where a
+    # bound of None leaves that side open
+    def pop_range(self, lo, hi):
+        self.merge()
+        i = 0 if lo is None else bisect_right(self.hashes, lo)
+        j = len(self.hashes) if hi is None else bisect_right(self.hashes, hi)
+        popped = list(zip(self.keys[i:j], self.hashes[i:j]))
+        del self.keys[i:j]
+        del self.hashes[i:j]
+        return popped
+
+    # Removes key (with hash h) from the index
+    def discard(self, key, h):
+        self.merge()
+        i = bisect_left(self.hashes, h)
+        while i < len(self.hashes) and self.hashes[i] == h:
+            if self.keys[i] == key:
+                del self.hashes[i]
+                del self.keys[i]
+                return
+            i += 1
+
+    # Removes and returns the `count` (key, hash) pairs with the highest hashes
+    def pop_highest(self, count):
+        self.merge()
+        start = max(len(self.hashes) - count, 0)
+        popped = list(zip(self.keys[start:], self.hashes[start:]))
+        del self.keys[start:]
+        del self.hashes[start:]
+        return popped
+
+    # Merges the pending pairs into the sorted lists
+    def merge(self):
+        if not self.pending:
+            return
+        if len(self.pending) * 8 < len(self.hashes):
+            # few new keys: insert each one in place
+            for h, key in self.pending:
+                idx = bisect_right(self.hashes, h)
+                self.hashes.insert(idx, h)
+                self.keys.insert(idx, key)
+        else:
+            pairs = list(zip(self.hashes, self.keys))
+            pairs.extend(self.pending)
+            pairs.sort(key=lambda pair: pair[0])
+            self.hashes = [h for h, _ in pairs]
+            self.keys = [key for _, key in pairs]
+        self.pending = []
+
+JUMP_MULTIPLIER = 2862933555777941757
+
+# Jump consistent hash (Lamping & Veach): maps a 64-bit key to a bucket in
+# range(num_buckets), moving only 1/num_buckets of the keys when a bucket is added
+def jump_hash(key, num_buckets):
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * JUMP_MULTIPLIER + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+# jump_hash over a batch of keys, iterating all unfinished keys together
+def jump_hash_many(keys, num_buckets):
+    if np is None:
+        return [jump_hash(key, num_buckets) for key in keys]
+    keys = np.array(keys, dtype=np.uint64)
+    b = np.full(len(keys), -1, dtype=np.int64)
+    j = np.zeros(len(keys), dtype=np.int64)
+    active = np.flatnonzero(j < num_buckets)
+    while len(active):
+        b[active] = j[active]
+        key = keys[active] * np.uint64(JUMP_MULTIPLIER) + np.uint64(1)
+        keys[active] = key
+        step = float(1 << 31) / ((key >> np.uint64(33)) + np.uint64(1)).astype(np.float64)
+        j[active] = ((b[active] + 1) * step).astype(np.int64)
+        active = active[j[active] < num_buckets]
+    return b
+
+MASK64 = 0xffffffffffffffff
+MIX_MULTIPLIER = 0x9e3779b97f4a7c15
+SCORE_BATCH = 4096 # keys scored at once, bounding the (keys x shards) matrix
+
+# MurmurHash3 64-bit finalizer
+def fmix64(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & MASK64
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & MASK64
+    k ^= k >> 33
+    return k
+
+def fmix64_many(k):
+    k = k ^ (k >> np.uint64(33))
+    k = k * np.uint64(0xff51afd7ed558ccd)
+    k = k ^ (k >> np.uint64(33))
+    k = k * np.uint64(0xc4ceb9fe1a85ec53)
+    return k ^ (k >> np.uint64(33))
+
+# Weighted rendezvous score of a key on a shard: the key's hash mixed with
+# the shard's seed is mapped to u in (0, 1) and scored -weight / ln(u), so a
+# shard wins a share of the keys proportional to its weight
+def score(key_hash, seed, weight):
+    mixed = fmix64((key_hash * MIX_MULTIPLIER + seed) & MASK64)
+    return -weight / math.log(((mixed >> 11) + 0.5) / (1 << 53))
+
+# score() for every pair of key_hashes (n,) and shards (seeds/weights, m,): (n, m)
+def score_many(key_hashes, seeds, weights):
+    mixed = fmix64_many(key_hashes[:, None] * np.uint64(MIX_MULTIPLIER) + seeds[None, :])
+    u = ((mixed >> np.uint64(11)).astype(np.float64) + 0.5) / float(1 << 53)
+    return -weights[None, :] / np.log(u)
+
+# Gets, for each of key_hashes, the position of its highest scoring shard
+# among the shards with the given seeds and weights
+def rendezvous_owners(key_hashes, seeds, weights):
+    if np is None:
+        return [max(range(len(seeds)), key=lambda i: score(h, seeds[i], weights[i])) for h in key_hashes]
+    key_hashes = np.asarray(key_hashes, dtype=np.uint64)
+    seeds = np.array(seeds, dtype=np.uint64)
+    weights = np.array(weights, dtype=np.float64)
+    owners = np.empty(len(key_hashes), dtype=np.int64)
+    for start in range(0, len(key_hashes), SCORE_BATCH):
+        batch = key_hashes[start:start + SCORE_BATCH]
+        owners[start:start + SCORE_BATCH] = score_many(batch, seeds, weights).argmax(axis=1)
+    return owners
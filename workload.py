@@ -0,0 +1,205 @@
+import argparse
+import mmap
+import re
+import struct
+from array import array
+from hashing import HASH_FUNCTIONS, DEFAULT_HASH, get_hash_fn
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+Compiled workload format. A little endian header is followed by four
+8-byte aligned sections:
+  ops:    one opcode byte per operation (OPCODES)
+  ids:    one uint32 per operation, the id of its key or shard name
+  keys:   every distinct key and shard name, utf-8 and newline separated,
+          in order of first appearance, so id i is the i-th of them
+  hashes: optional, hash_name hash of every key in the key table, uint32 or
+          uint64 depending on the hash width
+The ops and ids columns are read straight out of an mmap of the file.
+"""
+
+MAGIC = b'LBWL'
+VERSION = 1
+HEADER = struct.Struct('<4sBBxxQQQ16s') # magic, version, hash width in bytes, num ops, num keys, key table size, hash name
+OPCODES = {'put': 0, 'create': 1, 'remove': 2}
+COMMANDS = {opcode: command for command, opcode in OPCODES.items()}
+CHUNK_SIZE = 1 << 20 # operations scanned at once when replaying
+NOT_PUT = re.compile(b'[^\\x00]')
+
+# Rounds offset up to a multiple of 8
+def align(offset):
+    return (offset + 7) & ~7
+
+# Yields the (command, arg) operations of a text workload
+def read_text(path):
+    with open(path) as f:
+        for line in f:
+            command, arg = line.split()
+            yield command, arg
+
+# Compiles the text workload at src into the binary format at dst, storing
+# the hash_fn hash of every key unless hash_fn is 'none'
+def compile_workload(src, dst, hash_fn=DEFAULT_HASH):
+    return write_workload(dst, read_text(src), hash_fn)
+
+# Writes (command, arg) operations to dst in the binary format, storing the
+# hash_fn hash of every key unless hash_fn is 'none'. Returns the op count
+def write_workload(dst, operations, hash_fn=DEFAULT_HASH):
+    ops = bytearray()
+    ids = array('I')
+    key_ids = {}
+    for command, arg in operations:
+        ops.append(OPCODES[command])
+        i = key_ids.get(arg)
+        if i is None:
+            i = key_ids[arg] = len(key_ids)
+        ids.append(i)
+    keys = list(key_ids)
+    key_table = '\n'.join(keys).encode()
+
+    hashes = array('I')
+    hash_name = ''
+    if hash_fn != 'none':
+        hash_fn = get_hash_fn(hash_fn)
+        hash_name = hash_fn.name
+        hashes = array('I' if hash_fn.bits <= 32 else 'Q')
+        vals = hash_fn.many(keys) if keys else []
+        hashes.extend(vals.tolist() if np is not None and keys else vals)
+
+    with open(dst, 'wb') as w:
+        hash_width = hashes.itemsize if hash_name else 0
+        w.write(HEADER.pack(MAGIC, VERSION, hash_width, len(ops), len(keys), len(key_table), hash_name.encode()))
+        for section in (ops, ids.tobytes(), key_table, hashes.tobytes()):
+            w.write(section)
+            w.write(bytes(align(w.tell()) - w.tell()))
+    return len(ops)
+
+# Returns whether the file at path is a compiled workload
+def is_compiled(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# Opens a compiled or text workload
+def open_workload(path):
+    return BinaryWorkload(path) if is_compiled(path) else TextWorkload(path)
+
+"""
+Workload in the text format, one `<command> <arg>` per line
+"""
+class TextWorkload:
+    def __init__(self, path):
+        self.path = path
+        self.hash_name = None
+        self.num_ops = 0
+        last = b'\n'
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                self.num_ops += block.count(b'\n')
+                last = block[-1:]
+        if last != b'\n': # last line without a newline
+            self.num_ops += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    # Yields ('put', keys, None) for runs of at most batch_size puts and
+    # (command, shard_name, None) for every other command, in workload order
+    def replay(self, batch_size, hash_name=None):
+        puts = []
+        with open(self.path) as f:
+            for line in f:
+                command, arg = line.split()
+                if command == 'put':
+                    puts.append(arg)
+                    if len(puts) >= batch_size:
+                        yield 'put', puts, None
+                        puts = []
+                    continue
+                if puts:
+                    yield 'put', puts, None
+                    puts = []
+                yield command, arg, None
+        if puts:
+            yield 'put', puts, None
+
+"""
+Workload in the compiled format, memory-mapped
+"""
+class BinaryWorkload:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, hash_width, self.num_ops, num_keys, key_table_size, hash_name = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a version {} compiled workload'.format(path, VERSION))
+        self.hash_name = hash_name.rstrip(b'\0').decode() or None
+
+        ids_offset = align(HEADER.size + self.num_ops)
+        keys_offset = align(ids_offset + 4 * self.num_ops)
+        hashes_offset = align(keys_offset + key_table_size)
+        view = memoryview(self.mm)
+        self.ops = view[HEADER.size:HEADER.size + self.num_ops]
+        self.ids = view[ids_offset:ids_offset + 4 * self.num_ops].cast('I')
+        self.keys = bytes(view[keys_offset:keys_offset + key_table_size]).decode().split('\n') if num_keys else []
+        self.hashes = view[hashes_offset:hashes_offset + hash_width * num_keys].cast('I' if hash_width == 4 else 'Q') if hash_width else None
+        if np is not None:
+            self.ids = np.frombuffer(self.ids, dtype=np.uint32)
+            self.keys = np.array(self.keys, dtype=object)
+            if self.hashes is not None:
+                self.hashes = np.frombuffer(self.hashes, dtype=np.uint32 if hash_width == 4 else np.uint64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.ops = self.ids = self.hashes = None
+        try:
+            self.mm.close()
+        except BufferError:
+            pass # an unfinished replay still holds views, the map goes away with them
+
+    # Yields ('put', keys, hashes) for runs of at most batch_size puts and
+    # (command, shard_name, None) for every other command, in workload order.
+    # hashes are the stored hashes of keys if they were made with hash_name
+    def replay(self, batch_size, hash_name=None):
+        hashes = self.hashes if hash_name is not None and hash_name == self.hash_name else None
+        for chunk in range(0, self.num_ops, CHUNK_SIZE):
+            end = min(chunk + CHUNK_SIZE, self.num_ops)
+            start = chunk
+            # the puts run up to the next non-put opcode
+            for match in NOT_PUT.finditer(self.ops, chunk, end):
+                pos = match.start()
+                yield from self.puts(start, pos, batch_size, hashes)
+                yield COMMANDS[self.ops[pos]], self.keys[self.ids[pos]], None
+                start = pos + 1
+            yield from self.puts(start, end, batch_size, hashes)
+
+    # Yields the puts in [start, end) in runs of at most batch_size
+    def puts(self, start, end, batch_size, hashes):
+        for lo in range(start, end, batch_size):
+            ids = self.ids[lo:min(lo + batch_size, end)]
+            if np is not None:
+                yield 'put', self.keys[ids].tolist(), None if hashes is None else hashes[ids]
+            else:
+                yield 'put', [self.keys[i] for i in ids], None if hashes is None else [hashes[i] for i in ids]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compiles a text workload into the binary format')
+    parser.add_argument('src', type=str, help='text workload, e.g. Workloads/test_workload.txt')
+    parser.add_argument('dst', type=str, nargs='?', help='output file, defaults to src with a .wlb extension')
+    parser.add_argument('--hash', metavar='hash_fn', type=str, choices=sorted(HASH_FUNCTIONS) + ['none'],
+                        help='hash function to store key hashes for, or none', default=DEFAULT_HASH)
+    out = parser.parse_args()
+    dst = out.dst or out.src.rsplit('.', 1)[0] + '.wlb'
+    print('compiled {} operations into {}'.format(compile_workload(out.src, dst, out.hash), dst))
@@ -0,0 +1,138 @@
+import os
+import sys
+import random
+import argparse
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hashing import HASH_FUNCTIONS, DEFAULT_HASH
+from workload import write_workload
+
+DISTRIBUTIONS = ['uniform', 'zipf', 'hotspot', 'bursty']
+SCHEDULES = ['random', 'even', 'bursty']
+SAMPLE_BATCH = 4096 # Keys drawn at once from the zipf distribution
+
+# Yields num_ops key ids in range(num_keys) drawn uniformly
+def uniform_keys(rng, num_keys, num_ops, args):
+    for _ in range(num_ops):
+        yield rng.randrange(num_keys)
+
+# Yields num_ops key ids where key i is drawn with a weight of 1 / (i + 1) ** s
+def zipf_keys(rng, num_keys, num_ops, args):
+    cum_weights = list(accumulate(1 / (rank + 1) ** args.zipf_s for rank in range(num_keys)))
+    ids = range(num_keys)
+    for start in range(0, num_ops, SAMPLE_BATCH):
+        yield from rng.choices(ids, cum_weights=cum_weights, k=min(SAMPLE_BATCH, num_ops - start))
+
+# Yields num_ops key ids where a hot range of keys gets hot_share of the
+# ops, and the hot range jumps somewhere else every shift_every ops
+def hotspot_keys(rng, num_keys, num_ops, args):
+    hot = max(1, int(num_keys * args.hot_fraction))
+    for start in range(0, num_ops, args.shift_every):
+        base = rng.randrange(num_keys)
+        for _ in range(min(args.shift_every, num_ops - start)):
+            if rng.random() < args.hot_share:
+                yield (base + rng.randrange(hot)) % num_keys
+            else:
+                yield rng.randrange(num_keys)
+
+# Yields num_ops key ids drawn uniformly from a working set of keys that is
+# stable for burst_every ops, after which a burst retires churn of it and
+# brings in as many keys that were not used before
+def bursty_keys(rng, num_keys, num_ops, args):
+    window = max(1, int(num_keys * args.working_set))
+    base = 0
+    for start in range(0, num_ops, args.burst_every):
+        for _ in range(min(args.burst_every, num_ops - start)):
+            yield (base + rng.randrange(window)) % num_keys
+        base += max(1, int(window * args.churn))
+
+KEY_STREAMS = {'uniform': uniform_keys, 'zipf': zipf_keys, 'hotspot': hotspot_keys, 'bursty': bursty_keys}
+
+# Returns the sorted positions among num_ops puts at which the num_events creates and removes go
+def event_positions(rng, num_ops, num_events, schedule, burst_size):
+    if schedule == 'even':
+        return [num_ops * (i + 1) // (num_events + 1) for i in range(num_events)]
+    if schedule == 'bursty':
+        # events come in bursts of burst_size back to back
+        starts = sorted(rng.sample(range(num_ops + 1), -(-num_events // burst_size)))
+        return [starts[i // burst_size] for i in range(num_events)]
+    return sorted(rng.choices(range(num_ops + 1), k=num_events))
+
+# Returns the creates and removes in a random order that never removes the last shard
+def event_order(rng, num_shards, creates, removes):
+    events = ['create'] * creates + ['remove'] * removes
+    rng.shuffle(events)
+    live = num_shards
+    for i, event in enumerate(events):
+        if event == 'remove' and live == 1:
+            # swaps in the next create
+            j = events.index('create', i)
+            events[i], events[j] = events[j], events[i]
+            event = 'create'
+        live += 1 if event == 'create' else -1
+    return events
+
+# Yields the (command, arg) operations of the workload described by args
+def operations(args):
+    rng = random.Random(args.seed)
+    live = ['server{}'.format(n) for n in range(args.shards)]
+    next_server = args.shards
+    for name in live:
+        yield 'create', name
+
+    events = event_order(rng, args.shards, args.creates, args.removes)
+    positions = event_positions(rng, args.ops, len(events), args.schedule, args.burst_size)
+    keys = KEY_STREAMS[args.distribution](rng, args.keys, args.ops, args)
+    event = 0
+    for op in range(args.ops + 1):
+        while event < len(events) and positions[event] == op:
+            if events[event] == 'create':
+                live.append('server{}'.format(next_server))
+                next_server += 1
+                yield 'create', live[-1]
+            else:
+                yield 'remove', live.pop(rng.randrange(len(live)))
+            event += 1
+        if op < args.ops:
+            yield 'put', 'key{}'.format(next(keys))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='generates a synthetic workload')
+    parser.add_argument('-d', metavar='distribution', type=str, dest='distribution', choices=DISTRIBUTIONS,
+                        help='key distribution {}'.format(DISTRIBUTIONS), default='zipf')
+    parser.add_argument('--keys', type=int, help='number of distinct keys to draw from', default=100000)
+    parser.add_argument('--ops', type=int, help='number of puts', default=1000000)
+    parser.add_argument('--shards', type=int, help='number of shards created before the first put', default=10)
+    parser.add_argument('--creates', type=int, help='number of shards created among the puts', default=90)
+    parser.add_argument('--removes', type=int, help='number of shards removed among the puts', default=9)
+    parser.add_argument('--schedule', type=str, choices=SCHEDULES,
+                        help='where creates and removes go {}'.format(SCHEDULES), default='random')
+    parser.add_argument('--burst-size', type=int, help='creates and removes per burst with --schedule bursty', default=10)
+    parser.add_argument('--zipf-s', type=float, help='zipf exponent', default=1.1)
+    parser.add_argument('--hot-fraction', type=float, help='fraction of the keys that is hot with -d hotspot', default=0.01)
+    parser.add_argument('--hot-share', type=float, help='fraction of the puts going to hot keys with -d hotspot', default=0.9)
+    parser.add_argument('--shift-every', type=int, help='puts between hot spot shifts with -d hotspot', default=100000)
+    parser.add_argument('--working-set', type=float, help='fraction of the keys in the working set with -d bursty', default=0.1)
+    parser.add_argument('--churn', type=float, help='fraction of the working set replaced per burst with -d bursty', default=0.5)
+    parser.add_argument('--burst-every', type=int, help='puts between bursts with -d bursty', default=100000)
+    parser.add_argument('--seed', type=int, help='random seed, the same seed gives the same workload', default=0)
+    parser.add_argument('--format', type=str, choices=['text', 'binary', 'both'], help='output format', default='text')
+    parser.add_argument('--hash', metavar='hash_fn', type=str, choices=sorted(HASH_FUNCTIONS) + ['none'],
+                        help='hash function to store key hashes for in the binary format, or none', default=DEFAULT_HASH)
+    parser.add_argument('-o', metavar='output', type=str,
+                        help='output file without extension, defaults to synthetic_<distribution>_<ops>')
+    args = parser.parse_args()
+
+    if args.shards < 1 or args.shards + args.creates - args.removes < 1:
+        print('There has to be at least one shard at all times')
+        exit()
+
+    out_file = args.o or 'synthetic_{}_{}'.format(args.distribution, args.ops)
+    if args.format in ['text', 'both']:
+        print('generating ' + out_file + '.txt')
+        with open(out_file + '.txt', 'w') as w:
+            w.writelines('{} {}\n'.format(command, arg) for command, arg in operations(args))
+    if args.format in ['binary', 'both']:
+        print('generating ' + out_file + '.wlb')
+        write_workload(out_file + '.wlb', operations(args), args.hash)
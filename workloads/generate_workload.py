@@ -1,82 +1,133 @@
 import random
-import sys
 import argparse
 import collections
+import gzip
+import os
 import statistics
-
-random.seed(0)
-
-# Get the workload we're trying to generate
-parser = argparse.ArgumentParser(description='parsing options for running tests')
-parser.add_argument('-d', metavar='dataset', type=str, 
-                    help='dataset e.g. amazon0302.txt', default='com-dblp.ungraph.txt')
-parser.add_argument('-s', metavar='skew', type=bool, 
-                    help='True (only counts as False if omitted)', default=False)
-out = parser.parse_args()
-in_file = out.d
-
-out_file = "test_skewed_workload" if out.s else "test_workload"
-out_file += ".txt" if in_file == 'com-dblp.ungraph.txt' else "_{}".format(in_file)
-
-# Set input/output files
-f = open(in_file)
-w = open(out_file, 'w')
-
-print('generating ' + out_file)
-
-# Creates 90 servers 
-workload = ['create server{}\n'.format(server_num) for server_num in range(10,100)]
-# Removes 9 servers
-workload.extend(['remove server{}\n'.format(server_num) for server_num in range(9)])
-
-# To track key popularity
-keys = collections.defaultdict(lambda: 0)
-
-# Parse file to create load
-for line in f:
-    if line[0] == '#': continue
-    a, b = line.split()
-    puts = ['put {}\n'.format(a)] * (10 if out.s else 1)
-    workload.extend(puts)
-    keys[a] += len(puts)
-
-f.close()
-
-# shuffles the workload
-random.shuffle(workload)
-
-# Creates 10 servers to begin with
-for server_num in range(10):
-    w.write('create server{}\n'.format(server_num))
-
-# Records the workload
-for line in workload:
-    w.write(line)
-
-# Finds where creates and removes are located
-creates = [i for i in range(10)]
-removes = []
-for i in range(len(workload)):
-    line = workload[i]
-    if line.startswith('create'): creates.append(i + 10)
-    if line.startswith('remove'): removes.append(i + 10)
-
+import tempfile
+from itertools import islice
 from pprint import pprint
-print('{} creates'.format(len(creates)))
-pprint(creates, compact=True)
-print('{} removes'.format(len(removes)))
-pprint(removes)
-
-# Key Statistics
-print('{} keys in total'.format(len(keys)))
-sorted_popularity = sorted(keys.values(), reverse=True)
-top5 = sorted_popularity[:5]
-bottom5 = sorted_popularity[-5:]
-mean = statistics.mean(sorted_popularity)
-variance = statistics.variance(sorted_popularity, mean)
-print("mean key popularity = {}; variance of key popularity = {}".format(mean, variance))
-print("top5 = {}".format(top5))
-print("bottom5 = {}".format(bottom5))
-
-# Finish writing the file
-w.close()
\ No newline at end of file
+
+INITIAL_SERVERS = 10     # Servers created before the first put
+NUM_SERVERS = 100        # Servers created over the whole workload
+NUM_REMOVES = 9          # Servers removed, out of the initial ones
+BUCKET_PUTS = 1 << 20    # Puts shuffled in memory at once, out of the whole workload
+
+# Opens the dataset, decompressing it if it is gzipped
+def open_dataset(path):
+    return gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+
+# Counts the edges in the dataset
+def count_edges(path):
+    with open_dataset(path) as f:
+        return sum(1 for line in f if line[0] != '#')
+
+# Yields the key of every edge in the dataset, i.e. its first node
+def read_keys(path):
+    with open_dataset(path) as f:
+        for line in f:
+            if line[0] == '#': continue
+            a, b = line.split()
+            yield a
+
+# Yields items (strings without newlines) in a uniformly random order: each
+# is spilled to one of num_buckets temporary files picked at random, then the
+# files are shuffled in memory one at a time
+def shuffled(items, rng, num_buckets):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, str(i)) for i in range(num_buckets)]
+        files = [open(path, 'w') for path in paths]
+        for item in items:
+            files[rng.randrange(num_buckets)].write(item + '\n')
+        for f in files:
+            f.close()
+        for path in paths:
+            with open(path) as f:
+                bucket = f.read().splitlines()
+            rng.shuffle(bucket)
+            yield from bucket
+
+# Counts every key `repeat` times in popularity as it passes through
+def counted(keys, popularity, repeat):
+    for key in keys:
+        popularity[key] += repeat
+        yield key
+
+# Writes the workload for the dataset at in_file to out_file in one pass:
+# every key is put `repeat` times, and the creates and removes go at
+# positions sampled before any put is written. Returns the line numbers of
+# the creates and removes and, if popularity is given, counts puts per key in it
+def generate(in_file, out_file, repeat, rng, popularity=None):
+    # Creates 90 servers and removes 9 servers, in a random order
+    events = ['create server{}\n'.format(server_num) for server_num in range(INITIAL_SERVERS, NUM_SERVERS)]
+    events.extend(['remove server{}\n'.format(server_num) for server_num in range(NUM_REMOVES)])
+    rng.shuffle(events)
+
+    # Picks where they go among the puts
+    num_puts = count_edges(in_file) * repeat
+    positions = sorted(rng.sample(range(num_puts + len(events)), len(events)))
+
+    keys = read_keys(in_file)
+    if popularity is not None:
+        keys = counted(keys, popularity, repeat)
+    puts = shuffled((key for key in keys for _ in range(repeat)), rng, max(1, -(-num_puts // BUCKET_PUTS)))
+
+    creates = list(range(INITIAL_SERVERS))
+    removes = []
+    with open(out_file, 'w') as w:
+        # Creates 10 servers to begin with
+        for server_num in range(INITIAL_SERVERS):
+            w.write('create server{}\n'.format(server_num))
+
+        # Records the workload
+        written = 0
+        for position, event in zip(positions, events):
+            w.writelines('put {}\n'.format(key) for key in islice(puts, position - written))
+            w.write(event)
+            (creates if event.startswith('create') else removes).append(position + INITIAL_SERVERS)
+            written = position + 1
+        w.writelines('put {}\n'.format(key) for key in puts)
+    return creates, removes
+
+# Prints statistics of key popularity
+def print_stats(popularity):
+    print('{} keys in total'.format(len(popularity)))
+    sorted_popularity = sorted(popularity.values(), reverse=True)
+    top5 = sorted_popularity[:5]
+    bottom5 = sorted_popularity[-5:]
+    mean = statistics.mean(sorted_popularity)
+    variance = statistics.variance(sorted_popularity, mean)
+    print("mean key popularity = {}; variance of key popularity = {}".format(mean, variance))
+    print("top5 = {}".format(top5))
+    print("bottom5 = {}".format(bottom5))
+
+if __name__ == '__main__':
+    # Get the workload we're trying to generate
+    parser = argparse.ArgumentParser(description='parsing options for running tests')
+    parser.add_argument('-d', metavar='dataset', type=str,
+                        help='dataset e.g. amazon0302.txt, optionally gzipped', default='com-dblp.ungraph.txt')
+    parser.add_argument('-s', metavar='skew', type=bool,
+                        help='True (only counts as False if omitted)', default=False)
+    parser.add_argument('--seed', type=int, help='random seed, the same seed gives the same workload', default=0)
+    parser.add_argument('--stats', help='prints key popularity statistics, which keeps a count per key in memory', action='store_true')
+    out = parser.parse_args()
+    in_file = out.d
+    dataset = in_file[:-len('.gz')] if in_file.endswith('.gz') else in_file
+
+    out_file = "test_skewed_workload" if out.s else "test_workload"
+    out_file += ".txt" if dataset == 'com-dblp.ungraph.txt' else "_{}".format(dataset)
+
+    print('generating ' + out_file)
+
+    popularity = collections.Counter() if out.stats else None
+    creates, removes = generate(in_file, out_file, 10 if out.s else 1, random.Random(out.seed), popularity)
+
+    # Finds where creates and removes are located
+    print('{} creates'.format(len(creates)))
+    pprint(creates, compact=True)
+    print('{} removes'.format(len(removes)))
+    pprint(removes)
+
+    # Key Statistics
+    if popularity is not None:
+        print_stats(popularity)